@@ -1,22 +1,44 @@
-import hashlib
+import asyncio
 import uuid
+from typing import List
 
-from django.http import HttpRequest, HttpResponse
+from django.conf import settings
+from django.http import HttpRequest
+from django.utils.cache import patch_vary_headers
 from ninja import File, Query, UploadedFile
 
 from core.auth import AuthBearer
+from core.pagination import CountMode
 from core.router import Router
 from core.schemas import PaginatedQueryParams, SuccessResponseSchema
-
-from .schemas import ImageResponseSchema, ImageTransformParams, ImageUploadSchema, ImagesResponse
-from .services import ImageService
+from core.utils import response_with_data
+
+from .schemas import (
+    ImageBatchUploadResponse,
+    ImageResponseSchema,
+    ImageTransformParams,
+    ImageUploadSchema,
+    ImagesResponse,
+)
+from .services import FORMAT_AUTO, ImageService
+from .utils import (
+    accepted_types,
+    afile_response,
+    content_response,
+    etag_matches,
+    file_response,
+    image_etag,
+    not_modified,
+    offload_enabled,
+    offload_response,
+)
 
 img_router = Router(tags=["images"])
 
 
 @img_router.get("", auth=AuthBearer(), response={200: ImagesResponse})
 def get_images(request: HttpRequest, query: Query[PaginatedQueryParams] = None):
-    images = ImageService.get_user_images(request, query)
+    images = ImageService.get_user_images(request, query, count_mode=CountMode.EXACT)
     return images
 
 
@@ -33,6 +55,20 @@ def upload_image(request: HttpRequest, file: File[UploadedFile], data: ImageUplo
     return image
 
 
+@img_router.post(
+    "/upload/batch",
+    auth=AuthBearer(),
+    response={200: ImageBatchUploadResponse},
+)
+def upload_images(request: HttpRequest, files: File[List[UploadedFile]], data: ImageUploadSchema):
+    """
+    Upload several images, with a result per file
+    """
+    results = ImageService.upload_images(request=request, files=files, data=data or {})
+    uploaded = sum(1 for result in results if result["image"])
+    return response_with_data(f"{uploaded} of {len(results)} images uploaded.", results)
+
+
 @img_router.get("/{image_id}", response={200: ImageResponseSchema})
 def get_image(request: HttpRequest, image_id: uuid.UUID):
     image = ImageService.get_image(image_id)
@@ -46,24 +82,69 @@ def delete_image(request: HttpRequest, image_id: uuid.UUID):
     return "Image deleted successfully."
 
 
-@img_router.get("/serve/{image_id}", url_name="serve_image")
 def serve_image(request, image_id: uuid.UUID, parameters: Query[ImageTransformParams]):
     """Serve an image with optional transformations"""
-    image = ImageService.get_image(image_id)
-    content, content_type = ImageService.get_image_file(image, parameters)
-
-    data = parameters.dict()
-    has_transforms = any(v is not None and v != "" for v in data.values())
-    etag = f"{image.file_hash}"
-    cache_control = "public, max-age=31536000, immutable"
-    if has_transforms:
-        transform_key = f"w{parameters.width or ''}_h{parameters.height or ''}_f{parameters.format or ''}_q{parameters.quality}"
-        etag_content = f"{image.file_hash}_{transform_key}"
-        etag = hashlib.md5(etag_content.encode()).hexdigest()
-        cache_control = "public, max-age=604800, stale-while-revalidate=86400"
-
-    response = HttpResponse(content, content_type=content_type)
-    response["Cache-Control"] = cache_control
-    response["ETag"] = f'"{etag}"'
-    response["Content-Disposition"] = f'inline; filename="{image.filename}"'
+    image = ImageService.get_image_meta(image_id)
+    transform = ImageService.get_transform(image, parameters, accepted_types(request))
+    etag = image_etag(image.file_hash, transform)
+
+    if etag_matches(request, etag):
+        response = not_modified(etag)
+    elif offload_enabled() and (stored := ImageService.get_stored_file(image, transform)):
+        response = offload_response(*stored)
+    elif transform:
+        content, content_type = ImageService.transform_image(image, **transform)
+        response = content_response(request, content, content_type, etag)
+    else:
+        original = ImageService.get_original(image)
+        if isinstance(original, bytes):
+            response = content_response(request, original, image.mime_type, etag)
+        else:
+            response = file_response(request, original, image.file_size, image.mime_type, etag)
+    return _with_serve_headers(response, image, parameters, transform, etag)
+
+
+async def aserve_image(request, image_id: uuid.UUID, parameters: Query[ImageTransformParams]):
+    """serve_image for ASGI deployments, see IMAGE_SERVE_ASYNC"""
+    image = await ImageService.aget_image_meta(image_id)
+    transform = ImageService.get_transform(image, parameters, accepted_types(request))
+    etag = image_etag(image.file_hash, transform)
+
+    if etag_matches(request, etag):
+        response = not_modified(etag)
+    elif offload_enabled() and (
+        stored := await asyncio.to_thread(ImageService.get_stored_file, image, transform)
+    ):
+        response = offload_response(*stored)
+    elif transform:
+        content, content_type = await ImageService.atransform_image(image, **transform)
+        response = content_response(request, content, content_type, etag)
+    else:
+        original = await ImageService.aget_original(image)
+        if isinstance(original, bytes):
+            response = content_response(request, original, image.mime_type, etag)
+        else:
+            response = afile_response(request, original, image.file_size, image.mime_type, etag)
+    return _with_serve_headers(response, image, parameters, transform, etag)
+
+
+def _with_serve_headers(response, image, parameters, transform, etag):
+    if transform:
+        response["Cache-Control"] = "public, max-age=604800, stale-while-revalidate=86400"
+    else:
+        response["Cache-Control"] = "public, max-age=31536000, immutable"
+    response["ETag"] = etag
+    if parameters.format == FORMAT_AUTO:
+        patch_vary_headers(response, ["Accept"])
+    if response.status_code != 304:
+        response["Content-Disposition"] = f'inline; filename="{image.filename}"'
     return response
+
+
+img_router.get("/serve/{image_id}", url_name="serve_image")(
+    aserve_image if settings.IMAGE_SERVE_ASYNC else serve_image
+)
+# unlisted, so the async view can be tested and compared whatever IMAGE_SERVE_ASYNC says
+img_router.get("/serve-async/{image_id}", url_name="aserve_image", include_in_schema=False)(
+    aserve_image
+)
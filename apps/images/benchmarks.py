@@ -0,0 +1,61 @@
+"""
+Cases for the bench_image_transforms command. Django-free like workers.py: every case
+runs in a freshly spawned process so its peak memory can be read on its own.
+"""
+
+import io
+import resource
+import sys
+import time
+
+from PIL import Image as PILImage
+
+from . import workers
+
+
+def make_source(width: int, height: int, format: str) -> bytes:
+    """A noisy photo-like image, so encoders and decoders do realistic work"""
+    bands = [PILImage.effect_noise((width, height), sigma) for sigma in (40, 60, 80)]
+    image = PILImage.merge("RGB", bands)
+    output = io.BytesIO()
+    image.save(output, format=format, quality=90)
+    return output.getvalue()
+
+
+def full_decode(content: bytes, width: int, height: int, format: str, quality: int) -> bytes:
+    """The transform before decode-time downscaling: load everything, then thumbnail"""
+    image = PILImage.open(io.BytesIO(content))
+    image.load()
+    return workers.encode(workers.resize(image, width, height), format, quality)
+
+
+PATHS = {"decode-time": workers.transform, "full decode": full_decode}
+
+
+def _max_rss_kb() -> int:
+    # ru_maxrss survives fork and exec on Linux, so a spawned process would start out
+    # with the parent's peak; VmHWM belongs to this process alone
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run_case(path: str, source: str, width: int, height: int, repeat: int) -> dict:
+    """Median latency and peak resident memory the transform adds to the process"""
+    transform = PATHS[path]
+    with open(source, "rb") as f:
+        content = f.read()
+    baseline = _max_rss_kb()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        transform(content, width, height, "jpeg", workers.DEFAULT_QUALITY)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {"median_ms": timings[len(timings) // 2], "peak_kb": _max_rss_kb() - baseline}
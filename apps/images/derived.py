@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Callable
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Sum
+from django.utils import timezone
+
+from core.cache import LocalCache
+from core.utils import get_seconds
+
+from .models import DERIVED_PATH, DerivedImage, ImageFormat
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = 1024 * 1024 * 1024
+# last_accessed is only written once per interval and worker, not on every hit
+TOUCH_INTERVAL = get_seconds(minutes=1)
+# the running total only counts this worker's writes, it is re-read from the table
+# after this many of them
+TOTAL_SYNC_WRITES = 100
+
+
+class DerivedImageCache:
+    """
+    Transformed images kept in storage under media/derived/<file_hash>/<params>.<ext>.
+
+    Paths only depend on the original's hash and the transform, so every worker finds
+    what any other worker rendered, and it survives restarts. The DerivedImage table
+    indexes the files with their size and last access; once they add up to more than
+    IMAGE_DERIVED_CACHE_MAX_BYTES the least recently used unpinned ones are removed.
+    Each worker tracks the total itself and only sums the table every TOTAL_SYNC_WRITES
+    writes, so it also learns about the files the other workers added.
+    """
+
+    def __init__(self):
+        self.max_bytes = getattr(settings, "IMAGE_DERIVED_CACHE_MAX_BYTES", MAX_BYTES)
+        touch_interval = getattr(settings, "IMAGE_DERIVED_TOUCH_INTERVAL", TOUCH_INTERVAL)
+        self._touched = LocalCache(max_entries=10000, timeout=touch_interval)
+        self._total = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def path(file_hash: str, width: int, height: int, format: str, quality: int) -> str:
+        extension = ImageFormat.get_extension(format)
+        return f"{DERIVED_PATH}/{file_hash}/w{width or 0}_h{height or 0}_q{quality}.{extension}"
+
+    def get(self, file_hash: str, params: dict) -> bytes | None:
+        path = self.path(file_hash, **params)
+        content = self._read(path)
+        if content is not None:
+            self._touch(path)
+        return content
+
+    def put(self, file_hash: str, params: dict, content: bytes, pinned: bool = False):
+        path = self.path(file_hash, **params)
+        self._write(path, content)
+        self._record(path, file_hash, len(content), pinned)
+
+    @staticmethod
+    def _read(path: str) -> bytes | None:
+        try:
+            with default_storage.open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write(path: str, content: bytes):
+        if not default_storage.exists(path):
+            # another worker may have written it meanwhile, storage then picks a new name
+            # for ours and the index keeps pointing at the first one
+            default_storage.save(path, ContentFile(content))
+
+    def _record(self, path: str, file_hash: str, size: int, pinned: bool):
+        _, created = DerivedImage.objects.update_or_create(
+            path=path,
+            defaults={
+                "file_hash": file_hash,
+                "size": size,
+                "pinned": pinned,
+                "last_accessed": timezone.now(),
+            },
+        )
+        if self._add(size if created else 0) > self.max_bytes:
+            self.evict()
+
+    def get_or_create(
+        self, file_hash: str, params: dict, render: Callable[[], bytes], pinned: bool = False
+    ) -> bytes:
+        content = self.get(file_hash, params)
+        if content is None:
+            content = render()
+            try:
+                self.put(file_hash, params, content, pinned=pinned)
+            except Exception:
+                logger.exception(f"Cant store derived image for {file_hash}")
+        return content
+
+    async def aget_or_create(
+        self,
+        file_hash: str,
+        params: dict,
+        render: Callable[[], Awaitable[bytes]],
+        pinned: bool = False,
+    ) -> bytes:
+        # storage I/O runs in any thread; the index queries stay on the thread-sensitive
+        # executor, which is where Django manages async callers' connections
+        path = self.path(file_hash, **params)
+        content = await asyncio.to_thread(self._read, path)
+        if content is not None:
+            if self._touched.get(path) is None:
+                await sync_to_async(self._touch)(path)
+            return content
+
+        content = await render()
+        try:
+            await asyncio.to_thread(self._write, path, content)
+            await sync_to_async(self._record)(path, file_hash, len(content), pinned)
+        except Exception:
+            logger.exception(f"Cant store derived image for {file_hash}")
+        return content
+
+    def _add(self, size: int) -> int:
+        """Count a write of `size` new bytes and return the running total"""
+        with self._lock:
+            self._writes += 1
+            if self._total is None or self._writes >= TOTAL_SYNC_WRITES:
+                self._total = DerivedImage.objects.aggregate(total=Sum("size"))["total"] or 0
+                self._writes = 0
+            else:
+                self._total += size
+            return self._total
+
+    def evict(self):
+        """Drop least recently used unpinned files until the total fits the budget"""
+        total = DerivedImage.objects.aggregate(total=Sum("size"))["total"] or 0
+        if total > self.max_bytes:
+            candidates = DerivedImage.objects.filter(pinned=False).order_by("last_accessed")
+            for derived in candidates.only("id", "path", "size").iterator():
+                if total <= self.max_bytes:
+                    break
+                default_storage.delete(derived.path)
+                derived.delete()
+                total -= derived.size
+        with self._lock:
+            self._total = total
+            self._writes = 0
+
+    def _touch(self, path: str):
+        if self._touched.get(path):
+            return
+        self._touched.set(path, True)
+        DerivedImage.objects.filter(path=path).update(last_accessed=timezone.now())
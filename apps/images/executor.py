@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterable, Optional
+
+from django.conf import settings
+
+from core.exceptions import ServiceUnavailable
+
+logger = logging.getLogger(__name__)
+
+MODE_PROCESS = "process"
+MODE_THREAD = "thread"
+MODE_INLINE = "inline"
+
+# per web worker process, a server with N workers runs N times as many image jobs
+DEFAULT_WORKERS = 2
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRY_AFTER = 5
+
+
+class ImageExecutor:
+    """
+    Bounded pool for CPU-heavy image work (decode, resize, encode).
+
+    IMAGE_EXECUTOR_MODE picks a process pool (the default, so PIL work does not hold
+    the request workers' GIL), a thread pool, or "inline" to run jobs on the caller's
+    thread. Each web worker process has its own pool of IMAGE_EXECUTOR_WORKERS. At most
+    IMAGE_EXECUTOR_QUEUE_LIMIT jobs may be running or waiting; past that, and when a
+    job takes longer than IMAGE_EXECUTOR_TIMEOUT seconds, callers get
+    ServiceUnavailable (503 with Retry-After) instead of queueing up behind the work.
+
+    Jobs must be picklable top-level functions taking plain data, see workers.py.
+    """
+
+    def __init__(self):
+        self._pool: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._slots: Optional[threading.BoundedSemaphore] = None
+
+    @property
+    def mode(self) -> str:
+        return getattr(settings, "IMAGE_EXECUTOR_MODE", MODE_PROCESS)
+
+    @property
+    def workers(self) -> int:
+        return getattr(settings, "IMAGE_EXECUTOR_WORKERS", None) or DEFAULT_WORKERS
+
+    @property
+    def timeout(self) -> float:
+        return getattr(settings, "IMAGE_EXECUTOR_TIMEOUT", DEFAULT_TIMEOUT)
+
+    @property
+    def retry_after(self) -> int:
+        return getattr(settings, "IMAGE_EXECUTOR_RETRY_AFTER", DEFAULT_RETRY_AFTER)
+
+    def _get_pool(self) -> tuple[Executor, threading.BoundedSemaphore]:
+        with self._lock:
+            if self._pool is None:
+                if self.mode == MODE_PROCESS:
+                    # spawn, forking a threaded server process is not safe
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                else:
+                    self._pool = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="image-executor"
+                    )
+                queue_limit = getattr(settings, "IMAGE_EXECUTOR_QUEUE_LIMIT", None)
+                self._slots = threading.BoundedSemaphore(queue_limit or self.workers * 4)
+            return self._pool, self._slots
+
+    def _reset_pool(self, pool: Executor):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, fn: Callable, *args, wait: bool = False, **kwargs):
+        """
+        Run fn(*args, **kwargs) in the pool and return its result. Without `wait`, a
+        full queue raises ServiceUnavailable right away; with it (for background work)
+        the call blocks until a slot frees up.
+        """
+        if self.mode == MODE_INLINE:
+            return fn(*args, **kwargs)
+
+        pool, slots = self._get_pool()
+        future = self._submit(pool, slots, fn, args, kwargs, wait=wait)
+        return self._result(pool, future, fn, None if wait else self.timeout)
+
+    def map(self, fn: Callable, arg_lists: Iterable[tuple]) -> list:
+        """
+        Run fn(*args) for every args tuple in parallel and return the results in order.
+        Only the free slots are filled, the rest of the jobs are submitted as the batch's
+        own jobs end, so a batch does not fill the queue and fail its own items. A job
+        that fails, finds the queue full while none of the batch is running, or is not
+        done within IMAGE_EXECUTOR_TIMEOUT gives its exception in place of a result.
+        """
+        if self.mode == MODE_INLINE:
+            return [_call(fn, args) for args in arg_lists]
+
+        pool, slots = self._get_pool()
+        deadline = time.monotonic() + self.timeout
+        futures = []
+        for args in arg_lists:
+            # while a job of the batch runs, its slot frees up within the deadline
+            running = any(isinstance(future, Future) and not future.done() for future in futures)
+            try:
+                futures.append(
+                    self._submit(
+                        pool,
+                        slots,
+                        fn,
+                        args,
+                        {},
+                        wait=running,
+                        timeout=max(deadline - time.monotonic(), 0) if running else None,
+                    )
+                )
+            except ServiceUnavailable as error:
+                futures.append(error)
+
+        results = []
+        for future in futures:
+            if isinstance(future, ServiceUnavailable):
+                results.append(future)
+                continue
+            try:
+                timeout = max(deadline - time.monotonic(), 0)
+                results.append(self._result(pool, future, fn, timeout))
+            except (Exception, ServiceUnavailable) as error:
+                results.append(error)
+        return results
+
+    async def arun(self, fn: Callable, *args, **kwargs):
+        """run() for async views, awaiting the job instead of blocking the event loop"""
+        if self.mode == MODE_INLINE:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+
+        pool, slots = self._get_pool()
+        future = self._submit(pool, slots, fn, args, kwargs, wait=False)
+        try:
+            # shielded, a timed out or cancelled request leaves the job running like run()
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), self.timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Image job {fn.__name__} exceeded {self.timeout}s")
+            raise ServiceUnavailable(
+                "Image processing took too long, please try again shortly.", self.retry_after
+            )
+        except BrokenProcessPool:
+            self._reset_pool(pool)
+            raise ServiceUnavailable("Image processing is restarting.", self.retry_after)
+
+    def _submit(
+        self,
+        pool: Executor,
+        slots: threading.BoundedSemaphore,
+        fn: Callable,
+        args: tuple,
+        kwargs: dict,
+        wait: bool,
+        timeout: Optional[float] = None,
+    ) -> Future:
+        if not slots.acquire(blocking=wait, timeout=timeout):
+            raise ServiceUnavailable(
+                "Image processing is busy, please try again shortly.", self.retry_after
+            )
+        try:
+            future: Future = pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            slots.release()
+            self._reset_pool(pool)
+            raise ServiceUnavailable("Image processing is restarting.", self.retry_after)
+        except Exception:
+            slots.release()
+            raise
+        # the slot stays taken until the job really ends, even after a timeout
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def _result(self, pool: Executor, future: Future, fn: Callable, timeout: Optional[float]):
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.warning(f"Image job {fn.__name__} exceeded {self.timeout}s")
+            raise ServiceUnavailable(
+                "Image processing took too long, please try again shortly.", self.retry_after
+            )
+        except BrokenProcessPool:
+            self._reset_pool(pool)
+            raise ServiceUnavailable("Image processing is restarting.", self.retry_after)
+
+
+def _call(fn: Callable, args: tuple):
+    try:
+        return fn(*args)
+    except Exception as error:
+        return error
+
+
+image_executor = ImageExecutor()
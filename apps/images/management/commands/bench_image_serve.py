@@ -0,0 +1,64 @@
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test /api/images/serve on a WSGI and an ASGI deployment (the latter with "
+        "IMAGE_SERVE_ASYNC=1) and compare requests/sec for warm and cold transforms."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("image_id", help="An image both deployments can serve")
+        parser.add_argument("--wsgi-url", default="http://127.0.0.1:8000")
+        parser.add_argument("--asgi-url", default="http://127.0.0.1:8001")
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument(
+            "--cold-width", type=int, default=200, help="Cold requests use widths from here up"
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'server':<8}{'images':<8}{'req/s':>10}{'p50':>10}{'p95':>10}{'errors':>8}"
+        )
+        for server in ("wsgi", "asgi"):
+            base = f"{options[f'{server}_url'].rstrip('/')}/api/images/serve/{options['image_id']}"
+            # warm: one transform, rendered once and then served from the caches
+            warm = [f"{base}?width=120"] * options["requests"]
+            self._fetch(warm[0])
+            # cold: a new width per request, so every one renders and stores a transform
+            # (the derived cache keeps them, widths differ between the two servers)
+            offset = options["cold_width"] + (0 if server == "wsgi" else options["requests"])
+            cold = [f"{base}?width={offset + index}" for index in range(options["requests"])]
+            for label, urls in (("warm", warm), ("cold", cold)):
+                self.stdout.write(f"{server:<8}{label:<8}{self._run(urls, options['concurrency'])}")
+
+    def _run(self, urls: list[str], concurrency: int) -> str:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(self._fetch, urls))
+        elapsed = time.perf_counter() - started
+        timings = sorted(timing for timing, ok in results)
+        errors = sum(not ok for timing, ok in results)
+        p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)]
+        return (
+            f"{len(urls) / elapsed:>10.1f}{statistics.median(timings):>8.1f}ms"
+            f"{p95:>8.1f}ms{errors:>8}"
+        )
+
+    @staticmethod
+    def _fetch(url: str) -> tuple[float, bool]:
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=60) as response:
+                response.read()
+                ok = response.status == 200
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return (time.perf_counter() - started) * 1000, ok
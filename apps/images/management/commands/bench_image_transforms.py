@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from apps.images.benchmarks import PATHS, make_source, run_case
+
+SOURCES = [(1200, 800), (3000, 2000), (6000, 4000)]
+TARGETS = [100, 400, 1200]
+
+
+class Command(BaseCommand):
+    help = (
+        "Time image transforms and measure their peak memory by source and target size, "
+        "decode-time downscaling against a full decode. Each case runs in a new process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=["jpeg", "png"], default="jpeg")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context("spawn")
+        self.stdout.write(
+            f"{'source':<12}{'target':>8}  {'path':<14}{'median':>12}{'peak RSS':>12}"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            for width, height in SOURCES:
+                source = os.path.join(directory, f"{width}x{height}")
+                with open(source, "wb") as f:
+                    f.write(make_source(width, height, options["format"]))
+                for target in TARGETS:
+                    for path in PATHS:
+                        # a fresh process per case, peak RSS only ever grows within one
+                        with ProcessPoolExecutor(1, mp_context=context) as pool:
+                            result = pool.submit(
+                                run_case, path, source, target, target, options["repeat"]
+                            ).result()
+                        self.stdout.write(
+                            f"{f'{width}x{height}':<12}{target:>8}  {path:<14}"
+                            f"{result['median_ms']:>10.1f}ms{result['peak_kb'] / 1024:>10.1f}MB"
+                        )
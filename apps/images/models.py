@@ -1,9 +1,12 @@
+from django.conf import settings
 from django.core.files.storage import default_storage
 from django.db import models
+from django.utils import timezone
 
 from core.models import TimestampedModel
 
 IMAGE_PATH = "api/images/serve"
+DERIVED_PATH = "media/derived"
 
 
 class ImageCategory(models.TextChoices):
@@ -18,6 +21,7 @@ class MimeType(models.TextChoices):
     PNG = "image/png", "PNG"
     WEBP = "image/webp", "WebP"
     GIF = "image/gif", "GIF"
+    AVIF = "image/avif", "AVIF"
 
     @classmethod
     def get_extension(cls, mime_type):
@@ -26,6 +30,7 @@ class MimeType(models.TextChoices):
             cls.PNG: "png",
             cls.WEBP: "webp",
             cls.GIF: "gif",
+            cls.AVIF: "avif",
         }
         return mapping.get(mime_type, "bin")
 
@@ -35,6 +40,7 @@ class ImageFormat(models.TextChoices):
     PNG = "png", "PNG"
     WEBP = "webp", "WebP"
     GIF = "gif", "GIF"
+    AVIF = "avif", "AVIF"
 
     @classmethod
     def get_mime_type(cls, format):
@@ -43,6 +49,7 @@ class ImageFormat(models.TextChoices):
             cls.PNG: MimeType.PNG.value,
             cls.WEBP: MimeType.WEBP.value,
             cls.GIF: MimeType.GIF.value,
+            cls.AVIF: MimeType.AVIF.value,
         }
         return mapping.get(format, MimeType.JPEG)
 
@@ -52,7 +59,18 @@ class ImageFormat(models.TextChoices):
 
     @classmethod
     def supported_transparancy(cls, format_name):
-        return format_name in [cls.PNG, cls.JPEG, cls.WEBP, cls.GIF]
+        return format_name in [cls.PNG, cls.JPEG, cls.WEBP, cls.GIF, cls.AVIF]
+
+
+def variant_presets(category: str) -> dict[str, dict]:
+    """Named transforms (width/height/format/quality) generated ahead of time for a category"""
+    return getattr(settings, "IMAGE_VARIANT_PRESETS", {}).get(category, {})
+
+
+def upload_limits(category: str) -> dict:
+    """Header limits (formats, max_width, max_height, max_pixels) for uploads in a category"""
+    limits = getattr(settings, "IMAGE_UPLOAD_LIMITS", {})
+    return {**limits.get("default", {}), **limits.get(category, {})}
 
 
 class Image(TimestampedModel):
@@ -113,13 +131,51 @@ class Image(TimestampedModel):
         return self.get_url()
 
     @property
-    def thumbnail(self, width=400, height=400):
-        return self.get_url(width=width, height=height)
+    def thumbnail(self):
+        preset = variant_presets(self.category).get("thumbnail")
+        if preset:
+            return self.get_url(**preset)
+        return self.get_url(width=400, height=400)
 
     def delete_file(self):
+        DerivedImage.delete_for(self.file_hash)
         if self.file_path and default_storage.exists(self.file_path):
             default_storage.delete(self.file_path)
 
     def delete(self, *args, **kwargs):
         self.delete_file()
         super().delete(*args, **kwargs)
+
+
+class DerivedImage(TimestampedModel):
+    """Index of the transformed copies of an image kept in storage, see DerivedImageCache"""
+
+    file_hash = models.CharField(max_length=64, db_index=True)
+    path = models.CharField(max_length=500, unique=True)
+    size = models.PositiveIntegerField()
+    # variants from IMAGE_VARIANT_PRESETS, never evicted
+    pinned = models.BooleanField(default=False)
+    last_accessed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.path
+
+    class Meta(TimestampedModel.Meta):
+        verbose_name = "Derived Image"
+        verbose_name_plural = "Derived Images"
+        db_table = "derived_images"
+
+    @classmethod
+    def delete_for(cls, file_hash: str):
+        """Remove every derived copy of the image with this hash, files included"""
+        derived = cls.objects.filter(file_hash=file_hash)
+        paths = set(derived.values_list("path", flat=True))
+        try:
+            # also catch files whose index row was never written
+            _, files = default_storage.listdir(f"{DERIVED_PATH}/{file_hash}")
+            paths.update(f"{DERIVED_PATH}/{file_hash}/{name}" for name in files)
+        except (FileNotFoundError, NotImplementedError):
+            pass
+        for path in paths:
+            default_storage.delete(path)
+        derived.delete()
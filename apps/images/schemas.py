@@ -1,9 +1,9 @@
-from typing import Optional
+from typing import List, Optional
 
 from ninja import ModelSchema, Schema
 from pydantic import field_validator
 
-from core.schemas import PaginatedResponseSchema
+from core.schemas import BaseSchema, PaginatedResponseSchema
 
 from .models import Image, ImageCategory
 
@@ -16,7 +16,7 @@ class ImageUploadSchema(Schema):
 
     @field_validator("category")
     def validate_category(cls, value):
-        if value not in ImageCategory.choices:
+        if value not in ImageCategory.values:
             return ImageCategory.UNCATEGORIZED
         return value
 
@@ -51,9 +51,20 @@ class ImageResponseSchema(ModelSchema):
 class ImageTransformParams(Schema):
     width: Optional[int] = None
     height: Optional[int] = None
-    format: Optional[str] = None
+    format: Optional[str] = None  # a format, or "auto" to negotiate from Accept
     quality: Optional[int] = None
 
 
+class ImageUploadResultSchema(Schema):
+    filename: str
+    image: Optional[ImageResponseSchema] = None
+    duplicate: bool = False
+    error: Optional[str] = None
+
+
+class ImageBatchUploadResponse(BaseSchema):
+    data: List[ImageUploadResultSchema]
+
+
 class ImagesResponse(PaginatedResponseSchema[ImageResponseSchema]):
     message: str = "Images retrieved successfully"
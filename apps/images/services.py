@@ -1,29 +1,68 @@
+import asyncio
 import hashlib
 import io
-from typing import Union
+import logging
+import os
+import tempfile
+from contextlib import ExitStack, contextmanager
+from dataclasses import astuple, dataclass, fields
+from typing import Iterable, Iterator, Optional, Union
 from uuid import UUID
 
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core.files.base import File
 from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
 from django.http import Http404, HttpRequest
 from PIL import Image as PILImage
+from PIL import features
 
 from apps.users.models import CustomUser
 from apps.users.utils import get_user_from_request
 from core.cache import Cache
-from core.pagination import Paginator
+from core.exceptions import ServiceUnavailable
+from core.metrics import get_metrics
+from core.pagination import CountMode, Paginator
 from core.utils import get_seconds
 
-from .models import Image, ImageCategory, ImageFormat
+from . import workers
+from .derived import DerivedImageCache
+from .executor import image_executor
+from .models import Image, ImageCategory, ImageFormat, upload_limits, variant_presets
+from .tasks import run_in_background
+
+logger = logging.getLogger(__name__)
+
+# serve query format asking for the smallest format the client accepts
+FORMAT_AUTO = "auto"
+AUTO_FORMATS = ["avif", "webp"]
+UPLOAD_CHUNK_SIZE = 64 * 1024
+BATCH_UPLOAD_MAX_FILES = 20
+DUPLICATE_UPLOAD_MESSAGE = "Image has already been uploaded."
+
+
+class UploadRejected(ValueError):
+    """An upload failing validation, `reason` names the rejection counter"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
 
 
 class ImageProcessor:
+    DEFAULT_QUALITY = 85
 
     @classmethod
     def allowed_formats(cls):
         return {choices[0] for choices in ImageFormat.choices}
 
+    @classmethod
+    def auto_formats(cls) -> list[str]:
+        """IMAGE_AUTO_FORMATS this Pillow build can encode"""
+        formats = getattr(settings, "IMAGE_AUTO_FORMATS", AUTO_FORMATS)
+        return [format for format in formats if features.check(format)]
+
     @classmethod
     def allowed_mime_types(cls):
         return {ImageFormat.get_mime_type(fmt) for fmt in cls.allowed_formats()}
@@ -32,6 +71,70 @@ class ImageProcessor:
     def calculate_hash(file: bytes):
         return hashlib.sha256(file).hexdigest()
 
+    @staticmethod
+    @contextmanager
+    def spool_upload(file: UploadedFile, size_limit: int) -> Iterator[tuple[str, str]]:
+        """
+        Yield (path, sha256) for the upload on disk, hashing it chunk by chunk on the way.
+        Uploads Django already spooled to a temporary file are used in place, others are
+        copied to one that is removed afterwards. Uploads larger than `size_limit` are
+        rejected as soon as that many bytes have been read.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        temp_file = None
+        try:
+            if hasattr(file, "temporary_file_path"):
+                path = file.temporary_file_path()
+            else:
+                temp_file = tempfile.NamedTemporaryFile(
+                    dir=settings.FILE_UPLOAD_TEMP_DIR, suffix=".upload", delete=False
+                )
+                path = temp_file.name
+            for chunk in file.chunks(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > size_limit:
+                    raise UploadRejected("size", "File size exceeds the maximum limit.")
+                hasher.update(chunk)
+                if temp_file is not None:
+                    temp_file.write(chunk)
+            if temp_file is not None:
+                temp_file.close()
+            yield path, hasher.hexdigest()
+        finally:
+            if temp_file is not None:
+                temp_file.close()
+                os.unlink(temp_file.name)
+
+    @classmethod
+    def validate_header(cls, path: str, category: str) -> tuple[str, int, int]:
+        """
+        (format, width, height) of the image at `path`, checked against the category's
+        upload_limits. Only the header is read, so oversized images and decompression
+        bombs are rejected before any pixel is decoded or anything is stored.
+        """
+        limits = upload_limits(category)
+        try:
+            with PILImage.open(path) as image:
+                format = image.format.lower() if image.format else "unknown"
+                width, height = image.size
+        except PILImage.DecompressionBombError:
+            raise UploadRejected("pixels", "Image has too many pixels.")
+        except Exception:
+            raise UploadRejected("invalid", "Invalid image file.")
+
+        if format not in limits.get("formats", cls.allowed_formats()):
+            raise UploadRejected("format", f"Unsupported image format: {format}")
+        max_width, max_height = limits.get("max_width"), limits.get("max_height")
+        if (max_width and width > max_width) or (max_height and height > max_height):
+            raise UploadRejected(
+                "dimensions", f"Image dimensions exceed {max_width}x{max_height} pixels."
+            )
+        max_pixels = limits.get("max_pixels")
+        if max_pixels and width * height > max_pixels:
+            raise UploadRejected("pixels", "Image has too many pixels.")
+        return format, width, height
+
     @staticmethod
     def get_image_info(image: PILImage.Image):
         return {
@@ -47,31 +150,33 @@ class ImageProcessor:
         if target_format not in ImageProcessor.allowed_formats():
             raise ValueError(f"Unsupported target format: {target_format}")
 
-        output = io.BytesIO()
+        return io.BytesIO(workers.encode(image, str(target_format), quality))
 
-        if target_format == ImageFormat.JPEG and image.mode in ("RGBA", "P"):
-            background = PILImage.new("RGB", image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1] if image.mode == "RGBA" else None)
-            image = background
+    @staticmethod
+    def resize_image(image: PILImage.Image, width: int, height: int):
+        return workers.resize(image, width, height)
 
-        save_kwargs = {"format": target_format, "optimize": True}
-        if target_format == "JPEG":
-            save_kwargs["quality"] = quality
-            save_kwargs["progressive"] = True
-        elif target_format == "PNG":
-            save_kwargs["compress_level"] = 6
-        elif target_format == "WEBP":
-            save_kwargs["quality"] = quality
-            save_kwargs["method"] = 6
 
-        image.save(output, **save_kwargs)
-        output.seek(0)
-        return output
+@dataclass(frozen=True)
+class ImageMeta:
+    """
+    What serving an image needs from its row, small enough to cache per id. It has the
+    same attribute names as Image, so it can stand in for one in the serve helpers.
+    """
 
-    @staticmethod
-    def resize_image(image: PILImage.Image, width: int, height: int):
-        image.thumbnail((width, height), PILImage.Resampling.LANCZOS)
-        return image
+    id: str
+    file_path: str
+    file_hash: str
+    filename: str
+    category: str
+    mime_type: str
+    format: str
+    width: int
+    height: int
+    file_size: int
+
+
+IMAGE_META_FIELDS = tuple(field.name for field in fields(ImageMeta))
 
 
 class ImageService:
@@ -81,6 +186,12 @@ class ImageService:
     user_images_cache = Cache(prefix="user_images", timeout=get_seconds(minutes=10))
     image_cache = Cache(prefix="image_cache", timeout=get_seconds(minutes=30))
     image_transform_cache = Cache(prefix="image_transform", timeout=get_seconds(hours=1))
+    image_meta_cache = Cache(prefix="image_meta", timeout=get_seconds(hours=24))
+    derived_cache = DerivedImageCache()
+    # read with `manage.py cache_stats --namespace images`
+    upload_metrics = get_metrics("images:uploads")
+    # larger payloads are only kept in storage, the in-memory caches hold a reference
+    MEMORY_CACHE_MAX_BYTES = getattr(settings, "IMAGE_MEMORY_CACHE_MAX_BYTES", 256 * 1024)
 
     @classmethod
     def get_format_info(cls, image: PILImage.Image):
@@ -100,53 +211,253 @@ class ImageService:
         data,
     ):
         user: CustomUser = get_user_from_request(request)
+        fields = cls._upload_fields(data)
+        try:
+            image = cls._store_upload(user, file, fields)
+        except ValueError as error:
+            cls._count_rejection(error)
+            raise
+        cls.upload_metrics.incr("accepted")
+        return image
+
+    @classmethod
+    def upload_images(cls, request: HttpRequest, files: list[UploadedFile], data) -> list[dict]:
+        """
+        Upload several images sharing the same data. The batch needs one dedup query, is
+        processed in parallel by the image executor, stored with one bulk_create and
+        invalidates the user's cache once. Returns a result per file, in order, with the
+        image or the error that rejected it.
+        """
+        user: CustomUser = get_user_from_request(request)
+        fields = cls._upload_fields(data)
+        max_files = getattr(settings, "IMAGE_BATCH_UPLOAD_MAX_FILES", BATCH_UPLOAD_MAX_FILES)
+        if not files:
+            raise ValueError("No files uploaded.")
+        if len(files) > max_files:
+            raise ValueError(f"At most {max_files} images can be uploaded at once.")
+
+        results = [
+            {"filename": file.name, "image": None, "duplicate": False, "error": None}
+            for file in files
+        ]
+        new_images = []
+        with ExitStack() as stack:
+            spooled = {}
+            for index, file in enumerate(files):
+                try:
+                    if file.size and file.size > cls.FILE_SIZE_LIMIT:
+                        raise UploadRejected("size", "File size exceeds the maximum limit.")
+                    path, file_hash = stack.enter_context(
+                        ImageProcessor.spool_upload(file, cls.FILE_SIZE_LIMIT)
+                    )
+                    ImageProcessor.validate_header(path, fields["category"])
+                    spooled[index] = (path, file_hash)
+                except ValueError as error:
+                    cls._count_rejection(error)
+                    results[index]["error"] = str(error)
+
+            # file_hash is unique across users, so images of other users count as taken
+            existing = {
+                image.file_hash: image
+                for image in Image.objects.filter(
+                    file_hash__in={file_hash for _, file_hash in spooled.values()}
+                )
+            }
+            jobs, repeats = {}, []
+            for index, (path, file_hash) in spooled.items():
+                if file_hash in existing:
+                    image = existing[file_hash]
+                    if image.uploaded_by_id == user.id:
+                        results[index].update(image=image, duplicate=True)
+                    else:
+                        cls._count_rejection(UploadRejected("duplicate", DUPLICATE_UPLOAD_MESSAGE))
+                        results[index]["error"] = DUPLICATE_UPLOAD_MESSAGE
+                elif file_hash in jobs:
+                    repeats.append((index, jobs[file_hash][0]))
+                else:
+                    optimized = stack.enter_context(
+                        tempfile.NamedTemporaryFile(
+                            dir=settings.FILE_UPLOAD_TEMP_DIR, suffix=".optimized"
+                        )
+                    )
+                    jobs[file_hash] = (index, path, optimized.name)
+
+            allowed_formats = sorted(ImageProcessor.allowed_formats())
+            processed = image_executor.map(
+                workers.process_upload,
+                [(path, allowed_formats, output) for _, path, output in jobs.values()],
+            )
+            for (file_hash, (index, _, output)), result in zip(jobs.items(), processed):
+                if isinstance(result, ValueError):
+                    cls._count_rejection(result)
+                    results[index]["error"] = str(result)
+                elif isinstance(result, ServiceUnavailable):
+                    results[index]["error"] = str(result)
+                elif isinstance(result, Exception):
+                    logger.error(f"Cant process upload {file_hash}", exc_info=result)
+                    results[index]["error"] = "Image processing failed."
+                else:
+                    try:
+                        image = cls._build_image(user, file_hash, output, result, fields)
+                    except BaseException:
+                        cls._delete_stored(image for _, image in new_images)
+                        raise
+                    results[index]["image"] = image
+                    new_images.append((index, image))
+
+        new_images = cls._insert_uploads(user, new_images, results)
+        for index, first in repeats:
+            results[index].update(
+                image=results[first]["image"],
+                duplicate=results[first]["image"] is not None,
+                error=results[first]["error"],
+            )
+        cls.upload_metrics.incr("accepted", sum(1 for result in results if result["image"]))
+        if new_images:
+            cls.user_images_cache.delete_pattern(f"user_{user.id}_*")
+            if variant_presets(fields["category"]):
+                for image in new_images:
+                    run_in_background(cls.generate_variants, image)
+        return results
+
+    @classmethod
+    def _insert_uploads(
+        cls, user: CustomUser, new_images: list[tuple[int, Image]], results: list[dict]
+    ) -> list[Image]:
+        """
+        Write the rows of a batch with one bulk_create. If another upload inserted one of
+        the files first, the rows are written one by one and a file that lost the race
+        gets the existing image or an error as its result. Stored files whose row was not
+        written are deleted. Returns the images that were inserted.
+        """
+        try:
+            with transaction.atomic():
+                Image.objects.bulk_create([image for _, image in new_images])
+            return [image for _, image in new_images]
+        except IntegrityError:
+            pass
+        except BaseException:
+            cls._delete_stored(image for _, image in new_images)
+            raise
+
+        inserted = []
+        for position, (index, image) in enumerate(new_images):
+            try:
+                with transaction.atomic():
+                    image.save(force_insert=True)
+                inserted.append(image)
+                continue
+            except IntegrityError:
+                pass
+            except BaseException:
+                cls._delete_stored(image for _, image in new_images[position:])
+                raise
+            cls._delete_stored([image])
+            try:
+                existing = cls._existing_upload(user, image.file_hash)
+            except UploadRejected as error:
+                cls._count_rejection(error)
+                existing, results[index]["error"] = None, str(error)
+            if existing:
+                results[index].update(image=existing, duplicate=True)
+            else:
+                results[index]["image"] = None
+                results[index]["error"] = results[index]["error"] or "Image upload failed."
+        return inserted
+
+    @staticmethod
+    def _delete_stored(images: Iterable[Image]):
+        for image in images:
+            try:
+                default_storage.delete(image.file_path)
+            except Exception:
+                logger.exception(f"Cant delete stored upload {image.file_path}")
+
+    @staticmethod
+    def _upload_fields(data) -> dict:
         data = data.dict(exclude_unset=True) if hasattr(data, "dict") else data
-        category = data.get("category", ImageCategory.UNCATEGORIZED)
-        alt_text = data.get("alt_text", "")
-        title = data.get("title", "")
-        description = data.get("description", "")
-        if file.size and file.size > cls.FILE_SIZE_LIMIT:
-            raise ValueError("File size exceeds the maximum limit.")
-        file_content = file.read()
-        file.seek(0)
+        return {
+            "category": data.get("category", ImageCategory.UNCATEGORIZED),
+            "alt_text": data.get("alt_text", ""),
+            "title": data.get("title", ""),
+            "description": data.get("description", ""),
+        }
 
-        file_hash = ImageProcessor.calculate_hash(file_content)
-        existing_image = Image.objects.filter(file_hash=file_hash, uploaded_by=user).first()
+    @classmethod
+    def _count_rejection(cls, error: ValueError):
+        # failures past the header check come from decoding in the worker
+        cls.upload_metrics.incr("rejected")
+        cls.upload_metrics.incr(f"rejected_{getattr(error, 'reason', 'invalid')}")
 
-        if existing_image:
-            return existing_image
+    @classmethod
+    def _store_upload(cls, user: CustomUser, file: UploadedFile, fields: dict) -> Image:
+        if file.size and file.size > cls.FILE_SIZE_LIMIT:
+            raise UploadRejected("size", "File size exceeds the maximum limit.")
+
+        with ImageProcessor.spool_upload(file, cls.FILE_SIZE_LIMIT) as (path, file_hash):
+            ImageProcessor.validate_header(path, fields["category"])
+            existing_image = cls._existing_upload(user, file_hash)
+            if existing_image:
+                return existing_image
+
+            with tempfile.NamedTemporaryFile(
+                dir=settings.FILE_UPLOAD_TEMP_DIR, suffix=".optimized"
+            ) as optimized:
+                processed = image_executor.run(
+                    workers.process_upload,
+                    path,
+                    sorted(ImageProcessor.allowed_formats()),
+                    optimized.name,
+                )
+                image = cls._build_image(user, file_hash, optimized.name, processed, fields)
 
         try:
-            pil_image = PILImage.open(file)
-            image_info = ImageProcessor.get_image_info(pil_image)
-            format, mime_type = cls.get_format_info(pil_image)
-        except Exception:
-            raise ValueError("Invalid image file.")
-
-        file_extension = ImageFormat.get_extension(mime_type)
-        optimized_image_io = ImageProcessor.optimize_image(pil_image, format)
-        optmized_content = optimized_image_io.getvalue()
-        file_size = len(optmized_content)
-        filename = f"{file_hash}.{file_extension}"
-        upload_path = f"media/images/{category}/{filename}"
-        save_path = default_storage.save(upload_path, ContentFile(optmized_content))
-        image = Image.objects.create(
+            with transaction.atomic():
+                image.save()
+        except IntegrityError:
+            # the same file was stored by a concurrent upload, keep its copy only
+            default_storage.delete(image.file_path)
+            existing_image = cls._existing_upload(user, file_hash)
+            if existing_image is None:
+                raise
+            return existing_image
+        cls.clear_cache(image)
+        if variant_presets(image.category):
+            run_in_background(cls.generate_variants, image)
+        return image
+
+    @staticmethod
+    def _existing_upload(user: CustomUser, file_hash: str) -> Optional[Image]:
+        """The image already stored for `file_hash`, file_hash is unique across users"""
+        image = Image.objects.filter(file_hash=file_hash).first()
+        if image and image.uploaded_by_id != user.id:
+            raise UploadRejected("duplicate", DUPLICATE_UPLOAD_MESSAGE)
+        return image
+
+    @classmethod
+    def _build_image(
+        cls, user: CustomUser, file_hash: str, path: str, processed: dict, fields: dict
+    ) -> Image:
+        """Store the re-encoded upload the worker wrote to `path`, the row is left unsaved"""
+        format = processed["format"]
+        filename = f"{file_hash}.{ImageFormat.get_extension(format)}"
+        upload_path = f"media/images/{fields['category']}/{filename}"
+        # reopened, the worker wrote the file by name
+        with open(path, "rb") as f:
+            save_path = default_storage.save(upload_path, File(f))
+            file_size = os.fstat(f.fileno()).st_size
+        return Image(
             uploaded_by=user,
             filename=filename,
-            category=category,
             file_path=save_path,
             file_size=file_size,
             file_hash=file_hash,
-            mime_type=mime_type,
+            mime_type=ImageFormat.get_mime_type(format),
             format=format,
-            width=image_info["width"],
-            height=image_info["height"],
-            alt_text=alt_text,
-            title=title,
-            description=description,
+            width=processed["width"],
+            height=processed["height"],
+            **fields,
         )
-        cls.clear_cache(image)
-        return image
 
     @classmethod
     def get_image(cls, image: Union[UUID, str, Image]) -> Image:
@@ -160,100 +471,307 @@ class ImageService:
             raise
 
     @classmethod
-    def get_user_images(cls, request: HttpRequest, query):
+    def get_image_meta(cls, image_id: Union[UUID, str]) -> ImageMeta:
+        """Cached ImageMeta for the id, so serving a known image needs no query"""
+        image_id = str(image_id)
+        cache_key = cls.image_meta_cache.generate_key({"id": image_id}, suffix=image_id)
+        meta = cls.image_meta_cache.get(cache_key)
+        if meta is not None:
+            return ImageMeta(*meta)
+
+        try:
+            values = Image.objects.values(*IMAGE_META_FIELDS).get(id=image_id)
+        except Image.DoesNotExist:
+            raise Http404("Image not found")
+        meta = ImageMeta(**{**values, "id": str(values["id"])})
+        # stored as a plain tuple, cheaper to pickle and independent of the class
+        cls.image_meta_cache.set(cache_key, astuple(meta))
+        return meta
+
+    @classmethod
+    async def aget_image_meta(cls, image_id: Union[UUID, str]) -> ImageMeta:
+        image_id = str(image_id)
+        cache_key = await cls.image_meta_cache.agenerate_key({"id": image_id}, suffix=image_id)
+        meta = await cls.image_meta_cache.aget(cache_key)
+        if meta is not None:
+            return ImageMeta(*meta)
+
+        try:
+            values = await Image.objects.values(*IMAGE_META_FIELDS).aget(id=image_id)
+        except Image.DoesNotExist:
+            raise Http404("Image not found")
+        meta = ImageMeta(**{**values, "id": str(values["id"])})
+        await cls.image_meta_cache.aset(cache_key, astuple(meta))
+        return meta
+
+    @classmethod
+    def get_user_images(cls, request: HttpRequest, query, count_mode: CountMode = None):
         user = get_user_from_request(request)
         query_params = query.dict(exclude_unset=True) if query else {}
         page = query_params.get("page", 1)
         page_size = query_params.get("page_size", 10)
+        cursor = query_params.get("cursor")
 
         key_data = {
             "page": page,
             "page_size": page_size,
+            "cursor": cursor,
+            "count_mode": count_mode,
         }
         cache_key = cls.user_images_cache.generate_key(key_data, suffix=f"user_{str(user.id)}")
-        cached_response = cls.user_images_cache.get(cache_key)
 
-        if cached_response:
-            return cached_response
+        def get_page():
+            queryset = Image.objects.filter(uploaded_by=user)
+            paginator = Paginator(
+                request, queryset=queryset, page_size=page_size, count_mode=count_mode
+            )
+            return paginator.get_page(page, cursor=cursor)
 
-        queryset = Image.objects.filter(uploaded_by=user).order_by("-created_at")
-        paginator = Paginator(request, queryset=queryset, page_size=page_size)
-        page_obj = paginator.get_page(page)
-        cls.user_images_cache.set(cache_key, page_obj)
-        return page_obj
+        return cls.user_images_cache.get_or_compute(cache_key, get_page)
 
     @classmethod
     def get_image_file(cls, image: Image | UUID, transform_data=None):
         """Get image file content and content type"""
         image = cls.get_image(image)
-        if not default_storage.exists(image.file_path):
-            raise FileNotFoundError("Image file not found")
-
-        cache_key = None
-        if transform_data is None:
-            cache_key = cls.image_cache.generate_key({"file_hash": image.file_hash})
-            cached_content = cls.image_cache.get(cache_key) if cache_key else None
-            if cached_content:
-                return cached_content
-
-        if transform_data:
-            transform_params = (
-                transform_data.dict(exclude_unset=True)
-                if hasattr(transform_data, "dict")
-                else transform_data
-            )
-            return cls.transform_image(image, **transform_params)
+        transform = cls.get_transform(image, transform_data)
+        if transform:
+            return cls.transform_image(image, **transform)
+
+        original = cls.get_original(image)
+        if not isinstance(original, bytes):
+            with original:
+                original = original.read()
+        return (original, image.mime_type)
+
+    @classmethod
+    def get_original(cls, image: Image | ImageMeta) -> Union[bytes, File]:
+        """
+        The original's bytes when it is small enough for the in-memory cache, otherwise
+        the stored file opened for streaming, which the caller closes.
+        """
+        if image.file_size > cls.MEMORY_CACHE_MAX_BYTES:
+            return cls.open_original(image)
+
+        cache_key = cls.image_cache.generate_key({"file_hash": image.file_hash})
+        cached_content = cls.image_cache.get(cache_key)
+        if cached_content:
+            return cached_content[0]
 
-        with default_storage.open(image.file_path, "rb") as f:
+        with cls.open_original(image) as f:
             content = f.read()
-        result = (content, image.mime_type)
-        if cache_key:
-            cls.image_cache.set(cache_key, result)
-        return result
+        cls.image_cache.set(cache_key, (content, image.mime_type))
+        return content
+
+    @classmethod
+    async def aget_original(cls, image: Image | ImageMeta) -> Union[bytes, File]:
+        """get_original with the storage calls run in a thread"""
+        if image.file_size > cls.MEMORY_CACHE_MAX_BYTES:
+            return await asyncio.to_thread(cls.open_original, image)
+
+        cache_key = await cls.image_cache.agenerate_key({"file_hash": image.file_hash})
+        cached_content = await cls.image_cache.aget(cache_key)
+        if cached_content:
+            return cached_content[0]
+
+        content = await asyncio.to_thread(cls.read_original, image)
+        await cls.image_cache.aset(cache_key, (content, image.mime_type))
+        return content
+
+    @classmethod
+    def get_transform(
+        cls, image: Image | ImageMeta, transform_data=None, accepted_types: Iterable[str] = ()
+    ) -> Optional[dict]:
+        """
+        transform_image arguments for the serve query, None when it asks for the original.
+        format=auto is resolved against the client's `accepted_types`, so the cache key and
+        ETag name the format actually served.
+        """
+        params = (
+            transform_data.dict(exclude_unset=True)
+            if hasattr(transform_data, "dict")
+            else transform_data or {}
+        )
+        if not any(value is not None and value != "" for value in params.values()):
+            return None
+        format = params.get("format")
+        if format == FORMAT_AUTO:
+            format = cls.negotiate_format(image, accepted_types)
+            resized = any(params.get(key) for key in ("width", "height", "quality"))
+            if format == image.format and not resized:
+                return None
+        params = cls.normalize_transform(
+            image,
+            target_format=format,
+            width=params.get("width"),
+            height=params.get("height"),
+            quality=params.get("quality"),
+        )
+        params["target_format"] = params.pop("format")
+        return params
+
+    @classmethod
+    def negotiate_format(cls, image: Image | ImageMeta, accepted_types: Iterable[str]) -> str:
+        """The first auto format the client accepts, or the original's format"""
+        accepted_types = set(accepted_types)
+        for format in ImageProcessor.auto_formats():
+            if ImageFormat.get_mime_type(format) in accepted_types:
+                return format
+        return image.format
+
+    @classmethod
+    def open_original(cls, image: Image | ImageMeta) -> File:
+        """The stored original opened for streaming, the caller closes it"""
+        try:
+            return default_storage.open(image.file_path, "rb")
+        except FileNotFoundError:
+            raise Http404("Image file not found")
+
+    @classmethod
+    def read_original(cls, image: Image | ImageMeta) -> bytes:
+        with cls.open_original(image) as f:
+            return f.read()
+
+    @classmethod
+    def get_stored_file(cls, image: Image | ImageMeta, transform: Optional[dict] = None):
+        """
+        (path, content type) of the stored file answering the serve request, without
+        reading it: the original, or a derived copy that has already been rendered.
+        """
+        if not transform:
+            return image.file_path, image.mime_type
+        params = cls.normalize_transform(image, **transform)
+        path = cls.derived_cache.path(image.file_hash, **params)
+        if default_storage.exists(path):
+            return path, ImageFormat.get_mime_type(params["format"])
+        return None
 
     @classmethod
     def transform_image(
         cls,
-        image: Image,
+        image: Image | ImageMeta,
         target_format: ImageFormat = None,
         width: int = None,
         height: int = None,
-        quality: int = 85,
+        quality: int = None,
     ):
-        image = cls.get_image(image)
-        if not default_storage.exists(image.file_path):
-            raise FileNotFoundError("Image file not found")
-        transform_params = {
-            "target_format": target_format,
-            "width": width,
-            "height": height,
-            "quality": quality,
-        }
-        cache_key = cls.image_transform_cache.generate_key(transform_params, suffix=image.file_hash)
-        cached_content = cls.image_transform_cache.get(cache_key)
+        if not isinstance(image, ImageMeta):
+            image = cls.get_image(image)
+        params = cls.normalize_transform(image, target_format, width, height, quality)
+        mime_type = ImageFormat.get_mime_type(params["format"])
+        cache_key = cls.image_transform_cache.generate_key(params, suffix=image.file_hash)
+
+        def get_derived():
+            # preset variants are normally ready, rendered after upload
+            return cls.derived_cache.get_or_create(
+                image.file_hash,
+                params,
+                lambda: cls.render_transform(image, **params),
+                pinned=params in cls.variant_params(image),
+            )
 
-        if cached_content:
-            return cached_content
+        def render():
+            content = get_derived()
+            return (content if len(content) <= cls.MEMORY_CACHE_MAX_BYTES else None, mime_type)
+
+        content, mime_type = cls.image_transform_cache.get_or_compute(cache_key, render)
+        if content is None:
+            content = get_derived()
+        return (content, mime_type)
 
-        with default_storage.open(image.file_path, "rb") as f:
-            pil_image = PILImage.open(f)
-            pil_image.load()
+    @classmethod
+    async def atransform_image(
+        cls,
+        image: ImageMeta,
+        target_format: ImageFormat = None,
+        width: int = None,
+        height: int = None,
+        quality: int = None,
+    ):
+        """transform_image for async views, the image work runs in the image executor"""
+        params = cls.normalize_transform(image, target_format, width, height, quality)
+        mime_type = ImageFormat.get_mime_type(params["format"])
+        cache_key = await cls.image_transform_cache.agenerate_key(params, suffix=image.file_hash)
+
+        async def get_derived():
+            return await cls.derived_cache.aget_or_create(
+                image.file_hash,
+                params,
+                lambda: cls.arender_transform(image, **params),
+                pinned=params in cls.variant_params(image),
+            )
 
-        if width or height:
-            target_width = width if width else image.width
-            target_height = height if height else image.height
-            pil_image = ImageProcessor.resize_image(pil_image, target_width, target_height)
+        async def render():
+            content = await get_derived()
+            return (content if len(content) <= cls.MEMORY_CACHE_MAX_BYTES else None, mime_type)
 
-        target_format = target_format if target_format else image.format
-        if not target_format or target_format not in ImageProcessor.allowed_formats():
-            raise ValueError(f"Unsupported target format: {target_format}")
-        mime_type = ImageFormat.get_mime_type(target_format)
+        content, mime_type = await cls.image_transform_cache.aget_or_compute(cache_key, render)
+        if content is None:
+            content = await get_derived()
+        return (content, mime_type)
 
-        optimized_image_io = ImageProcessor.optimize_image(pil_image, target_format, quality)
-        content = optimized_image_io.getvalue()
-        result = (content, mime_type)
-        cls.image_transform_cache.set(cache_key, result)
-        return result
+    @classmethod
+    def normalize_transform(
+        cls,
+        image: Image | ImageMeta,
+        target_format: ImageFormat = None,
+        width: int = None,
+        height: int = None,
+        quality: int = None,
+    ) -> dict:
+        """Transform parameters with the defaults filled in, so equal requests look equal"""
+        format = (target_format or image.format or "").lower()
+        if format not in ImageProcessor.allowed_formats():
+            raise ValueError(f"Unsupported target format: {format}")
+        return {
+            "width": width or None,
+            "height": height or None,
+            "format": format,
+            "quality": quality or ImageProcessor.DEFAULT_QUALITY,
+        }
+
+    @classmethod
+    def variant_params(cls, image: Image | ImageMeta) -> list[dict]:
+        return [
+            cls.normalize_transform(
+                image,
+                target_format=preset.get("format"),
+                width=preset.get("width"),
+                height=preset.get("height"),
+                quality=preset.get("quality"),
+            )
+            for preset in variant_presets(image.category).values()
+        ]
+
+    @classmethod
+    def render_transform(
+        cls, image: Image | ImageMeta, width, height, format, quality, wait: bool = False
+    ) -> bytes:
+        """Render a transform in the image executor, see ImageExecutor.run for `wait`"""
+        content = cls.read_original(image)
+        return image_executor.run(
+            workers.transform, content, width, height, format, quality, wait=wait
+        )
+
+    @classmethod
+    async def arender_transform(
+        cls, image: Image | ImageMeta, width, height, format, quality
+    ) -> bytes:
+        content = await asyncio.to_thread(cls.read_original, image)
+        return await image_executor.arun(workers.transform, content, width, height, format, quality)
+
+    @classmethod
+    def generate_variants(cls, image: Image):
+        """Render the category's preset variants into the derived image cache"""
+        for params in cls.variant_params(image):
+            try:
+                cls.derived_cache.get_or_create(
+                    image.file_hash,
+                    params,
+                    lambda: cls.render_transform(image, **params, wait=True),
+                    pinned=True,
+                )
+            except Exception:
+                logger.exception(f"Cant generate variant {params} for {image.file_hash}")
 
     @classmethod
     def update_image_metadata(
@@ -290,5 +808,6 @@ class ImageService:
 
         image_cache_key = cls.image_cache.generate_key({"file_hash": image.file_hash})
         cls.image_cache.delete(image_cache_key)
+        cls.image_meta_cache.invalidate(str(image.id))
 
         cls.image_transform_cache.delete_pattern(f"*{image.file_hash}*")
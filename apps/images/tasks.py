@@ -0,0 +1,57 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "IMAGE_VARIANT_WORKERS", DEFAULT_WORKERS),
+                thread_name_prefix="image-variants",
+            )
+        return _executor
+
+
+def _call(fn: Callable, *args, **kwargs):
+    try:
+        fn(*args, **kwargs)
+    except Exception:
+        logger.exception(f"Background image task {fn.__name__} failed")
+
+
+def _run(fn: Callable, *args, **kwargs):
+    """_call on a pool thread, which must not keep its database connection open"""
+    close_old_connections()
+    try:
+        _call(fn, *args, **kwargs)
+    finally:
+        connection.close()
+
+
+def run_in_background(fn: Callable, *args, **kwargs):
+    """
+    Run fn in the image worker pool once the current transaction commits, so workers
+    never see rows or files that end up rolled back. IMAGE_VARIANT_WORKERS = 0 runs it
+    inline instead.
+    """
+
+    def submit():
+        if getattr(settings, "IMAGE_VARIANT_WORKERS", DEFAULT_WORKERS) <= 0:
+            _call(fn, *args, **kwargs)
+        else:
+            get_executor().submit(_run, fn, *args, **kwargs)
+
+    transaction.on_commit(submit)
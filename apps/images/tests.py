@@ -1,3 +1,653 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import tempfile
+import threading
+import time
+from unittest import mock
+from urllib.parse import quote
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from PIL import Image as PILImage
+
+from apps.users.models import CustomUser
+from core.cache import get_key_hasher
+from core.exceptions import ServiceUnavailable
+from core.metrics import read_metrics
+
+from . import tasks, workers
+from .derived import DerivedImageCache
+from .executor import ImageExecutor
+from .models import DerivedImage, Image, ImageCategory, ImageFormat, MimeType, variant_presets
+from .services import ImageService
+from .utils import (
+    RangeNotSatisfiable,
+    accepted_types,
+    image_etag,
+    offload_response,
+    parse_range,
+)
+
+
+class TemporaryStorageMixin:
+    """Runs each test against an empty FileSystemStorage and an empty cache"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        storages = self.settings(
+            STORAGES={
+                "default": {
+                    "BACKEND": "django.core.files.storage.FileSystemStorage",
+                    "OPTIONS": {"location": media_root.name},
+                },
+                "staticfiles": {
+                    "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+                },
+            }
+        )
+        storages.enable()
+        self.addCleanup(storages.disable)
+        cache.clear()
+
+
+def png_bytes(color=(200, 30, 30), size=(120, 80)) -> bytes:
+    output = io.BytesIO()
+    PILImage.new("RGB", size, color).save(output, "PNG")
+    return output.getvalue()
+
+
+class UploadFixtures(TemporaryStorageMixin):
+    """Two users and an inline image executor, for the upload tests"""
+
+    def setUp(self):
+        super().setUp()
+        executor = self.settings(IMAGE_EXECUTOR_MODE="inline")
+        executor.enable()
+        self.addCleanup(executor.disable)
+        self.owner = CustomUser.objects.create(email="owner@example.com", username="owner")
+        self.other = CustomUser.objects.create(email="other@example.com", username="other")
+
+    def upload(self, user, content, name="upload.png"):
+        request = RequestFactory().post("/api/images/upload")
+        request.auth = user
+        file = SimpleUploadedFile(name, content, content_type="image/png")
+        return ImageService.upload_image(request, file, {})
+
+    def stored_files(self):
+        _, files = default_storage.listdir(f"media/images/{ImageCategory.UNCATEGORIZED}")
+        return files
+
+    def rejections(self) -> dict:
+        ImageService.upload_metrics.flush()
+        metrics = read_metrics("images:uploads").get("images:uploads", {})
+        return metrics.get("counters", {})
+
+
+class UploadImageTests(UploadFixtures, TestCase):
+    def test_repeated_upload_returns_the_stored_image(self):
+        image = self.upload(self.owner, png_bytes())
+        self.assertEqual(self.upload(self.owner, png_bytes(), "again.png"), image)
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_file_uploaded_by_another_user_is_rejected(self):
+        self.upload(self.owner, png_bytes())
+        with self.assertRaisesMessage(ValueError, "Image has already been uploaded."):
+            self.upload(self.other, png_bytes())
+        self.assertEqual(Image.objects.count(), 1)
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_concurrent_upload_of_the_same_file_keeps_one_copy(self):
+        image = self.upload(self.owner, png_bytes())
+        # the other upload passes the dedup check before this one's row is written
+        with mock.patch.object(ImageService, "_existing_upload", side_effect=[None, image]):
+            self.assertEqual(self.upload(self.owner, png_bytes()), image)
+        self.assertEqual(self.stored_files(), [image.filename])
+
+    def assert_rejected(self, reason, message, content=None, **limits):
+        before = self.rejections()
+        upload_limits = {"default": {"formats": ["png"], **limits}}
+        with self.settings(IMAGE_UPLOAD_LIMITS=upload_limits), mock.patch.object(
+            workers, "process_upload"
+        ) as process_upload:
+            with self.assertRaisesMessage(ValueError, message):
+                self.upload(self.owner, png_bytes() if content is None else content)
+        process_upload.assert_not_called()
+        self.assertFalse(Image.objects.exists())
+        self.assertFalse(default_storage.exists("media/images"))
+
+        after = self.rejections()
+        self.assertEqual(after["rejected"] - before.get("rejected", 0), 1)
+        counter = f"rejected_{reason}"
+        self.assertEqual(after[counter] - before.get(counter, 0), 1)
+
+    def test_disallowed_format_is_rejected(self):
+        output = io.BytesIO()
+        PILImage.new("RGB", (10, 10)).save(output, "GIF")
+        self.assert_rejected("format", "Unsupported image format: gif", output.getvalue())
+
+    def test_images_over_the_header_limits_are_rejected(self):
+        # png_bytes() is 120x80
+        for width, height in ((100, 1000), (1000, 50)):
+            self.assert_rejected(
+                "dimensions",
+                f"Image dimensions exceed {width}x{height} pixels.",
+                max_width=width,
+                max_height=height,
+            )
+        self.assert_rejected("pixels", "Image has too many pixels.", max_pixels=9000)
+
+    def test_files_that_are_not_images_are_rejected(self):
+        self.assert_rejected("invalid", "Invalid image file.", b"not an image")
+
+    def test_decompression_bombs_are_rejected_before_decoding(self):
+        with mock.patch.object(PILImage, "MAX_IMAGE_PIXELS", 1000):
+            self.assert_rejected("pixels", "Image has too many pixels.")
+
+    def test_oversized_files_are_rejected_while_spooling(self):
+        with mock.patch.object(ImageService, "FILE_SIZE_LIMIT", 100):
+            self.assert_rejected("size", "File size exceeds the maximum limit.")
+
+
+class UploadImagesTests(UploadFixtures, TestCase):
+    def upload_batch(self, user, contents):
+        request = RequestFactory().post("/api/images/upload/batch")
+        request.auth = user
+        files = [
+            SimpleUploadedFile(f"upload{index}.png", content, content_type="image/png")
+            for index, content in enumerate(contents)
+        ]
+        return ImageService.upload_images(request, files, {})
+
+    def test_each_file_gets_its_own_result(self):
+        existing = self.upload(self.owner, png_bytes((1, 1, 1)))
+        taken = self.upload(self.other, png_bytes((2, 2, 2)))
+        before = self.rejections()
+        new = png_bytes((3, 3, 3))
+        results = self.upload_batch(
+            self.owner, [new, new, png_bytes((1, 1, 1)), b"not an image", png_bytes((2, 2, 2))]
+        )
+
+        self.assertEqual(
+            [result["filename"] for result in results],
+            [f"upload{index}.png" for index in range(5)],
+        )
+        image = results[0]["image"]
+        self.assertEqual(image.uploaded_by, self.owner)
+        self.assertEqual(
+            [(result["image"], result["duplicate"], result["error"]) for result in results],
+            [
+                (image, False, None),
+                (image, True, None),
+                (existing, True, None),
+                (None, False, "Invalid image file."),
+                (None, False, "Image has already been uploaded."),
+            ],
+        )
+        self.assertCountEqual(
+            self.stored_files(), [existing.filename, taken.filename, image.filename]
+        )
+        after = self.rejections()
+        for counter in ("rejected_invalid", "rejected_duplicate"):
+            self.assertEqual(after[counter] - before.get(counter, 0), 1)
+
+    def test_batch_size_is_limited(self):
+        with self.settings(IMAGE_BATCH_UPLOAD_MAX_FILES=2):
+            with self.assertRaisesMessage(ValueError, "At most 2 images can be uploaded at once."):
+                self.upload_batch(self.owner, [png_bytes((index, 0, 0)) for index in range(3)])
+        self.assertFalse(Image.objects.exists())
+        self.assertFalse(default_storage.exists("media/images"))
+
+    def test_file_inserted_by_a_concurrent_upload_gets_its_own_result(self):
+        taken, free = png_bytes((1, 2, 3)), png_bytes((4, 5, 6))
+        taken_hash = hashlib.sha256(taken).hexdigest()
+        process_upload = workers.process_upload
+
+        def process_while_another_upload_inserts(*args):
+            if not Image.objects.filter(file_hash=taken_hash).exists():
+                Image.objects.create(
+                    uploaded_by=self.other,
+                    filename=f"{taken_hash}.png",
+                    file_path=f"media/images/uncategorized/{taken_hash}.png",
+                    file_size=len(taken),
+                    width=120,
+                    height=80,
+                    format=ImageFormat.PNG,
+                    mime_type=MimeType.PNG,
+                    file_hash=taken_hash,
+                )
+            return process_upload(*args)
+
+        with mock.patch.object(
+            workers, "process_upload", side_effect=process_while_another_upload_inserts
+        ):
+            results = self.upload_batch(self.owner, [taken, free, taken])
+
+        self.assertEqual(
+            [result["error"] for result in results],
+            ["Image has already been uploaded.", None, "Image has already been uploaded."],
+        )
+        self.assertIsNone(results[0]["image"])
+        self.assertEqual(results[1]["image"].uploaded_by, self.owner)
+        self.assertEqual(self.stored_files(), [results[1]["image"].filename])
+
+
+class VariantPipelineTests(TemporaryStorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        inline = self.settings(IMAGE_EXECUTOR_MODE="inline", IMAGE_VARIANT_WORKERS=0)
+        inline.enable()
+        self.addCleanup(inline.disable)
+        self.owner = CustomUser.objects.create(email="owner@example.com", username="owner")
+
+    def upload(self):
+        request = RequestFactory().post("/api/images/upload")
+        request.auth = self.owner
+        file = SimpleUploadedFile("product.png", png_bytes(), content_type="image/png")
+        return ImageService.upload_image(request, file, {"category": ImageCategory.PRODUCTS})
+
+    def test_preset_variants_are_pinned_and_served_without_rendering(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = self.upload()
+
+        presets = variant_presets(ImageCategory.PRODUCTS)
+        derived = DerivedImage.objects.filter(file_hash=image.file_hash)
+        self.assertEqual(derived.count(), len(presets))
+        self.assertTrue(all(variant.pinned for variant in derived))
+        for variant in derived:
+            self.assertTrue(default_storage.exists(variant.path))
+
+        with mock.patch.object(ImageService.derived_cache, "max_bytes", 0):
+            ImageService.derived_cache.evict()
+        for variant in derived:
+            self.assertTrue(default_storage.exists(variant.path))
+
+        with mock.patch.object(ImageService, "render_transform") as render_transform:
+            for preset in presets.values():
+                response = self.client.get(f"/api/images/serve/{image.id}", preset)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response["Content-Type"], MimeType.WEBP)
+        render_transform.assert_not_called()
+
+    def test_nothing_is_scheduled_when_the_upload_rolls_back(self):
+        with mock.patch.object(ImageService, "generate_variants") as generate_variants:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    self.upload()
+                    raise RuntimeError
+        self.assertEqual(callbacks, [])
+        generate_variants.assert_not_called()
+
+    def test_pool_threads_close_their_connection(self):
+        job = mock.Mock(side_effect=RuntimeError, __name__="job")
+        with mock.patch.multiple(
+            tasks, close_old_connections=mock.DEFAULT, connection=mock.DEFAULT
+        ) as patched, self.assertLogs("apps.images.tasks", "ERROR"):
+            tasks._run(job, 1)
+        job.assert_called_once_with(1)
+        patched["close_old_connections"].assert_called_once()
+        patched["connection"].close.assert_called_once()
+
+
+class ServeImageTests(TemporaryStorageMixin, TestCase):
+    serve_path = "/api/images/serve"
+
+    def setUp(self):
+        super().setUp()
+        output = io.BytesIO()
+        PILImage.new("RGB", (120, 80), (200, 30, 30)).save(output, "PNG")
+        content = output.getvalue()
+        file_hash = "a" * 64
+        path = default_storage.save(f"media/images/products/{file_hash}.png", ContentFile(content))
+        self.image = Image.objects.create(
+            name="test",
+            category=ImageCategory.PRODUCTS,
+            filename=f"{file_hash}.png",
+            file_path=path,
+            file_size=len(content),
+            width=120,
+            height=80,
+            format=ImageFormat.PNG,
+            mime_type=MimeType.PNG,
+            file_hash=file_hash,
+        )
+        self.content = content
+        self.url = f"{self.serve_path}/{self.image.id}"
+
+    def get(self, params=None, **headers):
+        return self.client.get(self.url, params or {}, headers=headers)
+
+    def read(self, response) -> bytes:
+        if not response.streaming:
+            return response.content
+        if not response.is_async:
+            return b"".join(response.streaming_content)
+
+        async def read_async():
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        return async_to_sync(read_async)()
+
+    def assert_warm_request_is_free(self, params=None):
+        response = self.get(params)
+        self.assertEqual(response.status_code, 200)
+
+        no_storage = mock.patch.multiple(
+            default_storage,
+            exists=mock.Mock(side_effect=AssertionError("storage.exists() called")),
+            open=mock.Mock(side_effect=AssertionError("storage.open() called")),
+            size=mock.Mock(side_effect=AssertionError("storage.size() called")),
+        )
+        with self.assertNumQueries(0), no_storage:
+            response = self.get(params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_warm_original_needs_no_queries_or_storage(self):
+        response = self.assert_warm_request_is_free()
+        self.assertEqual(response["Content-Type"], MimeType.PNG)
+
+    def test_warm_transform_needs_no_queries_or_storage(self):
+        response = self.assert_warm_request_is_free({"width": 60, "format": "webp"})
+        self.assertEqual(response["Content-Type"], MimeType.WEBP)
+
+    def test_auto_format_skips_refused_types(self):
+        response = self.get({"format": "auto"}, accept="image/avif;q=0, image/webp")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], MimeType.WEBP)
+
+    def test_not_modified_needs_no_queries_or_storage(self):
+        etag = self.get()["ETag"]
+        with self.assertNumQueries(0), mock.patch.object(default_storage, "open") as open_:
+            response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        open_.assert_not_called()
+
+    def test_deleted_image_is_not_served_from_cached_metadata(self):
+        self.get()
+        ImageService.clear_cache(self.image)
+        self.image.delete()
+        self.assertEqual(self.get().status_code, 404)
+
+    def test_large_originals_are_streamed_with_ranges(self):
+        with mock.patch.object(ImageService, "MEMORY_CACHE_MAX_BYTES", 0):
+            response = self.get()
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEqual(self.read(response), self.content)
+
+            response = self.get(range="bytes=10-19")
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.content)}")
+            self.assertEqual(self.read(response), self.content[10:20])
+
+            response = self.get(range=f"bytes={len(self.content)}-")
+            self.assertEqual(response.status_code, 416)
+
+    def test_cold_transform_is_rendered_and_stored(self):
+        response = self.get({"width": 60, "format": "webp"})
+        self.assertEqual(response.status_code, 200)
+        with PILImage.open(io.BytesIO(self.read(response))) as rendered:
+            self.assertEqual((rendered.format, rendered.width), ("WEBP", 60))
+        self.assertTrue(DerivedImage.objects.filter(file_hash=self.image.file_hash).exists())
+
+    def test_stored_files_are_offloaded_to_the_proxy(self):
+        path = self.image.file_path
+        cases = [
+            ({}, "X-Accel-Redirect", f"/protected/{quote(path)}"),
+            ({"IMAGE_SERVE_OFFLOAD_PREFIX": "/internal/"}, "X-Accel-Redirect", f"/internal/{path}"),
+        ]
+        for overrides, header, value in cases:
+            with self.subTest(**overrides), self.settings(
+                IMAGE_SERVE_OFFLOAD="x-accel-redirect", **overrides
+            ):
+                self.assert_offloaded(self.get(), header, value)
+        with self.settings(IMAGE_SERVE_OFFLOAD="x-sendfile"):
+            response = self.get()
+        self.assert_offloaded(response, "X-Sendfile", default_storage.path(path))
+        self.assertEqual(response["ETag"], image_etag(self.image.file_hash, None))
+        self.assertEqual(response["Cache-Control"], "public, max-age=31536000, immutable")
+
+    def test_unrendered_transforms_are_rendered_instead_of_offloaded(self):
+        cases = [
+            ("x-accel-redirect", 60, "X-Accel-Redirect", lambda path: f"/protected/{quote(path)}"),
+            ("x-sendfile", 40, "X-Sendfile", default_storage.path),
+        ]
+        for mode, width, header, expected in cases:
+            params = {"width": width, "format": "webp"}
+            transform = {"target_format": "webp", "width": width}
+            with self.subTest(mode=mode), self.settings(IMAGE_SERVE_OFFLOAD=mode):
+                self.assertIsNone(ImageService.get_stored_file(self.image, transform))
+                response = self.get(params)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn(header, response)
+                with PILImage.open(io.BytesIO(self.read(response))) as rendered:
+                    self.assertEqual((rendered.format, rendered.width), ("WEBP", width))
+
+                path, content_type = ImageService.get_stored_file(self.image, transform)
+                self.assertEqual(content_type, MimeType.WEBP)
+                response = self.get(params)
+                self.assert_offloaded(response, header, expected(path))
+                self.assertEqual(response["Content-Type"], MimeType.WEBP)
+                self.assertIn("stale-while-revalidate", response["Cache-Control"])
+
+    def assert_offloaded(self, response, header, value):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response[header], value)
+        self.assertEqual(self.read(response), b"")
+        self.assertTrue(response["ETag"])
+        self.assertTrue(response["Cache-Control"])
+
+
+class AsyncServeImageTests(ServeImageTests):
+    """The ServeImageTests cases against aserve_image, through AsyncClient"""
+
+    serve_path = "/api/images/serve-async"
+
+    def get(self, params=None, **headers):
+        return async_to_sync(self.async_client.get)(self.url, params or {}, headers=headers)
+
+    def test_requests_reach_the_async_view(self):
+        with mock.patch.object(
+            ImageService, "aget_image_meta", wraps=ImageService.aget_image_meta
+        ) as aget_image_meta:
+            self.assertEqual(self.get().status_code, 200)
+        aget_image_meta.assert_awaited_once()
+
+
+class DerivedImageCacheTests(TemporaryStorageMixin, TestCase):
+    params = {"width": 10, "height": 0, "format": "png", "quality": 85}
+
+    def put(self, derived_cache, name, size):
+        derived_cache.put(name * 64, self.params, b"x" * size)
+
+    def test_writes_do_not_sum_the_table_every_time(self):
+        derived_cache = DerivedImageCache()
+        self.put(derived_cache, "a", 10)
+        with CaptureQueriesContext(connection) as queries:
+            for name in "bcd":
+                self.put(derived_cache, name, 10)
+        self.assertFalse([query for query in queries if "SUM(" in query["sql"]])
+        self.assertEqual(derived_cache._total, 40)
+
+    def test_least_recently_used_files_are_evicted_past_the_budget(self):
+        derived_cache = DerivedImageCache()
+        derived_cache.max_bytes = 25
+        for name in "abc":
+            self.put(derived_cache, name, 10)
+        self.assertEqual(
+            sorted(DerivedImage.objects.values_list("file_hash", flat=True)), ["b" * 64, "c" * 64]
+        )
+        self.assertIsNone(derived_cache.get("a" * 64, self.params))
+        self.assertEqual(derived_cache._total, 20)
+
+
+class ParseRangeTests(SimpleTestCase):
+    def parse(self, header, size=100, etag='"abc"', **headers):
+        request = RequestFactory().get("/", HTTP_RANGE=header, **headers)
+        return parse_range(request, size, etag)
+
+    def test_ranges(self):
+        self.assertEqual(self.parse("bytes=0-9"), (0, 9))
+        self.assertEqual(self.parse("bytes=90-"), (90, 99))
+        self.assertEqual(self.parse("bytes=-10"), (90, 99))
+        # past the end is cut to the content
+        self.assertEqual(self.parse("bytes=95-200"), (95, 99))
+        self.assertEqual(self.parse("bytes=-500"), (0, 99))
+
+    def test_full_content_for_unsupported_or_malformed_ranges(self):
+        for header in ("", "items=0-9", "bytes=0-9,20-29", "bytes=5", "bytes=a-b"):
+            with self.subTest(header=header):
+                self.assertIsNone(self.parse(header))
+
+    def test_if_range_must_match_the_etag(self):
+        self.assertEqual(self.parse("bytes=0-9", HTTP_IF_RANGE='"abc"'), (0, 9))
+        self.assertIsNone(self.parse("bytes=0-9", HTTP_IF_RANGE='"old"'))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ("bytes=100-", "bytes=50-10", "bytes=-0"):
+            with self.subTest(header=header), self.assertRaises(RangeNotSatisfiable):
+                self.parse(header)
+
+
+class DownscaleTests(SimpleTestCase):
+    def encoded(self, format, size=(2000, 1600), mode="RGB"):
+        output = io.BytesIO()
+        PILImage.new(mode, size, 128).save(output, format)
+        return output.getvalue()
+
+    def test_choose_resample(self):
+        Resampling = PILImage.Resampling
+        self.assertEqual(workers.choose_resample(1.2, 85), Resampling.BILINEAR)
+        self.assertEqual(workers.choose_resample(2, 85), Resampling.BICUBIC)
+        self.assertEqual(workers.choose_resample(1.2, 90), Resampling.LANCZOS)
+        self.assertEqual(workers.choose_resample(2, 95), Resampling.LANCZOS)
+
+    def test_large_jpegs_are_decoded_in_draft_mode(self):
+        image = PILImage.open(io.BytesIO(self.encoded("JPEG")))
+        image.draft = mock.Mock(wraps=image.draft)
+        result = workers.downscale(image, 200, 200)
+        # REDUCING_GAP times the 200x160 target
+        image.draft.assert_called_once_with(None, (400, 320))
+        self.assertEqual(image.size, (500, 400))
+        self.assertEqual(result.size, (200, 160))
+
+    def test_other_formats_are_reduced_to_at_least_the_gap(self):
+        resized = []
+        original_resize = PILImage.Image.resize
+
+        def record_resize(image, size, *args, **kwargs):
+            resized.append(image.size)
+            return original_resize(image, size, *args, **kwargs)
+
+        image = PILImage.open(io.BytesIO(self.encoded("PNG")))
+        image.reduce = mock.Mock(wraps=image.reduce)
+        with mock.patch.object(PILImage.Image, "resize", record_resize):
+            result = workers.downscale(image, 200, 200)
+        image.reduce.assert_called_once_with(5)
+        self.assertEqual(resized, [(400, 320)])
+        self.assertEqual(result.size, (200, 160))
+
+    def test_output_matches_the_full_decode(self):
+        cases = [("JPEG", "RGB"), ("PNG", "RGB"), ("PNG", "RGBA"), ("PNG", "P"), ("PNG", "L")]
+        for format, mode in cases:
+            with self.subTest(format=format, mode=mode):
+                content = self.encoded(format, (1999, 1333), mode)
+                downscaled = workers.downscale(PILImage.open(io.BytesIO(content)), 300, 300)
+                full = workers.resize(PILImage.open(io.BytesIO(content)), 300, 300)
+                self.assertEqual(downscaled.size, full.size)
+                self.assertEqual(downscaled.mode, full.mode)
+                self.assertEqual(downscaled.mode, mode)
+
+    def test_small_images_are_returned_unchanged(self):
+        image = PILImage.open(io.BytesIO(self.encoded("PNG", (100, 80))))
+        self.assertIs(workers.downscale(image, 200, 200), image)
+
+
+class ImageEtagTests(SimpleTestCase):
+    def test_transform_etags_do_not_follow_the_key_hasher(self):
+        self.addCleanup(get_key_hasher.cache_clear)
+        transform = {"target_format": "webp", "width": 60}
+        etags = set()
+        for hasher in ("blake2b", "md5"):
+            with self.settings(CACHE_KEY_HASHER=hasher):
+                get_key_hasher.cache_clear()
+                etags.add(image_etag("a" * 64, transform))
+        digest = hashlib.blake2b(b'{"target_format":"webp","width":60}', digest_size=8)
+        self.assertEqual(etags, {f'"{"a" * 16}-{digest.hexdigest()}"'})
+        self.assertEqual(image_etag("a" * 64), f'"{"a" * 64}"')
+
+
+class OffloadResponseTests(SimpleTestCase):
+    def test_x_accel_redirect_quotes_the_path_under_the_prefix(self):
+        with self.settings(IMAGE_SERVE_OFFLOAD="x-accel-redirect"):
+            response = offload_response("media/images/a b#1.png", MimeType.PNG)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected/media/images/a%20b%231.png")
+        self.assertEqual((response["Content-Type"], response.content), (MimeType.PNG, b""))
+
+    def test_unknown_mode_is_a_configuration_error(self):
+        with self.settings(IMAGE_SERVE_OFFLOAD="x-unknown"):
+            with self.assertRaises(ImproperlyConfigured):
+                offload_response("media/images/a.png", MimeType.PNG)
+
+
+class ImageExecutorTests(SimpleTestCase):
+    def executor(self):
+        executor = ImageExecutor()
+        self.addCleanup(lambda: executor._pool and executor._pool.shutdown())
+        return executor
+
+    def test_inline_arun_keeps_the_job_off_the_event_loop(self):
+        async def run():
+            return threading.get_ident(), await ImageExecutor().arun(threading.get_ident)
+
+        with self.settings(IMAGE_EXECUTOR_MODE="inline"):
+            loop_thread, job_thread = asyncio.run(run())
+        self.assertNotEqual(loop_thread, job_thread)
+
+    def test_map_queues_a_batch_larger_than_the_free_slots(self):
+        def job(value):
+            time.sleep(0.02)
+            return value
+
+        executor = self.executor()
+        with self.settings(
+            IMAGE_EXECUTOR_MODE="thread", IMAGE_EXECUTOR_WORKERS=1, IMAGE_EXECUTOR_QUEUE_LIMIT=2
+        ):
+            self.assertEqual(executor.map(job, [(value,) for value in range(6)]), list(range(6)))
+
+    def test_map_fails_fast_when_other_jobs_fill_the_queue(self):
+        release = threading.Event()
+        executor = self.executor()
+        with self.settings(
+            IMAGE_EXECUTOR_MODE="thread", IMAGE_EXECUTOR_WORKERS=1, IMAGE_EXECUTOR_QUEUE_LIMIT=1
+        ):
+            pool, slots = executor._get_pool()
+            executor._submit(pool, slots, release.wait, (), {}, wait=False)
+            results = executor.map(abs, [(-1,), (-2,)])
+            release.set()
+        self.assertTrue(all(isinstance(result, ServiceUnavailable) for result in results))
+
+
+class AcceptedTypesTests(SimpleTestCase):
+    def accepted(self, header):
+        return accepted_types(RequestFactory().get("/", HTTP_ACCEPT=header))
+
+    def test_explicit_types_only(self):
+        self.assertEqual(
+            self.accepted("image/avif, image/webp;q=0.9, image/*;q=0.8, */*;q=0.5"),
+            {"image/avif", "image/webp"},
+        )
+
+    def test_refused_types_are_left_out(self):
+        self.assertEqual(self.accepted("image/avif;q=0, image/webp"), {"image/webp"})
+        self.assertEqual(self.accepted("image/avif; q=0.0"), set())
@@ -0,0 +1,225 @@
+import asyncio
+from hashlib import blake2b
+from typing import IO, AsyncIterator, Iterator, Optional
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpRequest, HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
+
+from core.cache import encode_key_data
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+OFFLOAD_X_ACCEL_REDIRECT = "x-accel-redirect"
+OFFLOAD_X_SENDFILE = "x-sendfile"
+
+
+class RangeNotSatisfiable(Exception):
+    """The requested byte range lies outside the content"""
+
+
+def image_etag(file_hash: str, transform: Optional[dict] = None) -> str:
+    """
+    ETag for an image response, derived only from the original's hash and the
+    normalized transform so it can be checked before touching storage. The hash is
+    fixed rather than CACHE_KEY_HASHER, so changing that setting does not invalidate
+    the ETags clients and CDNs hold.
+    """
+    if not transform:
+        return quote_etag(file_hash)
+    digest = blake2b(encode_key_data(transform), digest_size=8).hexdigest()
+    return quote_etag(f"{file_hash[:16]}-{digest}")
+
+
+def etag_matches(request: HttpRequest, etag: str) -> bool:
+    """If-None-Match check, weak comparison as RFC 9110 asks for"""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    etags = parse_etags(header)
+    if "*" in etags:
+        return True
+    return _strip_weak(etag) in {_strip_weak(tag) for tag in etags}
+
+
+def _strip_weak(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def accepted_types(request: HttpRequest) -> set[str]:
+    """
+    Media types the Accept header names explicitly. Wildcards are left out, clients send
+    */* and image/* without decoding every image format, and so are types refused with
+    q=0 (which Django only drops itself from 5.2 on).
+    """
+    return {
+        f"{media_type.main_type}/{media_type.sub_type}"
+        for media_type in request.accepted_types
+        if media_type.sub_type != "*" and media_type.quality > 0
+    }
+
+
+def not_modified(etag: str) -> HttpResponse:
+    response = HttpResponse(status=304)
+    response["ETag"] = etag
+    return response
+
+
+def parse_range(request: HttpRequest, size: int, etag: str) -> Optional[tuple[int, int]]:
+    """
+    The (start, end) byte positions, end inclusive, asked for by the Range header, or
+    None to send the whole content. Only single ranges are supported; anything else is
+    answered with the full content, which the spec allows.
+    """
+    header = request.headers.get("Range")
+    if not header or not header.startswith("bytes="):
+        return None
+    if_range = request.headers.get("If-Range")
+    if if_range and if_range != etag:
+        return None
+    spec = header[len("bytes=") :].strip()
+    if "," in spec or "-" not in spec:
+        return None
+
+    first, last = (part.strip() for part in spec.split("-", 1))
+    try:
+        if not first:
+            # suffix range, the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def range_not_satisfiable(size: int) -> HttpResponse:
+    response = HttpResponse(status=416)
+    response["Content-Range"] = f"bytes */{size}"
+    return response
+
+
+def content_response(
+    request: HttpRequest, content: bytes, content_type: str, etag: str
+) -> HttpResponse:
+    """Response for content already in memory, honouring Range"""
+    try:
+        byte_range = parse_range(request, len(content), etag)
+    except RangeNotSatisfiable:
+        return range_not_satisfiable(len(content))
+
+    if byte_range is None:
+        response = HttpResponse(content, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = HttpResponse(content[start : end + 1], content_type=content_type, status=206)
+        response["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def file_response(
+    request: HttpRequest, file: IO[bytes], size: int, content_type: str, etag: str
+) -> HttpResponse:
+    """Response streaming an open file in chunks, honouring Range. Closes the file."""
+    try:
+        byte_range = parse_range(request, size, etag)
+    except RangeNotSatisfiable:
+        file.close()
+        return range_not_satisfiable(size)
+
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+        response["Content-Length"] = str(size)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _read_range(file, start, end - start + 1), content_type=content_type, status=206
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def _read_range(file: IO[bytes], start: int, length: int) -> Iterator[bytes]:
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def afile_response(
+    request: HttpRequest, file: IO[bytes], size: int, content_type: str, etag: str
+) -> HttpResponse:
+    """
+    file_response for async views: the file is streamed by an async iterator doing each
+    read in a thread, so ASGI servers never block on storage. Closes the file.
+    """
+    try:
+        byte_range = parse_range(request, size, etag)
+    except RangeNotSatisfiable:
+        file.close()
+        return range_not_satisfiable(size)
+
+    start, end = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(
+        _aread_range(file, start, end - start + 1),
+        content_type=content_type,
+        status=200 if byte_range is None else 206,
+    )
+    if byte_range is not None:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+async def _aread_range(file: IO[bytes], start: int, length: int) -> AsyncIterator[bytes]:
+    try:
+        await asyncio.to_thread(file.seek, start)
+        while length > 0:
+            chunk = await asyncio.to_thread(file.read, min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+def offload_enabled() -> bool:
+    return bool(getattr(settings, "IMAGE_SERVE_OFFLOAD", None))
+
+
+def offload_response(path: str, content_type: str) -> HttpResponse:
+    """
+    Empty response telling the front proxy to send the stored file at `path` itself:
+    nginx's X-Accel-Redirect to IMAGE_SERVE_OFFLOAD_PREFIX + path (an internal
+    location aliasing the storage root), or X-Sendfile with the absolute path for
+    Apache/lighttpd. The proxy then handles Range requests too.
+    """
+    mode = getattr(settings, "IMAGE_SERVE_OFFLOAD", None)
+    response = HttpResponse(content_type=content_type)
+    if mode == OFFLOAD_X_ACCEL_REDIRECT:
+        prefix = getattr(settings, "IMAGE_SERVE_OFFLOAD_PREFIX", "/protected/").rstrip("/")
+        response["X-Accel-Redirect"] = f"{prefix}/{quote(path)}"
+    elif mode == OFFLOAD_X_SENDFILE:
+        response["X-Sendfile"] = default_storage.path(path)
+    else:
+        raise ImproperlyConfigured(f"Unknown IMAGE_SERVE_OFFLOAD mode: {mode}")
+    return response
@@ -0,0 +1,114 @@
+"""
+PIL work run by the image executor. These functions take and return plain bytes and
+must not import Django, so they also run in freshly spawned worker processes.
+"""
+
+import io
+from typing import Iterable
+
+from PIL import Image as PILImage
+
+DEFAULT_QUALITY = 85
+# decode and box-reduce down to this many times the target size, then resample
+REDUCING_GAP = 2.0
+# from this quality up the final resize always uses LANCZOS
+HIGH_QUALITY = 90
+
+
+def encode(image: PILImage.Image, format: str, quality: int = DEFAULT_QUALITY) -> bytes:
+    output = io.BytesIO()
+
+    if format == "jpeg" and image.mode in ("RGBA", "P"):
+        background = PILImage.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1] if image.mode == "RGBA" else None)
+        image = background
+
+    save_kwargs = {"format": format, "optimize": True}
+    if format == "jpeg":
+        save_kwargs["quality"] = quality
+        save_kwargs["progressive"] = True
+    elif format == "png":
+        save_kwargs["compress_level"] = 6
+    elif format == "webp":
+        save_kwargs["quality"] = quality
+        save_kwargs["method"] = 6
+    elif format == "avif":
+        save_kwargs["quality"] = quality
+
+    image.save(output, **save_kwargs)
+    return output.getvalue()
+
+
+def resize(image: PILImage.Image, width: int, height: int) -> PILImage.Image:
+    image.thumbnail((width, height), PILImage.Resampling.LANCZOS)
+    return image
+
+
+def fit(size: tuple[int, int], width: int, height: int) -> tuple[int, int]:
+    """Largest size within width x height keeping the aspect ratio, never upscaling"""
+    ratio = min(width / size[0], height / size[1], 1)
+    return max(round(size[0] * ratio), 1), max(round(size[1] * ratio), 1)
+
+
+def choose_resample(scale: float, quality: int) -> PILImage.Resampling:
+    """
+    Cheapest filter that still meets the requested quality for the remaining
+    downscale ratio. Close to 1:1 the filters are indistinguishable, so bilinear is
+    enough; past that bicubic avoids visible aliasing, and lanczos is kept for
+    high quality requests.
+    """
+    if quality >= HIGH_QUALITY:
+        return PILImage.Resampling.LANCZOS
+    if scale <= 1.25:
+        return PILImage.Resampling.BILINEAR
+    return PILImage.Resampling.BICUBIC
+
+
+def downscale(
+    image: PILImage.Image, width: int, height: int, quality: int = DEFAULT_QUALITY
+) -> PILImage.Image:
+    """
+    Shrink a freshly opened (not yet loaded) image to fit width x height. JPEGs are
+    decoded at 1/2, 1/4 or 1/8 scale right away (draft mode) and other formats are
+    box-reduced by an integer factor, both down to REDUCING_GAP times the target, so
+    only the last step needs a real resampling filter.
+    """
+    target = fit(image.size, width, height)
+    if target == image.size:
+        return image
+
+    gap = (round(target[0] * REDUCING_GAP), round(target[1] * REDUCING_GAP))
+    if image.format == "JPEG":
+        image.draft(None, gap)
+
+    factor = min(image.width // gap[0], image.height // gap[1])
+    if factor > 1 and image.mode not in ("1", "P"):
+        image = image.reduce(factor)
+
+    scale = image.width / target[0]
+    return image.resize(target, choose_resample(scale, quality))
+
+
+def process_upload(path: str, allowed_formats: Iterable[str], output_path: str) -> dict:
+    """
+    Validate the uploaded image at `path` and write it re-encoded to `output_path`.
+    Files go in and out by path so the upload is never held in memory as a whole.
+    """
+    try:
+        with PILImage.open(path) as image:
+            format = image.format.lower() if image.format else "unknown"
+            if format not in allowed_formats:
+                raise ValueError(f"Unsupported image format: {format}")
+            with open(output_path, "wb") as output:
+                output.write(encode(image, format))
+            return {"format": format, "width": image.width, "height": image.height}
+    except Exception:
+        raise ValueError("Invalid image file.")
+
+
+def transform(content: bytes, width: int, height: int, format: str, quality: int) -> bytes:
+    # not loaded up front so downscale can decode at a reduced size
+    image = PILImage.open(io.BytesIO(content))
+    if width or height:
+        image = downscale(image, width or image.width, height or image.height, quality)
+    return encode(image, format, quality)
@@ -1,6 +1,8 @@
 from ninja import Query
 from apps.products.services import ProductService
+from core.pagination import CountMode
 from core.router import CustomRouter
+from core.utils import json_response
 
 from .schemas import ProductDetailSchema, ProductFilters, ProductListSchema
 
@@ -12,13 +14,10 @@ def get_products(request, filters: Query[ProductFilters]):
     """
     Get a list of products.
     """
-    result = ProductService.get_products(request, filters)
-    return result
+    result = ProductService.get_products(request, filters, count_mode=CountMode.CACHED)
+    return json_response(result)
 
 
-@products_router.get("{slug}", response={200: ProductDetailSchema})
+@products_router.get("/{slug}", response={200: ProductDetailSchema})
 def get_product_details(request, slug: str):
-    return 200, {
-        "message": "Product successfully retrieved",
-        "data": ProductService.get_product_by_slug(slug),
-    }
+    return json_response(ProductService.get_product_details(slug))
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ProductsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "apps.products"
+
+    def ready(self):
+        from . import services  # noqa: F401  connects the cache receivers
+        from .search import setup_search_index
+
+        post_migrate.connect(setup_search_index, sender=self)
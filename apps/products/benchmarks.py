@@ -0,0 +1,48 @@
+"""Product fixtures for the product bench_* management commands"""
+
+import random
+from decimal import Decimal
+
+from apps.shops.models import Shop
+from apps.users.models import CustomUser
+
+from .models import Product, ProductCategory
+
+WORDS = (
+    "shirt cotton linen denim jacket boot leather wool scarf lamp oak walnut chair table "
+    "garden rake spade kettle ceramic glass vase candle soap brush travel bag"
+).split()
+
+
+def create_products(count: int, batch_size: int = 5000, shops: int = 20, categories: int = 20):
+    """
+    Bulk insert `count` active products spread over a few shops and categories, with
+    names and descriptions drawn from WORDS. Signals do not run, so search documents
+    are not created.
+    """
+    rng = random.Random(0)
+    owner = CustomUser.objects.create(email="bench@example.com", username="bench")
+    shop_list = [Shop.objects.create(owner=owner, name=f"Bench Shop {i}") for i in range(shops)]
+    category_list = [
+        ProductCategory.objects.create(name=f"Bench Category {i}") for i in range(categories)
+    ]
+
+    batch = []
+    for index in range(count):
+        words = rng.sample(WORDS, 6)
+        batch.append(
+            Product(
+                name=" ".join(words[:3]).title(),
+                description=" ".join(words),
+                shop=rng.choice(shop_list),
+                category=rng.choice(category_list),
+                price=Decimal(rng.randint(100, 100000)) / 100,
+                stock=rng.randint(0, 20),
+                slug=f"bench-{index}",
+            )
+        )
+        if len(batch) >= batch_size:
+            Product.objects.bulk_create(batch)
+            batch = []
+    Product.objects.bulk_create(batch)
+    return shop_list, category_list
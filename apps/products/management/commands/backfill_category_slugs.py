@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from apps.products.models import ProductCategory
+
+
+class Command(BaseCommand):
+    help = "Generate the slug of every product category created before slugs existed"
+
+    def handle(self, *args, **options):
+        count = ProductCategory.backfill_slugs()
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {count} category slugs."))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from apps.products.benchmarks import create_products
+from apps.products.models import Product
+from core.benchmarks import format_row, measure, scratch_data
+from core.pagination import CountMode, Paginator
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare offset and cursor pagination on a generated product table, from the "
+        "first page to a deep one. Fixtures are rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=50000)
+        parser.add_argument("--page-size", type=int, default=10)
+        parser.add_argument("--page", type=int, default=5000, help="The deep page to measure")
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        page_size, deep_page = options["page_size"], options["page"]
+        if options["products"] < deep_page * page_size:
+            options["products"] = deep_page * page_size
+        request = RequestFactory().get("/api/products")
+
+        with scratch_data():
+            self.stdout.write(f"Creating {options['products']} products...")
+            create_products(options["products"])
+            queryset = Product.objects.filter(is_active=True)
+
+            def paginator():
+                return Paginator(request, queryset, page_size, count_mode=CountMode.NONE)
+
+            # the cursor a client holds after paging through to the deep page
+            before_deep = paginator().queryset[(deep_page - 1) * page_size - 1]
+            deep_cursor = paginator()._encode_cursor(before_deep)
+            first_cursor = paginator().get_page(1)["next_cursor"]
+
+            cases = [
+                ("offset page 1", lambda: paginator().get_page(1)),
+                (f"offset page {deep_page}", lambda: paginator().get_page(deep_page)),
+                ("cursor page 2", lambda: paginator().get_page(cursor=first_cursor)),
+                (f"cursor page {deep_page}", lambda: paginator().get_page(cursor=deep_cursor)),
+            ]
+            self.stdout.write(f"{'case':<36}{'median':>12}{'p95':>12}")
+            for label, fn in cases:
+                self.stdout.write(format_row(label, measure(fn, repeat=options["repeat"])))
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from apps.products.benchmarks import create_products
+from apps.products.search import product_search
+from apps.products.services import ProductService
+from core.benchmarks import format_row, measure, scratch_data
+from core.pagination import CountMode, Paginator
+
+
+class Command(BaseCommand):
+    help = (
+        "Time product search pages on a generated catalogue: a common and a rare term, "
+        "search combined with a category, and the count. Fixtures are rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=100000, help="e.g. 1000000")
+        parser.add_argument("--page-size", type=int, default=20)
+        parser.add_argument("--repeat", type=int, default=10)
+
+    def handle(self, *args, **options):
+        if product_search.backend is None:
+            self.stdout.write("No full-text engine on this database, search uses icontains.")
+        request = RequestFactory().get("/api/products")
+
+        with scratch_data():
+            self.stdout.write(f"Creating {options['products']} products...")
+            _, categories = create_products(options["products"])
+            product_search.rebuild()
+
+            def page(filters, count_mode=CountMode.NONE, cursor=False):
+                queryset = ProductService._apply_filters(
+                    ProductService._listing_queryset(), filters
+                )
+                paginator = Paginator(
+                    request,
+                    queryset,
+                    options["page_size"],
+                    ordering=ProductService._ordering(filters),
+                    count_mode=count_mode,
+                )
+                result = paginator.get_page(1)
+                if cursor:
+                    result = paginator.get_page(cursor=result["next_cursor"])
+                return result
+
+            category = categories[0].slug
+            cases = [
+                ("common term", {"search": "garden"}),
+                ("two terms", {"search": "oak cha"}),
+                ("common term + category", {"search": "garden", "category": category}),
+                (
+                    "common term + category + price",
+                    {"search": "garden", "category": category, "max_price": 50},
+                ),
+                ("no match", {"search": "zeppelin"}),
+            ]
+            self.stdout.write(f"{'case':<36}{'median':>12}{'p95':>12}{'matches':>10}")
+            for label, filters in cases:
+                matches = page(filters, CountMode.EXACT)["count"]
+                result = measure(lambda: page(filters), repeat=options["repeat"])
+                self.stdout.write(f"{format_row(label, result)}{matches:>10}")
+
+            filters = {"search": "garden", "category": category}
+            for label, fn in (
+                ("common term + category, count", lambda: page(filters, CountMode.EXACT)),
+                ("common term + category, 2nd page", lambda: page(filters, cursor=True)),
+            ):
+                self.stdout.write(format_row(label, measure(fn, repeat=options["repeat"])))
@@ -0,0 +1,67 @@
+import json
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from ninja.responses import NinjaJSONEncoder
+
+from apps.products.benchmarks import create_products
+from apps.products.schemas import ProductDetailSchema, ProductListSchema
+from apps.products.services import ProductService
+from core.benchmarks import format_row, measure, scratch_data
+from core.cache import Cache, _value_size
+from core.pagination import CountMode, Paginator
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare cache hits that unpickle model instances and serialize them against hits "
+        "on the rendered JSON payload, for a product listing page and a product detail."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, default=20)
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        # a pickling backend like the shared ones, so hits pay for deserialization
+        cache = Cache(prefix="bench", timeout=600, local=False, backend=LocMemCache("bench", {}))
+        request = RequestFactory().get("/api/products")
+
+        with scratch_data():
+            create_products(options["page_size"] * 5)
+            queryset = ProductService._listing_queryset()
+            page = Paginator(
+                request, queryset, options["page_size"], count_mode=CountMode.EXACT
+            ).get_page(1)
+            listing = {"message": "Product retrieved successfully", **page}
+            product = ProductService._detail_queryset().get(pk=page["data"][0].pk)
+            detail = {"message": "Product successfully retrieved", "data": product}
+
+            self.stdout.write(f"{'case':<36}{'median':>12}{'p95':>12}{'entry':>12}")
+            for name, payload, schema in (
+                ("listing", listing, ProductListSchema),
+                ("detail", detail, ProductDetailSchema),
+            ):
+                self._compare(cache, name, payload, schema, options["repeat"])
+
+    def _compare(self, cache, name, payload, schema, repeat):
+        def render(value):
+            data = schema.model_validate(value).model_dump()
+            return json.dumps(data, cls=NinjaJSONEncoder).encode()
+
+        cache.set(f"{name}_models", payload)
+        models_hit = measure(lambda: render(cache.get(f"{name}_models")), repeat=repeat)
+        models_size = _value_size(payload)
+
+        cache.get_or_render(f"{name}_rendered", schema, lambda: payload)
+        rendered_hit = measure(
+            lambda: cache.get_or_render(f"{name}_rendered", schema, lambda: payload),
+            repeat=repeat,
+        )
+        rendered_size = len(render(payload))
+
+        self.stdout.write(f"{format_row(f'{name}: model instances', models_hit)}{models_size:>11}B")
+        self.stdout.write(
+            f"{format_row(f'{name}: rendered payload', rendered_hit)}{rendered_size:>11}B"
+        )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.products.search import product_search
+
+
+class Command(BaseCommand):
+    help = "Recreate the product search documents and full-text index from the products table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        product_search.setup()
+        with transaction.atomic():
+            count = product_search.rebuild(batch_size=options["batch_size"])
+        engine = "full-text" if product_search.backend else "icontains fallback"
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} products ({engine})."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from apps.products.models import Product, ProductImages
+
+
+class Command(BaseCommand):
+    help = "Copy every product's primary image from ProductImages to Product.primary_image"
+
+    def handle(self, *args, **options):
+        count = ProductImages.sync_primary(Product.objects.all())
+        self.stdout.write(self.style.SUCCESS(f"Synced {count} products."))
@@ -1,16 +1,41 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import OuterRef, Q, Subquery
 from django.utils.text import slugify
 from core.models import BaseModel, TimestampedModel
 
 
 class ProductCategory(BaseModel):
     name = models.CharField(max_length=255, unique=True)
+    # nullable so the column can be added to existing rows, backfill_category_slugs
+    # fills in the slugs of categories created before it
+    slug = models.SlugField(max_length=255, unique=True, null=True, blank=True)
     description = models.TextField(blank=True)
 
     class Meta(BaseModel.Meta):
         verbose_name = "Product Category"
         verbose_name_plural = "Product Categories"
 
+    def save(self, *args, **kwargs):
+        if not self.slug:
+            base_slug = slugify(self.name)
+            slug = base_slug
+            counter = 1
+            while ProductCategory.objects.filter(slug=slug).exists():
+                slug = f"{base_slug}-{counter}"
+                counter += 1
+            self.slug = slug
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def backfill_slugs(cls) -> int:
+        """Generate the slug of every category without one"""
+        categories = cls.objects.filter(Q(slug__isnull=True) | Q(slug=""))
+        count = 0
+        for category in categories.order_by("name"):
+            category.save(update_fields=["slug"])
+            count += 1
+        return count
+
 
 class Product(TimestampedModel):
     name = models.CharField(max_length=255)
@@ -24,6 +49,10 @@ class Product(TimestampedModel):
     stock = models.PositiveIntegerField(null=True, blank=True)
     is_active = models.BooleanField(default=True)
     slug = models.SlugField(max_length=255, unique=True, null=True, blank=True)
+    # copy of the primary ProductImages row's image, kept in sync by ProductImages
+    primary_image = models.ForeignKey(
+        "images.Image", on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
 
     def __str__(self):
         return f"{self.name} - {self.shop.name}"
@@ -39,24 +68,34 @@ class Product(TimestampedModel):
         verbose_name = "Product"
         verbose_name_plural = "Products"
         ordering = ["-created_at"]
+        # Listings only show active products and page on (-created_at, -id) or (price,
+        # id), so these are partial indexes over active rows with the sort columns
+        # behind the filter column: pages come straight off the index, no sort step.
         indexes = [
             models.Index(fields=["slug"]),
             models.Index(fields=["category"]),
-            models.Index(fields=["shop", "is_active"]),
-            models.Index(fields=["price"]),
+            models.Index(
+                fields=["-created_at", "-id"],
+                condition=Q(is_active=True),
+                name="product_active_created_idx",
+            ),
+            models.Index(
+                fields=["price", "id"],
+                condition=Q(is_active=True),
+                name="product_active_price_idx",
+            ),
+            models.Index(
+                fields=["category", "-created_at", "-id"],
+                condition=Q(is_active=True),
+                name="product_category_created_idx",
+            ),
+            models.Index(
+                fields=["shop", "-created_at", "-id"],
+                condition=Q(is_active=True),
+                name="product_shop_created_idx",
+            ),
         ]
 
-    @property
-    def primary_image(self):
-        if hasattr(self, "prefetched_primary_image"):
-            prefetch = self.prefetched_primary_image
-            img = prefetch[0].image
-        else:
-            primary_image = self.images.filter(primary=True).first()
-            img = primary_image.image if primary_image else None
-
-        return img if img else None
-
     @property
     def gallery_images(self):
         if hasattr(self, "prefetched_gallery_images"):
@@ -76,3 +115,72 @@ class ProductImages(TimestampedModel):
     class Meta(TimestampedModel.Meta):
         verbose_name = "Product Image"
         verbose_name_plural = "Product Images"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["product"],
+                condition=Q(primary=True),
+                name="product_single_primary_image",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Saving a primary image demotes the product's previous one. Moving the image to
+        another product updates both products.
+        """
+        with transaction.atomic():
+            product_ids = {self.product_id}
+            if not self._state.adding:
+                previous = ProductImages.objects.filter(pk=self.pk).values("product_id")
+                product_ids.update(row["product_id"] for row in previous)
+            if self.primary:
+                others = ProductImages.objects.filter(product_id=self.product_id, primary=True)
+                others.exclude(pk=self.pk).update(primary=False)
+            super().save(*args, **kwargs)
+            self.sync_primary(Product.objects.filter(pk__in=product_ids))
+            self.clear_product_cache(product_ids)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            self.sync_primary(Product.objects.filter(pk=self.product_id))
+            self.clear_product_cache({self.product_id})
+        return result
+
+    @classmethod
+    def sync_primary(cls, products) -> int:
+        """
+        Copy each product's primary image to Product.primary_image. save() and delete()
+        call it, bulk writes to this table have to call it themselves.
+        """
+        primary = cls.objects.filter(product=OuterRef("pk"), primary=True).values("image")[:1]
+        return products.update(primary_image=Subquery(primary))
+
+    @staticmethod
+    def clear_product_cache(product_ids):
+        """Listings and details show the images, drop the products' entries on commit"""
+        from .services import ProductService  # services imports the models
+
+        slugs = list(Product.objects.filter(pk__in=product_ids).values_list("slug", flat=True))
+
+        def clear():
+            for slug in slugs:
+                ProductService._clear_cache(slug=slug)
+
+        transaction.on_commit(clear)
+
+
+class ProductSearchDocument(models.Model):
+    """
+    The searchable text of a product, maintained by apps.products.search. The integer
+    id is the row the full-text engine indexes the document under.
+    """
+
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, related_name="search_document"
+    )
+    name = models.CharField(max_length=255)
+    body = models.TextField(blank=True)
+
+    class Meta:
+        db_table = "product_search_documents"
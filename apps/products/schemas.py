@@ -1,4 +1,5 @@
 from typing import List, Literal, Optional
+from uuid import UUID
 
 from ninja import ModelSchema, Schema
 
@@ -17,6 +18,7 @@ class ProductFilters(PaginatedQueryParams):
     in_stock: Optional[bool] = None
     on_sale: Optional[bool] = None
     sort: Optional[Literal["price_asc", "price_desc"]] = None
+    facets: bool = False
 
 
 class ProductImageSchema(Schema):
@@ -50,8 +52,30 @@ class ProductSchema(ModelSchema):
         return obj.primary_image
 
 
+class FacetValueSchema(Schema):
+    id: Optional[UUID] = None
+    name: Optional[str] = None
+    slug: Optional[str] = None
+    count: int
+
+
+class PriceRangeFacetSchema(Schema):
+    min: Optional[float] = None
+    max: Optional[float] = None
+    count: int
+
+
+class ProductFacetsSchema(Schema):
+    categories: List[FacetValueSchema]
+    shops: List[FacetValueSchema]
+    price_ranges: List[PriceRangeFacetSchema]
+    in_stock: int
+    on_sale: int
+
+
 class ProductListSchema(PaginatedResponseSchema[ProductSchema]):
     message: str = "Product retrieved successfully"
+    facets: Optional[ProductFacetsSchema] = None
 
 
 class ShortShopInfo(Schema):
@@ -0,0 +1,250 @@
+"""
+Full-text product search.
+
+Every product has a ProductSearchDocument (name and description) kept in sync by the
+signals below. The engine indexing the documents depends on the database: an FTS5
+table reading them as external content on SQLite, a GIN index over their weighted
+tsvector on PostgreSQL. Both are created after migrate. On other databases, or a SQLite
+build without FTS5, search falls back to icontains.
+
+Bulk writes (queryset.update(), bulk_create) skip the signals, run the
+rebuild_search_index command after them.
+"""
+
+import logging
+import re
+from typing import Optional
+
+from django.db import DatabaseError, connection
+from django.db.models import FloatField, Q, QuerySet
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Product, ProductSearchDocument
+
+logger = logging.getLogger(__name__)
+
+MAX_TERMS = 8
+RANK_FIELD = "search_rank"
+# best match first, the id keeps the order stable for cursors
+RANK_ORDERING = (RANK_FIELD, "-id")
+
+DOCUMENTS_TABLE = ProductSearchDocument._meta.db_table
+PRODUCTS_TABLE = Product._meta.db_table
+FTS_TABLE = "product_search"
+# name matches weigh ten times as much as description matches
+FTS_WEIGHTS = (10.0, 1.0)
+# {table} qualifies the columns in queries joining the products
+PG_VECTOR = (
+    "setweight(to_tsvector('simple', {table}name), 'A') || "
+    "setweight(to_tsvector('simple', {table}body), 'B')"
+)
+PG_JOINED_VECTOR = PG_VECTOR.format(table=f"{DOCUMENTS_TABLE}.")
+
+
+def search_terms(term: str) -> list[str]:
+    return re.findall(r"\w+", term.lower())[:MAX_TERMS]
+
+
+class SQLiteBackend:
+    """FTS5 over the documents table (external content), ranked by bm25"""
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                f"name, body, content='{DOCUMENTS_TABLE}', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+
+    def add(self, document: ProductSearchDocument):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}(rowid, name, body) VALUES (%s, %s, %s)",
+                [document.id, document.name, document.body],
+            )
+
+    def remove(self, document: ProductSearchDocument):
+        # external content tables are told what was indexed, so pass the old values
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, body) "
+                f"VALUES ('delete', %s, %s, %s)",
+                [document.id, document.name, document.body],
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+    def join(self, terms: list[str]) -> tuple[list[str], list[str], list]:
+        """Tables, conditions and params joining the products matching every term"""
+        return (
+            [FTS_TABLE, DOCUMENTS_TABLE],
+            [
+                f"{FTS_TABLE} MATCH %s",
+                # unary + hides the rowid from FTS5, so the match runs once as the outer
+                # loop instead of once per product the other filters select
+                f"{DOCUMENTS_TABLE}.id = +{FTS_TABLE}.rowid",
+                f"{DOCUMENTS_TABLE}.product_id = {PRODUCTS_TABLE}.id",
+            ],
+            [self._query(terms)],
+        )
+
+    def rank(self, terms: list[str]) -> tuple[str, list]:
+        """SQL for the rank of a joined product, lower is better"""
+        return f"bm25({FTS_TABLE}, %s, %s)", list(FTS_WEIGHTS)
+
+    @staticmethod
+    def _query(terms: list[str]) -> str:
+        # every term must match as a word prefix
+        return " ".join(f'"{term}"*' for term in terms)
+
+
+class PostgresBackend:
+    """GIN expression index over the weighted tsvector, ranked by ts_rank"""
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {FTS_TABLE}_document_gin "
+                f"ON {DOCUMENTS_TABLE} USING gin (({PG_VECTOR.format(table='')}))"
+            )
+
+    def add(self, document: ProductSearchDocument):
+        pass
+
+    def remove(self, document: ProductSearchDocument):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def join(self, terms: list[str]) -> tuple[list[str], list[str], list]:
+        return (
+            [DOCUMENTS_TABLE],
+            [
+                f"({PG_JOINED_VECTOR}) @@ to_tsquery('simple', %s)",
+                f"{DOCUMENTS_TABLE}.product_id = {PRODUCTS_TABLE}.id",
+            ],
+            [self._query(terms)],
+        )
+
+    def rank(self, terms: list[str]) -> tuple[str, list]:
+        # negated, so that lower is better as with bm25
+        return f"-ts_rank(({PG_JOINED_VECTOR}), to_tsquery('simple', %s))", [self._query(terms)]
+
+    @staticmethod
+    def _query(terms: list[str]) -> str:
+        return " & ".join(f"{term}:*" for term in terms)
+
+
+class ProductSearchIndex:
+    backends = {"sqlite": SQLiteBackend, "postgresql": PostgresBackend}
+
+    def __init__(self):
+        self._backend = None
+        self._checked = False
+
+    @property
+    def backend(self) -> Optional[SQLiteBackend | PostgresBackend]:
+        """The engine for the default database, None when search falls back to icontains"""
+        if not self._checked:
+            backend_class = self.backends.get(connection.vendor)
+            self._backend = backend_class() if backend_class else None
+            self._checked = True
+        return self._backend
+
+    def setup(self):
+        if self.backend is None:
+            return
+        try:
+            self.backend.setup()
+        except DatabaseError:
+            logger.warning("Full-text search is not available, using icontains", exc_info=True)
+            self._backend = None
+
+    def index(self, product: Product):
+        """Create or refresh the product's document"""
+        document = ProductSearchDocument.objects.filter(product_id=product.pk).first()
+        name, body = product.name, product.description or ""
+        if document is not None:
+            if document.name == name and document.body == body:
+                return
+            if self.backend:
+                self.backend.remove(document)
+            document.name, document.body = name, body
+            document.save(update_fields=["name", "body"])
+        else:
+            document = ProductSearchDocument.objects.create(product=product, name=name, body=body)
+        if self.backend:
+            self.backend.add(document)
+
+    def remove(self, document: ProductSearchDocument):
+        if self.backend:
+            self.backend.remove(document)
+
+    def rebuild(self, batch_size: int = 1000) -> int:
+        """Recreate every document from the products table"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {DOCUMENTS_TABLE}")
+        count = 0
+        products = Product.objects.only("id", "name", "description").iterator(batch_size)
+        batch = []
+        for product in products:
+            batch.append(
+                ProductSearchDocument(
+                    product_id=product.pk, name=product.name, body=product.description or ""
+                )
+            )
+            if len(batch) >= batch_size:
+                count += len(ProductSearchDocument.objects.bulk_create(batch))
+                batch = []
+        count += len(ProductSearchDocument.objects.bulk_create(batch))
+        if self.backend:
+            self.backend.rebuild()
+        return count
+
+    def filter(self, queryset: QuerySet, term: str) -> QuerySet:
+        """
+        The products of the queryset matching the search term, annotated with their
+        RANK_FIELD (lower is better) when there is a full-text engine. The engine is
+        joined into the queryset, so its other filters and the pagination apply to every
+        matching product.
+        """
+        terms = search_terms(term)
+        if not terms:
+            return queryset
+        if self.backend is None:
+            return queryset.filter(Q(name__icontains=term) | Q(description__icontains=term))
+
+        tables, where, params = self.backend.join(terms)
+        rank = RawSQL(*self.backend.rank(terms), output_field=FloatField())
+        return queryset.extra(tables=tables, where=where, params=params).annotate(
+            **{RANK_FIELD: rank}
+        )
+
+    def ordering(self, term: str) -> Optional[tuple[str, ...]]:
+        """Paginator ordering for results of filter(), None to keep the default"""
+        return RANK_ORDERING if self.backend and search_terms(term) else None
+
+
+product_search = ProductSearchIndex()
+
+
+def setup_search_index(sender, using: str = None, **kwargs):
+    """post_migrate hook creating the engine's table or index"""
+    if using in (None, connection.alias):
+        product_search.setup()
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance: Product, raw: bool = False, **kwargs):
+    if not raw:
+        product_search.index(instance)
+
+
+@receiver(post_delete, sender=ProductSearchDocument)
+def unindex_product(sender, instance: ProductSearchDocument, **kwargs):
+    product_search.remove(instance)
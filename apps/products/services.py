@@ -1,123 +1,280 @@
-from django.db.models import Prefetch, Q
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Prefetch, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
+from apps.shops.models import Shop
 from core.cache import Cache
 from core.exceptions import NotFound
-from core.pagination import Paginator
+from core.pagination import DEFAULT_ORDERING, CountMode, Paginator
 from core.utils import get_seconds
 
-from .models import Product, ProductImages
+from .models import Product, ProductCategory, ProductImages
+from .schemas import ProductDetailSchema, ProductListSchema
+from .search import product_search
+
+IN_STOCK = Q(stock__gt=0)
+ON_SALE = Q(discount_price__isnull=False, discount_price__lt=F("price"))
+# upper bounds of the price facet ranges, the last range is open ended
+PRICE_BUCKETS = [10, 25, 50, 100, 250, 500]
+# query parameters that do not change which products match
+PAGING_PARAMS = {"page", "page_size", "cursor", "facets"}
+# the id makes the order unique, which cursor pagination needs
+SORT_ORDERINGS = {
+    "price_asc": ("price", "id"),
+    "price_desc": ("-price", "-id"),
+}
+# the columns ProductSchema and ProductDetail render
+LISTING_FIELDS = (
+    "id",
+    "name",
+    "description",
+    "price",
+    "discount_price",
+    "stock",
+    "is_active",
+    "slug",
+    "created_at",
+    "updated_at",
+)
+DETAIL_FIELDS = (
+    "id",
+    "name",
+    "description",
+    "price",
+    "discount_price",
+    "stock",
+    "slug",
+    "shop__name",
+    "shop__slug",
+)
 
 
 class ProductService:
     cache = Cache(prefix="products", timeout=get_seconds(minutes=15))
 
     @classmethod
-    def _clear_cache(cls, product_id=None, shop_id=None):
+    def _clear_cache(cls, slug=None):
         patterns = [
             "product_list*",
+            "product_facets*",
         ]
         for pattern in patterns:
             cls.cache.delete_pattern(pattern)
 
-        if product_id:
-            key = cls.cache.generate_key({"slug": product_id})
-            cls.cache.delete(key)
-        if shop_id:
-            key = cls.cache.generate_key({"shop_id": shop_id})
-            cls.cache.delete(key)
+        # detail entries are keyed by slug, see get_product_details
+        if slug:
+            cls.cache.invalidate(f"detail_{slug}")
 
     @staticmethod
-    def _base_queryset(active: bool = True):
+    def _listing_queryset(active: bool = True):
+        """Products for ProductSchema: own columns and the primary image, one query"""
         return (
-            Product.objects.select_related("shop", "category")
+            Product.objects.select_related("primary_image")
+            .only(*LISTING_FIELDS, "primary_image")
+            .filter(is_active=active)
+        )
+
+    @staticmethod
+    def _detail_queryset(active: bool = True):
+        """Products for ProductDetail: the shop name and slug, primary and gallery images"""
+        gallery = ProductImages.objects.select_related("image").filter(primary=False)
+        return (
+            Product.objects.select_related("shop", "primary_image")
+            .only(*DETAIL_FIELDS, "primary_image")
             .prefetch_related(
-                Prefetch(
-                    "images",
-                    queryset=ProductImages.objects.select_related("image").filter(primary=True),
-                    to_attr="prefetched_primary_image",
-                ),
-                Prefetch(
-                    "images",
-                    queryset=ProductImages.objects.select_related("image").filter(primary=False),
-                    to_attr="prefetched_gallery_image",
-                ),
+                Prefetch("images", queryset=gallery, to_attr="prefetched_gallery_images")
             )
             .filter(is_active=active)
         )
 
     @classmethod
-    def get_products(cls, request, filters):
+    def get_products(cls, request, filters, count_mode: CountMode = None):
         page = getattr(filters, "page", 1) if filters else 1
         page_size = getattr(filters, "page_size", 10) if filters else 10
+        cursor = getattr(filters, "cursor", None) if filters else None
         filters = filters.dict() if filters else {}
         cache_key_data = {
             "page": page,
             "page_size": page_size,
+            "count_mode": count_mode,
             **filters,
         }
         cache_key = cls.cache.generate_key(cache_key_data, suffix="product_list")
 
-        cache_result = cls.cache.get(cache_key)
-        if cache_result:
-            return cache_result
-
-        qs = cls._base_queryset()
-        if filters:
-            qs = cls._apply_filters(qs, filters)
+        def get_page():
+            qs = cls._listing_queryset()
+            if filters:
+                qs = cls._apply_filters(qs, filters)
 
-        qs = qs.order_by("-created_at")
+            paginator = Paginator(
+                request, qs, page_size, ordering=cls._ordering(filters), count_mode=count_mode
+            )
+            result = paginator.get_page(page, cursor=cursor)
+            if filters.get("facets"):
+                result["facets"] = cls.get_facets(qs, filters)
+            return result
 
-        paginator = Paginator(request, qs, page_size)
-        result = paginator.get_page(page)
-        cls.cache.set(cache_key, result)
-        return result
+        return cls.cache.get_or_render(cache_key, ProductListSchema, get_page)
 
     @classmethod
-    def get_product_by_slug(cls, slug):
-        cache_key = cls.cache.generate_key({"slug": slug})
-        cached_product = cls.cache.get(cache_key)
+    def get_facets(cls, queryset, filters: dict) -> dict:
+        """
+        Category, shop, price range, in stock and on sale counts for the filtered
+        products. One grouped query per category/shop pair with the other counts as
+        conditional aggregates, cached per filter fingerprint so every page of a
+        listing shares it.
+        """
+        fingerprint = {key: value for key, value in filters.items() if key not in PAGING_PARAMS}
+        cache_key = cls.cache.generate_key(fingerprint, suffix="product_facets")
+
+        def compute():
+            buckets = getattr(settings, "PRODUCT_PRICE_BUCKETS", PRICE_BUCKETS)
+            ranges = list(zip([None, *buckets], [*buckets, None]))
+            aggregates = {
+                f"price_{index}": Count("id", filter=cls._price_range(low, high))
+                for index, (low, high) in enumerate(ranges)
+            }
+            rows = (
+                queryset.prefetch_related(None)
+                .order_by()
+                .values(
+                    "category_id",
+                    "category__name",
+                    "category__slug",
+                    "shop_id",
+                    "shop__name",
+                    "shop__slug",
+                )
+                .annotate(
+                    total=Count("id"),
+                    in_stock=Count("id", filter=IN_STOCK),
+                    on_sale=Count("id", filter=ON_SALE),
+                    **aggregates,
+                )
+            )
 
-        if cached_product:
-            return cached_product
+            categories, shops = {}, {}
+            price_counts = [0] * len(ranges)
+            in_stock = on_sale = 0
+            for row in rows:
+                for counts, key in ((categories, "category"), (shops, "shop")):
+                    value_id = row[f"{key}_id"]
+                    entry = counts.setdefault(
+                        value_id,
+                        {
+                            "id": value_id,
+                            "name": row[f"{key}__name"],
+                            "slug": row[f"{key}__slug"],
+                            "count": 0,
+                        },
+                    )
+                    entry["count"] += row["total"]
+                for index in range(len(ranges)):
+                    price_counts[index] += row[f"price_{index}"]
+                in_stock += row["in_stock"]
+                on_sale += row["on_sale"]
 
+            return {
+                "categories": sorted(categories.values(), key=lambda entry: -entry["count"]),
+                "shops": sorted(shops.values(), key=lambda entry: -entry["count"]),
+                "price_ranges": [
+                    {"min": low, "max": high, "count": count}
+                    for (low, high), count in zip(ranges, price_counts)
+                ],
+                "in_stock": in_stock,
+                "on_sale": on_sale,
+            }
+
+        return cls.cache.get_or_compute(cache_key, compute)
+
+    @staticmethod
+    def _price_range(low, high) -> Q:
+        condition = Q()
+        if low is not None:
+            condition &= Q(price__gte=low)
+        if high is not None:
+            condition &= Q(price__lt=high)
+        return condition
+
+    @staticmethod
+    def _ordering(filters) -> tuple[str, ...]:
+        """Explicit sort first, then search rank, then newest first"""
+        if filters.get("sort") in SORT_ORDERINGS:
+            return SORT_ORDERINGS[filters["sort"]]
+        if filters.get("search"):
+            return product_search.ordering(filters["search"]) or DEFAULT_ORDERING
+        return DEFAULT_ORDERING
+
+    @classmethod
+    def get_product_by_slug(cls, slug):
         try:
-            qs = cls._base_queryset()
-            product = qs.get(slug=slug)
-            cls.cache.set(cache_key, product)
-            return product
+            qs = cls._detail_queryset()
+            return qs.get(slug=slug)
         except Product.DoesNotExist:
             raise NotFound("Product not found")
 
+    @classmethod
+    def get_product_details(cls, slug):
+        """Rendered ProductDetailSchema payload for the product"""
+        cache_key = cls.cache.generate_key({"slug": slug}, suffix=f"detail_{slug}")
+
+        def get_details():
+            return {
+                "message": "Product successfully retrieved",
+                "data": cls.get_product_by_slug(slug),
+            }
+
+        return cls.cache.get_or_render(cache_key, ProductDetailSchema, get_details)
+
     @staticmethod
     def _apply_filters(queryset, filters):
 
         if not filters:
             return queryset
 
-            # Price range filter
-        if "min_price" in filters and filters["min_price"]:
+        # Price range filter
+        if filters.get("min_price") is not None:
             queryset = queryset.filter(price__gte=filters["min_price"])
 
-        if "max_price" in filters and filters["max_price"]:
+        if filters.get("max_price") is not None:
             queryset = queryset.filter(price__lte=filters["max_price"])
 
-        # Category filter
-        if "category_id" in filters and filters["category_id"]:
-            queryset = queryset.filter(category_id=filters["category_id"])
+        # Category and shop filters, by slug. The slug is resolved to the id first, an
+        # equality on it lets the (category|shop, -created_at) indexes return the rows
+        # already in listing order.
+        if filters.get("category"):
+            categories = ProductCategory.objects.filter(slug=filters["category"])
+            category_id = categories.values_list("id", flat=True).first()
+            queryset = queryset.filter(category_id=category_id) if category_id else queryset.none()
 
-        # Shop filter
-        if "shop_id" in filters and filters["shop_id"]:
-            queryset = queryset.filter(shop_id=filters["shop_id"])
+        if filters.get("shop"):
+            shop_id = Shop.objects.filter(slug=filters["shop"]).values_list("id", flat=True).first()
+            queryset = queryset.filter(shop_id=shop_id) if shop_id else queryset.none()
 
         # Search filter
-        if "search" in filters and filters["search"]:
-            search_term = filters["search"]
-            queryset = queryset.filter(
-                Q(name__icontains=search_term) | Q(description__icontains=search_term)
-            )
+        if filters.get("search"):
+            queryset = product_search.filter(queryset, filters["search"])
 
-        # In stock filter
-        if "in_stock_only" in filters and filters["in_stock_only"]:
-            queryset = queryset.filter(stock__gt=0)
+        # Stock and sale filters, false asks for the opposite
+        if filters.get("in_stock") is not None:
+            queryset = queryset.filter(IN_STOCK if filters["in_stock"] else ~IN_STOCK)
+
+        if filters.get("on_sale") is not None:
+            queryset = queryset.filter(ON_SALE if filters["on_sale"] else ~ON_SALE)
 
         return queryset
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def clear_product_cache(sender, instance: Product, raw: bool = False, **kwargs):
+    """
+    Drops the listings, facets and the product's detail once the write commits, so a
+    read racing the transaction cannot cache the old rows again. Bulk writes skip the
+    signals and leave entries up to the cache timeout (15 minutes) stale.
+    """
+    if not raw:
+        slug = instance.slug
+        transaction.on_commit(lambda: ProductService._clear_cache(slug=slug))
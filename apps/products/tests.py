@@ -1,3 +1,405 @@
+from decimal import Decimal
+from unittest import skipUnless
+
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
 
-# Create your tests here.
+from apps.images.models import Image, ImageFormat, MimeType
+from apps.shops.models import Shop
+from apps.users.models import CustomUser
+
+from .models import Product, ProductCategory, ProductImages, ProductSearchDocument
+from .services import ProductService
+
+
+class ProductFixtures:
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create(email="owner@example.com")
+        cls.shop = Shop.objects.create(owner=cls.owner, name="Corner Shop")
+        cls.other_shop = Shop.objects.create(owner=cls.owner, name="Other Shop")
+        cls.category = ProductCategory.objects.create(name="Garden Tools")
+        cls.image = Image.objects.create(
+            name="product",
+            filename="product.png",
+            file_path="media/images/products/product.png",
+            file_size=10,
+            width=10,
+            height=10,
+            format=ImageFormat.PNG,
+            mime_type=MimeType.PNG,
+            file_hash="b" * 64,
+            uploaded_by=cls.owner,
+        )
+
+    @classmethod
+    def create_product(cls, name, price, **fields):
+        fields.setdefault("shop", cls.shop)
+        product = Product.objects.create(name=name, price=Decimal(price), **fields)
+        ProductImages.objects.create(product=product, image=cls.image, primary=True)
+        return product
+
+    def setUp(self):
+        cache.clear()
+        ProductService.cache.local.clear()
+
+
+class ProductFilterTests(ProductFixtures, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.rake = cls.create_product("Rake", "20.00", category=cls.category, stock=3)
+        cls.spade = cls.create_product(
+            "Spade", "35.00", category=cls.category, stock=0, discount_price=Decimal("30.00")
+        )
+        cls.lamp = cls.create_product("Lamp", "12.50", shop=cls.other_shop, stock=1)
+        cls.create_product("Hidden", "1.00", is_active=False)
+
+    def get_names(self, **params):
+        response = self.client.get("/api/products", params)
+        self.assertEqual(response.status_code, 200)
+        return [product["name"] for product in response.json()["data"]]
+
+    def test_category_and_shop_filter_by_slug(self):
+        self.assertCountEqual(self.get_names(category=self.category.slug), ["Rake", "Spade"])
+        self.assertEqual(self.get_names(shop=self.other_shop.slug), ["Lamp"])
+        self.assertEqual(self.get_names(category="no-such-category"), [])
+        self.assertEqual(self.get_names(shop="no-such-shop"), [])
+
+    def test_stock_and_sale_filters(self):
+        self.assertCountEqual(self.get_names(in_stock=True), ["Rake", "Lamp"])
+        self.assertEqual(self.get_names(in_stock=False), ["Spade"])
+        self.assertEqual(self.get_names(on_sale=True), ["Spade"])
+        self.assertCountEqual(self.get_names(on_sale=False), ["Rake", "Lamp"])
+
+    def test_price_range_includes_zero_bound(self):
+        self.assertEqual(self.get_names(max_price=15), ["Lamp"])
+        self.assertEqual(self.get_names(min_price=0, max_price=0), [])
+
+    def test_sort_by_price(self):
+        self.assertEqual(self.get_names(sort="price_asc"), ["Lamp", "Rake", "Spade"])
+        self.assertEqual(self.get_names(sort="price_desc"), ["Spade", "Rake", "Lamp"])
+
+    def test_price_sort_pages_by_cursor(self):
+        params = {"sort": "price_asc", "page_size": 2}
+        first = self.client.get("/api/products", params).json()
+        self.assertEqual([product["name"] for product in first["data"]], ["Lamp", "Rake"])
+        self.assertEqual(self.get_names(cursor=first["next_cursor"], **params), ["Spade"])
+
+
+class ProductCacheTests(ProductFixtures, TestCase):
+    def test_clearing_a_product_invalidates_its_detail(self):
+        product = self.create_product("Rake", "20.00")
+        url = f"/api/products/{product.slug}"
+        self.assertEqual(self.client.get(url).json()["data"]["name"], "Rake")
+        Product.objects.filter(pk=product.pk).update(name="Leaf Rake")
+        self.assertEqual(self.client.get(url).json()["data"]["name"], "Rake")
+
+        ProductService._clear_cache(slug=product.slug)
+        self.assertEqual(self.client.get(url).json()["data"]["name"], "Leaf Rake")
+
+    def test_product_writes_invalidate_listings_and_detail(self):
+        product = self.create_product("Rake", "20.00")
+        url = f"/api/products/{product.slug}"
+        self.assertEqual(self.client.get(url).json()["data"]["name"], "Rake")
+        self.assertEqual(len(self.client.get("/api/products").json()["data"]), 1)
+
+        product.name = "Leaf Rake"
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertEqual(self.client.get(url).json()["data"]["name"], "Leaf Rake")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(self.client.get("/api/products").json()["data"], [])
+
+
+class ProductFacetTests(ProductFixtures, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.tools = ProductCategory.objects.create(name="Hand Tools")
+        cls.create_product("Seeds", "5.00", category=cls.category, stock=10)
+        cls.create_product("Trowel", "10.00", category=cls.category, stock=0)
+        cls.create_product(
+            "Spade", "30.00", category=cls.tools, stock=2, discount_price=Decimal("25.00")
+        )
+        cls.create_product("Mower", "600.00", shop=cls.other_shop, stock=1)
+        cls.create_product("Hidden", "1.00", category=cls.category, is_active=False)
+
+    def facets(self, **params):
+        response = self.client.get("/api/products", {"facets": True, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()["facets"]
+
+    def counts(self, values):
+        return [(value["name"], value["count"]) for value in values]
+
+    def test_category_and_shop_counts(self):
+        facets = self.facets()
+        self.assertEqual(facets["categories"][0]["name"], "Garden Tools")
+        self.assertCountEqual(
+            self.counts(facets["categories"]),
+            [("Garden Tools", 2), ("Hand Tools", 1), (None, 1)],
+        )
+        uncategorized = [value for value in facets["categories"] if value["name"] is None]
+        self.assertEqual((uncategorized[0]["id"], uncategorized[0]["slug"]), (None, None))
+        self.assertEqual(self.counts(facets["shops"]), [("Corner Shop", 3), ("Other Shop", 1)])
+
+        facets = self.facets(shop=self.other_shop.slug)
+        self.assertEqual(self.counts(facets["categories"]), [(None, 1)])
+        self.assertEqual(self.counts(facets["shops"]), [("Other Shop", 1)])
+
+    def test_price_ranges_are_open_ended(self):
+        ranges = [(r["min"], r["max"], r["count"]) for r in self.facets()["price_ranges"]]
+        self.assertEqual(
+            ranges,
+            [
+                (None, 10, 1),
+                (10, 25, 1),
+                (25, 50, 1),
+                (50, 100, 0),
+                (100, 250, 0),
+                (250, 500, 0),
+                (500, None, 1),
+            ],
+        )
+
+    def test_price_buckets_setting(self):
+        with self.settings(PRODUCT_PRICE_BUCKETS=[20]):
+            ranges = [(r["min"], r["max"], r["count"]) for r in self.facets()["price_ranges"]]
+        self.assertEqual(ranges, [(None, 20, 2), (20, None, 2)])
+
+    def test_stock_and_sale_counts(self):
+        facets = self.facets()
+        self.assertEqual((facets["in_stock"], facets["on_sale"]), (3, 1))
+        facets = self.facets(category=self.category.slug)
+        self.assertEqual((facets["in_stock"], facets["on_sale"]), (1, 0))
+
+    def test_pages_share_the_cached_facets(self):
+        first = self.facets(page_size=2)
+        # bulk updates skip the signals, so the cached facets stay as they were
+        Product.objects.update(stock=0)
+        # only the page query, the facets come from the cache
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                "/api/products", {"facets": True, "page_size": 2, "page": 2}
+            )
+        self.assertEqual(response.json()["facets"], first)
+        self.assertEqual(self.facets(in_stock=False)["in_stock"], 0)
+
+
+class ProductSearchTests(ProductFixtures, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.rake = cls.create_product(
+            "Garden Rake", "20.00", category=cls.category, description="Steel tines"
+        )
+        cls.create_product("Kettle", "15.00", category=cls.category, description="For the garden")
+        # more matches outside the category than one page holds
+        for index in range(12):
+            cls.create_product(f"Garden Chair {index}", "40.00", shop=cls.other_shop)
+        cls.create_product("Garden Gnome", "5.00", category=cls.category, is_active=False)
+
+    def search(self, term, **params):
+        response = self.client.get("/api/products", {"search": term, "page_size": 5, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def names(self, term, **params):
+        return [product["name"] for product in self.search(term, **params)["data"]]
+
+    def test_terms_match_word_prefixes(self):
+        self.assertEqual(self.names("rak"), ["Garden Rake"])
+        self.assertEqual(self.names("gard rak"), ["Garden Rake"])
+        self.assertEqual(self.names("tines"), ["Garden Rake"])
+        self.assertEqual(self.names("ake"), [])
+
+    def test_name_matches_rank_above_description_matches(self):
+        names = self.names("garden", category=self.category.slug)
+        self.assertEqual(names, ["Garden Rake", "Kettle"])
+
+    def test_search_applies_to_every_match_of_the_other_filters(self):
+        page = self.search("garden", category=self.category.slug, facets=True)
+        self.assertEqual(page["count"], 2)
+        self.assertEqual(
+            [(facet["slug"], facet["count"]) for facet in page["facets"]["categories"]],
+            [(self.category.slug, 2)],
+        )
+        page = self.search("garden")
+        self.assertEqual(page["count"], 14)
+        names = self.names("garden", cursor=page["next_cursor"])
+        self.assertEqual(len(names), 5)
+        self.assertNotIn("Garden Gnome", names)
+
+    def test_documents_follow_product_saves_and_deletes(self):
+        self.rake.name = "Leaf Blower"
+        self.rake.save()
+        self.assertEqual(self.names("blower"), ["Leaf Blower"])
+        self.assertEqual(self.names("rake"), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.rake.delete()
+        self.assertEqual(self.names("blower"), [])
+        self.assertFalse(ProductSearchDocument.objects.filter(product_id=self.rake.pk).exists())
+
+
+class CategorySlugTests(TestCase):
+    def test_backfill_fills_missing_slugs_only(self):
+        named = ProductCategory.objects.create(name="Garden Tools")
+        ProductCategory.objects.bulk_create(
+            [ProductCategory(name="Garden Tools!"), ProductCategory(name="Lamps", slug="")]
+        )
+        self.assertEqual(ProductCategory.backfill_slugs(), 2)
+        self.assertEqual(
+            dict(ProductCategory.objects.values_list("name", "slug")),
+            {"Garden Tools": named.slug, "Garden Tools!": "garden-tools-1", "Lamps": "lamps"},
+        )
+        self.assertEqual(ProductCategory.backfill_slugs(), 0)
+
+
+@skipUnless(connection.vendor == "sqlite", "query plans are SQLite specific")
+class ProductListingPlanTests(ProductFixtures, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.create_product("Rake", "20.00", category=cls.category)
+
+    def assert_plan_uses(self, filters, index):
+        queryset = ProductService._apply_filters(ProductService._listing_queryset(), filters)
+        plan = queryset.order_by(*ProductService._ordering(filters))[:20].explain()
+        self.assertIn(f"USING INDEX {index}", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_default_listing(self):
+        self.assert_plan_uses({}, "product_active_created_idx")
+
+    def test_category_listing(self):
+        self.assert_plan_uses({"category": self.category.slug}, "product_category_created_idx")
+
+    def test_shop_listing(self):
+        self.assert_plan_uses({"shop": self.shop.slug}, "product_shop_created_idx")
+
+    def test_price_sorted_listing(self):
+        self.assert_plan_uses({"sort": "price_asc"}, "product_active_price_idx")
+        self.assert_plan_uses({"sort": "price_desc", "min_price": 10}, "product_active_price_idx")
+
+
+class ProductQueryCountTests(ProductFixtures, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.products = [
+            cls.create_product(f"Product {index}", "10.00", category=cls.category)
+            for index in range(5)
+        ]
+        for product in cls.products:
+            ProductImages.objects.create(product=product, image=cls.image, primary=False)
+        cls.bare = Product.objects.create(name="No Images", price=Decimal("5.00"), shop=cls.shop)
+
+    def test_listing_queries_do_not_grow_with_page_size(self):
+        # count, page with the primary images joined
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/products", {"page_size": 20})
+        self.assertEqual(response.status_code, 200)
+        products = response.json()["data"]
+        self.assertEqual(len(products), 6)
+        self.assertEqual(sum(product["product_image"] is None for product in products), 1)
+
+    def test_detail_loads_gallery_with_prefetch(self):
+        product = self.products[0]
+        # product with its shop and primary image, gallery images
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/products/{product.slug}")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()["data"]
+        self.assertEqual(data["shop"], {"name": self.shop.name, "slug": self.shop.slug})
+        self.assertEqual(len(data["gallery_images"]), 1)
+
+    def test_detail_without_images(self):
+        response = self.client.get(f"/api/products/{self.bare.slug}")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()["data"]["product_image"])
+        self.assertEqual(response.json()["data"]["gallery_images"], [])
+
+
+class PrimaryImageTests(ProductFixtures, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_image = Image.objects.create(
+            name="other",
+            filename="other.png",
+            file_path="media/images/products/other.png",
+            file_size=10,
+            width=10,
+            height=10,
+            format=ImageFormat.PNG,
+            mime_type=MimeType.PNG,
+            file_hash="c" * 64,
+            uploaded_by=cls.owner,
+        )
+
+    def primary_image_id(self, product):
+        product.refresh_from_db(fields=["primary_image"])
+        return product.primary_image_id
+
+    def test_new_primary_replaces_previous(self):
+        product = self.create_product("Rake", "20.00")
+        first = product.images.get()
+        self.assertEqual(self.primary_image_id(product), self.image.id)
+
+        ProductImages.objects.create(product=product, image=self.other_image, primary=True)
+        first.refresh_from_db()
+        self.assertFalse(first.primary)
+        self.assertEqual(self.primary_image_id(product), self.other_image.id)
+
+    def test_demoting_or_deleting_primary_clears_it(self):
+        product = self.create_product("Rake", "20.00")
+        primary = product.images.get()
+        primary.primary = False
+        primary.save()
+        self.assertIsNone(self.primary_image_id(product))
+
+        primary.primary = True
+        primary.save()
+        self.assertEqual(self.primary_image_id(product), self.image.id)
+        primary.delete()
+        self.assertIsNone(self.primary_image_id(product))
+
+    def test_moving_an_image_updates_both_products(self):
+        product = self.create_product("Rake", "20.00")
+        other = Product.objects.create(name="Spade", price=Decimal("35.00"), shop=self.shop)
+        primary = product.images.get()
+        primary.product = other
+        primary.save()
+        self.assertIsNone(self.primary_image_id(product))
+        self.assertEqual(self.primary_image_id(other), self.image.id)
+
+    def test_image_changes_invalidate_the_product_cache(self):
+        product = self.create_product("Rake", "20.00")
+        url = f"/api/products/{product.slug}"
+
+        def detail_image():
+            return self.client.get(url).json()["data"]["product_image"]["id"]
+
+        def listing_image():
+            return self.client.get("/api/products").json()["data"][0]["product_image"]["id"]
+
+        self.assertEqual((detail_image(), listing_image()), (str(self.image.id),) * 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductImages.objects.create(product=product, image=self.other_image, primary=True)
+        self.assertEqual((detail_image(), listing_image()), (str(self.other_image.id),) * 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.images.get(primary=True).delete()
+        self.assertIsNone(self.client.get(url).json()["data"]["product_image"])
+
+    def test_single_primary_per_product(self):
+        product = self.create_product("Rake", "20.00")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ProductImages.objects.bulk_create(
+                [ProductImages(product=product, image=self.other_image, primary=True)]
+            )
@@ -3,9 +3,10 @@ from ninja import File, Query, UploadedFile
 
 from apps.users.utils import get_user_from_request
 from core.auth import AuthBearer
+from core.pagination import CountMode
 from core.router import CustomRouter as Router
 from core.schemas import PaginatedQueryParams, SuccessResponseSchema
-from core.utils import response_message, response_with_data
+from core.utils import json_response, response_message, response_with_data
 
 from .schemas import (
     ShopCreateSchema,
@@ -21,7 +22,7 @@ from .services import (
     deactivate_shop_for_user,
     delete_logo_for_shop,
     get_all_shops,
-    get_shop_by_slug,
+    get_shop_details,
     update_shop_for_user,
     upload_logo_for_shop,
 )
@@ -42,13 +43,13 @@ def get_shops(
     filters: Query[ShopFilters] = None,
     pagination: Query[PaginatedQueryParams] = None,
 ):
-    return get_all_shops(request, filters, pagination)
+    result = get_all_shops(request, filters, pagination, count_mode=CountMode.CACHED)
+    return json_response(result)
 
 
 @shop_router.get("/{shop_slug}", response=ShopDetailResponse)
 def get_shop(request: HttpRequest, shop_slug: str):
-    data = get_shop_by_slug(shop_slug)
-    return response_with_data("Shop details retrieved successfully", data=data)
+    return json_response(get_shop_details(shop_slug))
 
 
 @shop_router.patch("/{shop_slug}", auth=AuthBearer(), response={200: SuccessResponseSchema})
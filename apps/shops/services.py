@@ -5,10 +5,11 @@ from apps.images.services import ImageService
 from apps.shops.exceptions import ShopNotFound
 from apps.users.utils import get_user_from_request
 from core.cache import Cache
-from core.pagination import Paginator
-from core.utils import get_seconds
+from core.pagination import CountMode, Paginator
+from core.utils import get_seconds, response_with_data
 
 from .models import Shop, ShopProfile, ShopStatus
+from .schemas import ShopDetailResponse, ShopListSchema
 from .utils import send_shop_welcome_email
 
 shop_list_cache = Cache(prefix="shop_list", timeout=get_seconds(minutes=15))
@@ -35,45 +36,54 @@ def create_shop_for_user(request, shop_data, user):
     return shop
 
 
-def get_all_shops(request: HttpRequest, filters, pagination):
+def get_all_shops(request: HttpRequest, filters, pagination, count_mode: CountMode = None):
     pagination = pagination.dict() if hasattr(pagination, "dict") else {}
     filters = filters.dict() if hasattr(filters, "dict") else {}
     page_size = pagination.get("page_size", 10)
     page_number = pagination.get("page", 1)
+    cursor = pagination.get("cursor")
     cache_key_data = {
         "page_size": page_size,
         "page": page_number,
+        "cursor": cursor,
+        "count_mode": count_mode,
         **filters,
     }
     cache_key = shop_list_cache.generate_key(cache_key_data, suffix="all_shops")
-    cache_response = shop_list_cache.get(cache_key)
-    if cache_response:
-        return cache_response
 
-    queryset = Shop.objects.select_related("profile", "profile__logo").filter(
-        status=ShopStatus.ACTIVE
-    )
-    paginator = Paginator(request=request, queryset=queryset, page_size=page_size)
-    result = paginator.get_page(page_number)
-    shop_list_cache.set(cache_key, result)
-    return result
+    def get_page():
+        queryset = Shop.objects.select_related("profile", "profile__logo").filter(
+            status=ShopStatus.ACTIVE
+        )
+        paginator = Paginator(
+            request=request, queryset=queryset, page_size=page_size, count_mode=count_mode
+        )
+        return paginator.get_page(page_number, cursor=cursor)
+
+    return shop_list_cache.get_or_render(cache_key, ShopListSchema, get_page)
 
 
 def get_shop_by_slug(shop_slug: str):
     try:
-        key = shop_detail_cache.generate_key({"shop_slug": shop_slug})
-        cached_shop = shop_detail_cache.get(key)
-        if cached_shop:
-            return cached_shop
-        shop = Shop.objects.select_related("profile", "profile__logo").get(slug=shop_slug)
-        shop_detail_cache.set(key, shop)
-        return shop
+        return Shop.objects.select_related("profile", "profile__logo").get(slug=shop_slug)
     except Shop.DoesNotExist:
         raise ShopNotFound("Shop with the given slug does not exist.")
     except Exception:
         raise
 
 
+def get_shop_details(shop_slug: str) -> bytes:
+    """Rendered ShopDetailResponse payload for the shop"""
+    key = shop_detail_cache.generate_key({"shop_slug": shop_slug}, suffix=shop_slug)
+
+    def get_details():
+        return response_with_data(
+            "Shop details retrieved successfully", data=get_shop_by_slug(shop_slug)
+        )
+
+    return shop_detail_cache.get_or_render(key, ShopDetailResponse, get_details)
+
+
 def update_shop_for_user(request, shop_slug, data):
     user = get_user_from_request(request)
 
@@ -173,8 +183,7 @@ def deactivate_shop_for_user(request, shop_slug):
         shop.status = ShopStatus.INACTIVE
         shop.save(update_fields=["status", "updated_at"])
         shop_list_cache.clear()
-        shop_detail_key = shop_detail_cache.generate_key({"shop_slug": shop_slug})
-        shop_detail_cache.delete(shop_detail_key)
+        shop_detail_cache.invalidate(shop_slug)
     except Shop.DoesNotExist:
         raise ShopNotFound("Shop not found or you do not have permission to delete it.")
     except Exception:
@@ -198,5 +207,4 @@ def _clear_shop_cache(shop_slug: str = None) -> None:
     """Clear shop-related caches."""
     shop_list_cache.clear()
     if shop_slug:
-        shop_detail_key = shop_detail_cache.generate_key({"shop_slug": shop_slug})
-        shop_detail_cache.delete(shop_detail_key)
+        shop_detail_cache.invalidate(shop_slug)
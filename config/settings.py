@@ -20,6 +20,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "ninja",
+    "core",
     "apps.users",
     "apps.images",
     "apps.shops",
@@ -75,6 +76,19 @@ CACHES = {
     }
 }
 
+# core.cache.Cache prefixes that keep an in-process copy in front of CACHES["default"]
+CACHE_LOCAL_PREFIXES = ["products", "shop_detail", "image_meta"]
+CACHE_LOCAL_MAX_ENTRIES = 1000
+CACHE_LOCAL_TIMEOUT = 30
+# seconds every worker trusts the invalidation generations it read, for all prefixes
+CACHE_LOCAL_GENERATION_TIMEOUT = 1
+
+# core.metrics counters are merged into CACHES["default"] every METRICS_FLUSH_INTERVAL seconds
+METRICS_ENABLED = True
+METRICS_FLUSH_INTERVAL = 10
+# exposes GET /api/system/cache/stats to staff users
+METRICS_API_ENABLED = False
+
 
 NINJA_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=1),
@@ -118,3 +132,70 @@ USE_TZ = True
 STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# upper bounds of the price ranges counted by /api/products?facets=true
+PRODUCT_PRICE_BUCKETS = [10, 25, 50, 100, 250, 500]
+
+# Image variants rendered in the background after upload, by ImageCategory. Serve
+# requests with the same width/height/format/quality read the ready file.
+IMAGE_VARIANT_PRESETS = {
+    "products": {
+        "thumbnail": {"width": 400, "height": 400, "format": "webp", "quality": 80},
+        "medium": {"width": 800, "height": 800, "format": "webp", "quality": 80},
+    },
+    "logo": {
+        "thumbnail": {"width": 200, "height": 200, "format": "webp", "quality": 85},
+    },
+    "banner": {
+        "thumbnail": {"width": 400, "height": 400, "format": "webp", "quality": 80},
+        "large": {"width": 1600, "height": 600, "format": "webp", "quality": 80},
+    },
+}
+# Upload limits checked on the image header before any pixel is decoded, by
+# ImageCategory; a category's entries override "default"
+IMAGE_UPLOAD_LIMITS = {
+    "default": {
+        "formats": ["jpeg", "png", "webp", "gif", "avif"],
+        "max_width": 8000,
+        "max_height": 8000,
+        "max_pixels": 40_000_000,
+    },
+    "logo": {"max_width": 2000, "max_height": 2000, "max_pixels": 4_000_000},
+    "banner": {"max_width": 6000, "max_height": 3000, "max_pixels": 18_000_000},
+}
+# most files accepted by one /images/upload/batch request
+IMAGE_BATCH_UPLOAD_MAX_FILES = 20
+# size of the background pool rendering variants, 0 renders them inline after commit
+IMAGE_VARIANT_WORKERS = 2
+
+# storage-backed cache of transformed images (media/derived), least recently used
+# unpinned files are removed past this many bytes
+IMAGE_DERIVED_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# image payloads above this size are not kept in the in-memory caches
+IMAGE_MEMORY_CACHE_MAX_BYTES = 256 * 1024
+# formats tried for format=auto, smallest output first; the first one the client accepts
+# and Pillow can encode is served, otherwise the original's format
+IMAGE_AUTO_FORMATS = ["avif", "webp"]
+
+# Let the front proxy send stored images: None, "x-accel-redirect" (nginx) or
+# "x-sendfile" (Apache/lighttpd). For nginx, IMAGE_SERVE_OFFLOAD_PREFIX must be an
+# internal location aliasing the storage root, e.g.
+#   location /protected/ { internal; alias /srv/shopifyte/; }
+IMAGE_SERVE_OFFLOAD = None
+IMAGE_SERVE_OFFLOAD_PREFIX = "/protected/"
+
+# Serve images from an async view, for deployments running config.asgi (uvicorn,
+# daphne): storage reads and cache calls no longer hold a worker thread
+IMAGE_SERVE_ASYNC = config("IMAGE_SERVE_ASYNC", default=False, cast=bool)
+
+# CPU-heavy image work (upload re-encoding, transforms) runs in this pool: "process",
+# "thread" or "inline". Requests beyond the queue limit, or whose job runs past the
+# timeout, get a 503 with Retry-After.
+IMAGE_EXECUTOR_MODE = "process"
+# per web worker process: 4 gunicorn workers with 2 each run up to 8 image jobs at once,
+# size it so web workers x executor workers fits the cores and memory of the host
+IMAGE_EXECUTOR_WORKERS = 2
+IMAGE_EXECUTOR_QUEUE_LIMIT = None  # 4 jobs per worker
+IMAGE_EXECUTOR_TIMEOUT = 30
+IMAGE_EXECUTOR_RETRY_AFTER = 5
@@ -1,16 +1,48 @@
+from django.conf import settings
 from ninja_extra import NinjaExtraAPI
 
 from apps.products.api import products_router
 from apps.shops.api import shop_router
 from apps.users.api import auth_router, profile_router
 from apps.images.api import img_router
+from core.auth import AuthBearer
 from core.exception_handler import setup_exception_handlers
+from core.metrics import flush_all, read_metrics
+from core.permissions import IsAdminUser
+from core.router import CustomRouter
+from core.schemas import MetricsResponseSchema
+from core.utils import response_with_data
 
 
 class CustomNinjaExtraAPI(NinjaExtraAPI):
     pass
 
 
+system_router = CustomRouter(tags=["system"], auth=AuthBearer(), permissions=[IsAdminUser])
+
+
+@system_router.get(
+    "/cache/stats",
+    summary="Cache metrics per prefix",
+    response={200: MetricsResponseSchema},
+)
+def cache_stats(request):
+    flush_all()
+    return 200, response_with_data("Cache metrics retrieved successfully", read_metrics("cache:"))
+
+
+@system_router.get(
+    "/images/uploads/stats",
+    summary="Accepted and rejected image uploads",
+    response={200: MetricsResponseSchema},
+)
+def image_upload_stats(request):
+    flush_all()
+    return 200, response_with_data(
+        "Upload metrics retrieved successfully", read_metrics("images:uploads")
+    )
+
+
 api = CustomNinjaExtraAPI(
     title="SHOPIFYTE API Reference",
     description="API Reference for the SHOPIFYTE API",
@@ -27,3 +59,5 @@ api.add_router("/profile", profile_router)
 api.add_router("/images", img_router)
 api.add_router("/shops", shop_router)
 api.add_router("/products", products_router)
+if getattr(settings, "METRICS_API_ENABLED", False):
+    api.add_router("/system", system_router)
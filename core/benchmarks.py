@@ -0,0 +1,39 @@
+"""
+Helpers for the bench_* management commands. Benchmarks build their fixtures inside
+scratch_data(), a transaction that is always rolled back, so they can run against a
+development database without leaving rows behind.
+"""
+
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+from django.db import transaction
+
+
+@contextmanager
+def scratch_data():
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+def measure(fn: Callable[[], Any], repeat: int = 20, warmup: int = 2) -> dict:
+    """Median and p95 wall time of fn() in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "median_ms": statistics.median(timings),
+        "p95_ms": timings[min(int(len(timings) * 0.95), len(timings) - 1)],
+    }
+
+
+def format_row(label: str, result: dict, width: int = 36) -> str:
+    return f"{label:<{width}}{result['median_ms']:>10.2f}ms{result['p95_ms']:>10.2f}ms"
@@ -1,86 +1,611 @@
-from hashlib import md5
+import asyncio
+from collections import OrderedDict
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+from enum import Enum
+from functools import lru_cache
+from hashlib import blake2b, md5
 import json
-from typing import Any, Optional
+import logging
+import math
+import pickle
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+from uuid import UUID
 from django.conf import settings
 from django.core.cache import cache as django_cache
+from django.core.cache.backends.base import BaseCache
+from django.utils.module_loading import import_string
+from ninja import Schema
+from ninja.responses import NinjaJSONEncoder
 
+from core.metrics import SIZE_BUCKETS, Metrics, get_metrics
 from core.utils import get_seconds
 
+logger = logging.getLogger(__name__)
+
 DEFAULT_TIMEOUT = get_seconds(minutes=5)  # Default timeout in seconds
+GENERATION_KEY_PREFIX = "__gen__"
+
+LOCAL_MAX_ENTRIES = 1000
+LOCAL_TIMEOUT = get_seconds(seconds=30)
+# how long a worker trusts its local copy of a generation before asking the backend
+LOCAL_GENERATION_TIMEOUT = get_seconds(seconds=1)
+LOCAL_GENERATION_MAX_ENTRIES = 10000
+
+# how long get_or_compute keeps serving an expired value while it gets refreshed
+STALE_TIMEOUT = get_seconds(minutes=5)
+LOCK_TIMEOUT = get_seconds(seconds=10)
+LOCK_POLL_INTERVAL = 0.05
+
+_MISSING = object()
+
+try:
+    import xxhash
+except ImportError:  # optional, blake2b is used instead
+    xxhash = None
+
+
+def _encode_key_value(value: Any) -> Any:
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, Decimal):
+        # 10, 10.0 and 10.00 are the same filter
+        return format(value.normalize(), "f")
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    raise TypeError(f"Cannot use {type(value).__name__} in a cache key")
+
+
+def encode_key_data(data: dict[str, Any]) -> bytes:
+    """
+    Canonical bytes for the data a cache key is built from. The output only depends on
+    the values, never on dict order or the process, so every worker builds the same key.
+    Other types raise TypeError rather than fall back to str(), whose output (reprs with
+    memory addresses, unordered sets) is not stable across workers.
+    """
+    return json.dumps(
+        data, sort_keys=True, separators=(",", ":"), default=_encode_key_value
+    ).encode()
+
+
+KEY_HASHERS: dict[str, Callable[[bytes], str]] = {
+    "blake2b": lambda data: blake2b(data, digest_size=10).hexdigest(),
+    "md5": lambda data: md5(data).hexdigest()[:20],
+}
+if xxhash is not None:
+    KEY_HASHERS["xxhash"] = lambda data: xxhash.xxh3_64_hexdigest(data)
+
+
+@lru_cache(maxsize=None)
+def get_key_hasher() -> Callable[[bytes], str]:
+    """
+    The hash used for generated keys, set with CACHE_KEY_HASHER as one of KEY_HASHERS
+    or a dotted path to a callable taking bytes and returning a str. It defaults to
+    xxhash when installed, blake2b otherwise. Python's hash() is not an option since it
+    changes between processes.
+    """
+    name = getattr(settings, "CACHE_KEY_HASHER", None)
+    if name is None:
+        name = "xxhash" if xxhash is not None else "blake2b"
+    if name in KEY_HASHERS:
+        return KEY_HASHERS[name]
+    return import_string(name)
+
+
+@lru_cache(maxsize=None)
+def schema_version(schema: type[Schema]) -> str:
+    """Short fingerprint of a response schema, so payloads cached for an old shape are not served"""
+    definition = json.dumps(schema.model_json_schema(), sort_keys=True)
+    return md5(definition.encode()).hexdigest()[:8]
+
+
+def _value_size(value: Any) -> int:
+    """Roughly what the value costs in the backend, i.e. its pickled size"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache with a TTL per entry.
+
+    Values are kept as-is (not pickled), so callers must not mutate what they get back.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = LOCAL_MAX_ENTRIES,
+        timeout: float = LOCAL_TIMEOUT,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.metrics = metrics
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, timeout: Optional[float] = None):
+        timeout = min(timeout or self.timeout, self.timeout)
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                if self.metrics is not None:
+                    self.metrics.incr("local_evictions")
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
 
 
 class Cache:
+    """
+    Prefixed wrapper around the django cache.
+
+    Every key carries a generation number for its prefix, and keys generated with a
+    suffix also carry one for that suffix. Invalidating a prefix or a suffix only bumps
+    its generation, so stale entries become unreachable and expire on their own
+    instead of being searched for and deleted.
+
+    Generations live in the backend with a TTL well past the data timeout, which is
+    renewed while they are in use, so counters of namespaces nobody reads any more
+    (per image, per user, ...) expire. Each worker keeps the generations it read for
+    CACHE_LOCAL_GENERATION_TIMEOUT seconds, so an invalidation made by one worker
+    reaches the others within that window.
+
+    Prefixes listed in CACHE_LOCAL_PREFIXES (or created with local=True) also keep a
+    small in-process copy (L1) of the values in front of the shared backend (L2). Plain
+    deletes are not versioned and only leave other workers' L1 when the entry expires.
+
+    Hits, misses, sets, invalidations, latencies and value sizes are recorded under the
+    "cache:<prefix>" metrics namespace, see `manage.py cache_stats`.
+    """
 
-    def __init__(self, prefix: str = "cache", timeout: Optional[float] = None):
-        if timeout is None or timeout <= 0 or not isinstance(timeout, float):
+    def __init__(
+        self,
+        prefix: str = "cache",
+        timeout: Optional[float] = None,
+        local: Optional[bool] = None,
+        backend: Optional[BaseCache] = None,
+    ):
+        if timeout is None or not isinstance(timeout, (int, float)) or timeout <= 0:
             timeout = getattr(settings, "CACHE_TIMEOUT", DEFAULT_TIMEOUT)
         self.timeout = timeout
         self.prefix = prefix
-        self.cache = django_cache
+        self.cache = backend if backend is not None else django_cache
+        self.metrics = get_metrics(f"cache:{prefix}")
+
+        if local is None:
+            local = prefix in getattr(settings, "CACHE_LOCAL_PREFIXES", [])
+        # a generation has to outlive every value stored under it, stale ones included
+        stale_timeout = getattr(settings, "CACHE_STALE_TIMEOUT", STALE_TIMEOUT)
+        self.generation_timeout = getattr(settings, "CACHE_GENERATION_TIMEOUT", None) or (
+            2 * (self.timeout + stale_timeout)
+        )
+        self.generations = LocalCache(
+            max_entries=LOCAL_GENERATION_MAX_ENTRIES,
+            timeout=getattr(settings, "CACHE_LOCAL_GENERATION_TIMEOUT", LOCAL_GENERATION_TIMEOUT),
+        )
+        # generation keys whose TTL this worker renewed lately
+        self.renewed_generations = LocalCache(
+            max_entries=LOCAL_GENERATION_MAX_ENTRIES, timeout=self.generation_timeout / 2
+        )
+
+        self.local = None
+        if local:
+            self.local = LocalCache(
+                max_entries=getattr(settings, "CACHE_LOCAL_MAX_ENTRIES", LOCAL_MAX_ENTRIES),
+                timeout=getattr(settings, "CACHE_LOCAL_TIMEOUT", LOCAL_TIMEOUT),
+                metrics=self.metrics,
+            )
 
     def _prefix_key(self, key: str) -> str:
-        if not key.startswith(self.prefix):
-            key = f"{self.prefix}:{key}"
+        if not key.startswith(f"{self.prefix}:"):
+            key = f"{self.prefix}:{self.get_generation()}:{key}"
         return key
 
-    def generate_key(self, data: dict[str, Any], suffix: str = None) -> str:
+    async def _aprefix_key(self, key: str) -> str:
+        if not key.startswith(f"{self.prefix}:"):
+            (generation,) = await self.aget_generations(None)
+            key = f"{self.prefix}:{generation}:{key}"
+        return key
+
+    def _generation_key(self, namespace: str = None) -> str:
+        name = f"{self.prefix}:{namespace}" if namespace else self.prefix
+        return f"{GENERATION_KEY_PREFIX}:{name}"
+
+    @staticmethod
+    def _new_generation() -> int:
+        # start from the clock so a counter that got evicted never reuses an old number
+        return int(time.time() * 1000)
+
+    def get_generations(self, *namespaces: Optional[str]) -> list[int]:
+        """Current generation of each namespace, None being the whole prefix"""
+        keys = [self._generation_key(namespace) for namespace in namespaces]
+        generations = self._local_generations(keys)
+        missing = [key for key in keys if key not in generations]
+        if missing:
+            generations.update(self.cache.get_many(missing))
+        for key in missing:
+            if key not in generations:
+                generation = self._new_generation()
+                if not self.cache.add(key, generation, timeout=self.generation_timeout):
+                    generation = self.cache.get(key, generation)
+                generations[key] = generation
+                self.renewed_generations.set(key, True)
+            elif self.renewed_generations.get(key) is None:
+                self.cache.touch(key, self.generation_timeout)
+                self.renewed_generations.set(key, True)
+            self.generations.set(key, generations[key])
+        return [generations[key] for key in keys]
+
+    async def aget_generations(self, *namespaces: Optional[str]) -> list[int]:
+        keys = [self._generation_key(namespace) for namespace in namespaces]
+        generations = self._local_generations(keys)
+        missing = [key for key in keys if key not in generations]
+        if missing:
+            generations.update(await self.cache.aget_many(missing))
+        for key in missing:
+            if key not in generations:
+                generation = self._new_generation()
+                if not await self.cache.aadd(key, generation, timeout=self.generation_timeout):
+                    generation = await self.cache.aget(key, generation)
+                generations[key] = generation
+                self.renewed_generations.set(key, True)
+            elif self.renewed_generations.get(key) is None:
+                await self.cache.atouch(key, self.generation_timeout)
+                self.renewed_generations.set(key, True)
+            self.generations.set(key, generations[key])
+        return [generations[key] for key in keys]
+
+    def _local_generations(self, keys: list[str]) -> dict[str, int]:
+        generations = {}
+        for key in keys:
+            generation = self.generations.get(key)
+            if generation is not None:
+                generations[key] = generation
+        return generations
+
+    def get_generation(self, namespace: str = None) -> int:
+        return self.get_generations(namespace)[0]
+
+    def invalidate(self, namespace: str = None):
+        """
+        Drop every key under the namespace (a generate_key suffix), or under the whole
+        prefix when no namespace is given, by bumping its generation.
+        """
+        key = self._generation_key(namespace)
         try:
-            sorted_data = json.dumps(data, sort_keys=True)
+            try:
+                generation = self.cache.incr(key)
+            except ValueError:
+                # the counter is gone so nothing cached under it can be reached anyway
+                generation = self._new_generation()
+                self.cache.set(key, generation, timeout=self.generation_timeout)
+            self.generations.set(key, generation)
+            self.metrics.incr("invalidations")
+            return generation
         except Exception:
-            sorted_data = str(sorted(data.items()))
-        hash = md5(sorted_data.encode()).hexdigest()
+            logger.warning(
+                f"Cant invalidate cache namespace: {namespace or self.prefix}", exc_info=True
+            )
+            self.metrics.incr("errors")
+            return None
+
+    def generate_key(self, data: dict[str, Any], suffix: str = None) -> str:
+        hash = get_key_hasher()(encode_key_data(data))
         if suffix:
-            hash = f"{suffix}_{hash[:20]}"
+            generation, namespace_generation = self.get_generations(None, suffix)
+            return f"{self.prefix}:{generation}:{suffix}.{namespace_generation}_{hash}"
         return self._prefix_key(hash)
 
+    async def agenerate_key(self, data: dict[str, Any], suffix: str = None) -> str:
+        hash = get_key_hasher()(encode_key_data(data))
+        if suffix:
+            generation, namespace_generation = await self.aget_generations(None, suffix)
+            return f"{self.prefix}:{generation}:{suffix}.{namespace_generation}_{hash}"
+        return await self._aprefix_key(hash)
+
     def get(self, key: str):
+        started = time.perf_counter()
         try:
             key = self._prefix_key(key)
-            cached_data = self.cache.get(key)
+            cached_data = self._get_local(key)
+            if cached_data is _MISSING:
+                cached_data = self._after_get(key, self.cache.get(key), started)
+            return cached_data
+        except Exception:
+            logger.warning(f"Cant get cache for key: {key}", exc_info=True)
+            self.metrics.incr("errors")
+            return None
+
+    async def aget(self, key: str):
+        started = time.perf_counter()
+        try:
+            key = await self._aprefix_key(key)
+            cached_data = self._get_local(key)
+            if cached_data is _MISSING:
+                cached_data = self._after_get(key, await self.cache.aget(key), started)
             return cached_data
         except Exception:
-            print(f"Cant get cache for key: {key}")
+            logger.warning(f"Cant get cache for key: {key}", exc_info=True)
+            self.metrics.incr("errors")
             return None
 
+    def _get_local(self, key: str):
+        if self.local is None:
+            return _MISSING
+        cached_data = self.local.get(key, _MISSING)
+        self.metrics.incr("local_hits" if cached_data is not _MISSING else "local_misses")
+        return cached_data
+
+    def _after_get(self, key: str, cached_data: Any, started: float):
+        self.metrics.incr("hits" if cached_data is not None else "misses")
+        self.metrics.observe("get_ms", (time.perf_counter() - started) * 1000)
+        if cached_data is not None and self.local is not None:
+            self.local.set(key, cached_data)
+        return cached_data
+
     def set(self, key: str | dict, value: Any, timeout: Optional[float] = None):
         try:
             if isinstance(key, dict):
                 key = self.generate_key(key)
             key = self._prefix_key(key)
             timeout = timeout or self.timeout
-            return self.cache.set(key, value, timeout)
+            started = time.perf_counter()
+            result = self.cache.set(key, value, timeout)
+            self._after_set(key, value, timeout, started)
+            return result
         except Exception:
-            print(f"Cant set cache for key: {key}")
+            logger.warning(f"Cant set cache for key: {key}", exc_info=True)
+            self.metrics.incr("errors")
             return False
 
-    def delete(self, key: str):
+    async def aset(self, key: str | dict, value: Any, timeout: Optional[float] = None):
         try:
-            key = self._prefix_key(key)
-            return self.cache.delete(key)
+            if isinstance(key, dict):
+                key = await self.agenerate_key(key)
+            key = await self._aprefix_key(key)
+            timeout = timeout or self.timeout
+            started = time.perf_counter()
+            result = await self.cache.aset(key, value, timeout)
+            self._after_set(key, value, timeout, started)
+            return result
         except Exception:
-            print(f"Cant delete cache for key: {key}")
+            logger.warning(f"Cant set cache for key: {key}", exc_info=True)
+            self.metrics.incr("errors")
             return False
 
-    def delete_pattern(self, pattern: str, suffix: str = ""):
+    def _after_set(self, key: str, value: Any, timeout: float, started: float):
+        self.metrics.observe("set_ms", (time.perf_counter() - started) * 1000)
+        self.metrics.observe("value_bytes", _value_size(value), SIZE_BUCKETS)
+        self.metrics.incr("sets")
+        if self.local is not None:
+            self.local.set(key, value, timeout)
+
+    def get_or_compute(
+        self,
+        key: str,
+        fn: Callable[[], Any],
+        timeout: Optional[float] = None,
+        stale_timeout: Optional[float] = None,
+        lock_timeout: Optional[float] = None,
+        beta: float = 1.0,
+    ):
+        """
+        Get the value for key, computing it with fn() when it is missing or expired.
+
+        Values are stored with the time they took to compute and when they go stale, and
+        are kept `stale_timeout` seconds past that. Only the caller holding the lock (a
+        backend `add`, so it also works across processes on a shared backend) runs fn();
+        everyone else gets the stale value, or waits for the fresh one on a cold miss.
+        Callers may also refresh a little early, more likely the closer the value is to
+        going stale and the slower it is to compute (XFetch, scaled by beta).
+        """
+        try:
+            key = self._prefix_key(key)
+        except Exception:
+            logger.warning(f"Cant get cache for key: {key}", exc_info=True)
+            return fn()
+        timeout, stale_timeout, lock_timeout = self._compute_timeouts(
+            timeout, stale_timeout, lock_timeout
+        )
+
+        entry = self.get(key)
+        if entry is not None:
+            value, delta, expires_at = entry
+            if self._is_fresh(delta, expires_at, beta):
+                return value
+            if not self._acquire_lock(key, lock_timeout):
+                return value
+            return self._compute(key, fn, timeout, stale_timeout)
+
+        if self._acquire_lock(key, lock_timeout):
+            return self._compute(key, fn, timeout, stale_timeout)
+
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            entry = self.get(key)
+            if entry is not None:
+                return entry[0]
+        return fn()
+
+    async def aget_or_compute(
+        self,
+        key: str,
+        fn: Callable[[], Awaitable[Any]],
+        timeout: Optional[float] = None,
+        stale_timeout: Optional[float] = None,
+        lock_timeout: Optional[float] = None,
+        beta: float = 1.0,
+    ):
+        """get_or_compute for coroutine functions, sharing its entries and locks"""
         try:
-            if not pattern.endswith("*"):
-                pattern += "*"
-            pattern = self._prefix_key(pattern)
-            if hasattr(self.cache, "delete_pattern"):
-                return self.cache.delete_pattern(pattern)
-            if hasattr(self.cache, "keys"):
-                keys = self.cache.keys(pattern)
-                if keys:
-                    return self.cache.delete_many(keys)
-            # clear all if pattern matching or not supported
-            return self.cache.clear()
+            key = await self._aprefix_key(key)
         except Exception:
-            print(f"Cant delete cache for pattern or the pattern doesnt support: {pattern}")
-            return False
+            logger.warning(f"Cant get cache for key: {key}", exc_info=True)
+            return await fn()
+        timeout, stale_timeout, lock_timeout = self._compute_timeouts(
+            timeout, stale_timeout, lock_timeout
+        )
 
-    def clear(self):
+        entry = await self.aget(key)
+        if entry is not None:
+            value, delta, expires_at = entry
+            if self._is_fresh(delta, expires_at, beta):
+                return value
+            if not await self._aacquire_lock(key, lock_timeout):
+                return value
+            return await self._acompute(key, fn, timeout, stale_timeout)
+
+        if await self._aacquire_lock(key, lock_timeout):
+            return await self._acompute(key, fn, timeout, stale_timeout)
+
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            entry = await self.aget(key)
+            if entry is not None:
+                return entry[0]
+        return await fn()
+
+    def _compute_timeouts(
+        self,
+        timeout: Optional[float],
+        stale_timeout: Optional[float],
+        lock_timeout: Optional[float],
+    ) -> tuple[float, float, float]:
+        timeout = timeout or self.timeout
+        if stale_timeout is None:
+            stale_timeout = getattr(settings, "CACHE_STALE_TIMEOUT", STALE_TIMEOUT)
+        lock_timeout = lock_timeout or getattr(settings, "CACHE_LOCK_TIMEOUT", LOCK_TIMEOUT)
+        return timeout, stale_timeout, lock_timeout
+
+    @staticmethod
+    def _is_fresh(delta: float, expires_at: float, beta: float) -> bool:
+        return time.time() - delta * beta * math.log(1.0 - random.random()) < expires_at
+
+    def get_or_render(
+        self, key: str, schema: type[Schema], fn: Callable[[], Any], **kwargs
+    ) -> bytes:
+        """
+        get_or_compute for response payloads: fn()'s result is validated against the
+        response schema once and the final JSON bytes are cached, so a hit needs
+        neither unpickling model instances nor pydantic serialization.
+        """
+
+        def render() -> bytes:
+            data = schema.model_validate(fn()).model_dump()
+            return json.dumps(data, cls=NinjaJSONEncoder).encode()
+
+        key = f"{self._prefix_key(key)}:{schema_version(schema)}"
+        return self.get_or_compute(key, render, **kwargs)
+
+    def _compute(self, key: str, fn: Callable[[], Any], timeout: float, stale_timeout: float):
+        try:
+            started = time.monotonic()
+            value = fn()
+            delta = time.monotonic() - started
+            self.set(key, (value, delta, time.time() + timeout), timeout + stale_timeout)
+            return value
+        finally:
+            self._release_lock(key)
+
+    async def _acompute(
+        self, key: str, fn: Callable[[], Awaitable[Any]], timeout: float, stale_timeout: float
+    ):
+        try:
+            started = time.monotonic()
+            value = await fn()
+            delta = time.monotonic() - started
+            await self.aset(key, (value, delta, time.time() + timeout), timeout + stale_timeout)
+            return value
+        finally:
+            await self._arelease_lock(key)
+
+    def _acquire_lock(self, key: str, timeout: float) -> bool:
+        try:
+            return bool(self.cache.add(f"{key}:lock", 1, timeout))
+        except Exception:
+            logger.warning(f"Cant lock cache for key: {key}", exc_info=True)
+            return True
+
+    def _release_lock(self, key: str):
+        try:
+            self.cache.delete(f"{key}:lock")
+        except Exception:
+            logger.warning(f"Cant unlock cache for key: {key}", exc_info=True)
+
+    async def _aacquire_lock(self, key: str, timeout: float) -> bool:
         try:
-            return self.delete_pattern("*")
+            return bool(await self.cache.aadd(f"{key}:lock", 1, timeout))
         except Exception:
-            print("Cant clear cache")
+            logger.warning(f"Cant lock cache for key: {key}", exc_info=True)
+            return True
+
+    async def _arelease_lock(self, key: str):
+        try:
+            await self.cache.adelete(f"{key}:lock")
+        except Exception:
+            logger.warning(f"Cant unlock cache for key: {key}", exc_info=True)
+
+    def delete(self, key: str):
+        try:
+            key = self._prefix_key(key)
+            if self.local is not None:
+                self.local.delete(key)
+            self.metrics.incr("deletes")
+            return self.cache.delete(key)
+        except Exception:
+            logger.warning(f"Cant delete cache for key: {key}", exc_info=True)
+            self.metrics.incr("errors")
             return False
+
+    def delete_pattern(self, pattern: str, suffix: str = ""):
+        """
+        Invalidate the keys matching the pattern. The pattern names the generate_key
+        suffix to drop, e.g. "product_list*" or "*<file_hash>*"; an empty pattern or
+        one with a wildcard in the middle drops the whole prefix.
+        """
+        namespace = pattern
+        if namespace.startswith(f"{self.prefix}:"):
+            namespace = namespace[len(self.prefix) + 1 :]
+        namespace = namespace.strip("*").strip("_:")
+        if "*" in namespace:
+            namespace = None
+        return self.invalidate(namespace or None)
+
+    def clear(self):
+        return self.invalidate()
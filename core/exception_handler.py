@@ -10,7 +10,7 @@ from ninja_extra.exceptions import NotAuthenticated
 from ninja_jwt.exceptions import InvalidToken as NinjaJwtInvalidToken
 from pydantic import ValidationError as PydanticValidationError
 
-from core.exceptions import NotFound, Unauthorized
+from core.exceptions import NotFound, ServiceUnavailable, Unauthorized
 from core.exceptions import InvalidToken, TokenExpired
 from core.permissions import PermissionDenied
 
@@ -212,6 +212,16 @@ class APIExceptionHandler:
 
         return self.create_error_response(request=request, message=message, status=500)
 
+    def _service_unavailable(self, request: HttpRequest, exc: ServiceUnavailable) -> HttpResponse:
+        """
+        Handles overload, telling the client when to retry
+        """
+        self.log_exception(request, exc, 503)
+        message = self._get_exception_message(exc, "Service temporarily unavailable")
+        response = self.create_error_response(request=request, message=message, status=503)
+        response["Retry-After"] = str(exc.retry_after)
+        return response
+
     def _permission_exception(self, request: HttpRequest, exc: PermissionDenied) -> HttpResponse:
         """
         Handles exceptions raised from permission checks
@@ -248,6 +258,8 @@ class APIExceptionHandler:
 
         self.register_handler(PermissionDenied, self._permission_exception)
 
+        self.register_handler(ServiceUnavailable, self._service_unavailable)
+
         self.register_handler(
             DangoPermissionDenied,
             self.create_custom_handler(
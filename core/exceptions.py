@@ -39,3 +39,11 @@ class NotFound(BaseException):
 
     def __init__(self, message="Resource not found"):
         super().__init__(message)
+
+
+class ServiceUnavailable(BaseException):
+    """Exception raised when the server is too busy to handle the request right now."""
+
+    def __init__(self, message="Service temporarily unavailable", retry_after: int = 5):
+        self.retry_after = retry_after
+        super().__init__(message)
@@ -0,0 +1,54 @@
+import json
+from hashlib import md5
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from apps.products.schemas import ProductFilters
+from core.benchmarks import measure
+from core.cache import KEY_HASHERS, Cache, encode_key_data
+from core.pagination import CountMode
+
+
+class Command(BaseCommand):
+    help = "Time Cache.generate_key and its encoder and hashers on the product listing key path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=10000, help="Calls per measurement")
+
+    def handle(self, *args, **options):
+        calls = options["calls"]
+        filters = ProductFilters(
+            search="oak chair",
+            category="garden-tools",
+            min_price=10,
+            max_price=250.5,
+            in_stock=True,
+            sort="price_asc",
+            page_size=20,
+        )
+        # what ProductService.get_products builds its key from
+        data = {"page": 1, "page_size": 20, "count_mode": CountMode.CACHED, **filters.dict()}
+        encoded = encode_key_data(data)
+        cache = Cache(prefix="bench", backend=LocMemCache("bench", {}))
+
+        def before():
+            # the key path this replaced
+            return md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+        cases = [
+            ("json.dumps + md5 (before)", before),
+            ("encode_key_data", lambda: encode_key_data(data)),
+        ]
+        for name, hasher in KEY_HASHERS.items():
+            cases.append((f"hash: {name}", lambda hasher=hasher: hasher(encoded)))
+        cases.append(("generate_key", lambda: cache.generate_key(data)))
+        cases.append(("generate_key with suffix", lambda: cache.generate_key(data, "list")))
+
+        self.stdout.write(f"{'case':<36}{'median':>12}{'p95':>12}  (per call)")
+        for label, fn in cases:
+            result = measure(lambda fn=fn: [fn() for _ in range(calls)], repeat=10)
+            self.stdout.write(
+                f"{label:<36}{result['median_ms'] * 1000 / calls:>10.2f}us"
+                f"{result['p95_ms'] * 1000 / calls:>10.2f}us"
+            )
@@ -0,0 +1,80 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core.metrics import flush_all, read_metrics, reset_metrics
+
+CACHE_NAMESPACE = "cache"
+
+
+class Command(BaseCommand):
+    help = (
+        "Show hit/miss/latency/size metrics for each core.cache.Cache prefix, or the "
+        "metrics of another namespace with --namespace (e.g. --namespace images)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--namespace",
+            default=CACHE_NAMESPACE,
+            help=f"Metrics namespace to read, defaults to the cache metrics ({CACHE_NAMESPACE})",
+        )
+        parser.add_argument("--prefix", help="Only show this cache prefix or sub-namespace")
+        parser.add_argument("--json", action="store_true", help="Print the raw metrics as JSON")
+        parser.add_argument("--reset", action="store_true", help="Reset the metrics afterwards")
+
+    def handle(self, *args, **options):
+        flush_all()
+        namespace = f"{options['namespace']}:{options['prefix'] or ''}"
+        metrics = read_metrics(namespace)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(metrics, indent=2))
+        elif not metrics:
+            self.stdout.write(f"No {options['namespace']} metrics recorded yet.")
+        elif options["namespace"] != CACHE_NAMESPACE:
+            for name, values in metrics.items():
+                self._write_metrics(name, values)
+        else:
+            self.stdout.write(
+                f"{'prefix':<20}{'hits':>10}{'misses':>10}{'hit %':>8}{'L1 hits':>10}"
+                f"{'sets':>8}{'inval':>8}{'evict':>8}{'errors':>8}"
+                f"{'get p95':>10}{'set p95':>10}{'avg size':>10}"
+            )
+            for name, values in metrics.items():
+                self.stdout.write(self._row(name.split(":", 1)[1], values))
+
+        if options["reset"]:
+            reset_metrics(namespace)
+            self.stdout.write(self.style.SUCCESS(f"Metrics reset for {namespace}*."))
+
+    def _write_metrics(self, name: str, values: dict):
+        """Counters and histogram summaries of a namespace the cache table does not fit"""
+        self.stdout.write(self.style.MIGRATE_HEADING(name))
+        for counter, value in sorted(values["counters"].items()):
+            self.stdout.write(f"  {counter:<30}{value:>10}")
+        for histogram, summary in sorted(values["histograms"].items()):
+            self.stdout.write(
+                f"  {histogram:<30}{summary['count']:>10}  avg {summary['avg']}  "
+                f"p50 {summary['p50']}  p95 {summary['p95']}  p99 {summary['p99']}"
+            )
+
+    @staticmethod
+    def _row(prefix: str, values: dict) -> str:
+        counters = values["counters"]
+        histograms = values["histograms"]
+        hits = counters.get("hits", 0) + counters.get("local_hits", 0)
+        misses = counters.get("misses", 0)
+        ratio = f"{hits / (hits + misses) * 100:.1f}" if hits + misses else "-"
+
+        def p95(name):
+            value = histograms.get(name, {}).get("p95")
+            return f"{value}ms" if value is not None else "-"
+
+        size = histograms.get("value_bytes", {}).get("avg")
+        return (
+            f"{prefix:<20}{hits:>10}{misses:>10}{ratio:>8}{counters.get('local_hits', 0):>10}"
+            f"{counters.get('sets', 0):>8}{counters.get('invalidations', 0):>8}"
+            f"{counters.get('local_evictions', 0):>8}{counters.get('errors', 0):>8}"
+            f"{p95('get_ms'):>10}{p95('set_ms'):>10}{f'{size:.0f}B' if size else '-':>10}"
+        )
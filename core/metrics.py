@@ -0,0 +1,219 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+
+from core.utils import get_seconds
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY_PREFIX = "__metrics__"
+NAMESPACES_KEY = f"{METRICS_KEY_PREFIX}:namespaces"
+FLUSH_INTERVAL = get_seconds(seconds=10)
+LOCK_TIMEOUT = get_seconds(seconds=5)
+
+LATENCY_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)  # milliseconds
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # bytes
+
+
+class Metrics:
+    """
+    Counters and histograms for one namespace (e.g. "cache:products").
+
+    Numbers are collected in process and merged into the shared django cache every
+    METRICS_FLUSH_INTERVAL seconds, so the management command and the API can read the
+    totals of every worker. That only works across processes with a shared backend;
+    with LocMemCache each process only sees its own numbers.
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.enabled = getattr(settings, "METRICS_ENABLED", True)
+        self.flush_interval = getattr(settings, "METRICS_FLUSH_INTERVAL", FLUSH_INTERVAL)
+        self._counters: dict[str, int] = {}
+        self._histograms: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def incr(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+        self._maybe_flush()
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = _new_histogram(buckets)
+                self._histograms[name] = histogram
+            _add_to_histogram(histogram, value)
+        self._maybe_flush()
+
+    def snapshot(self) -> dict:
+        """Numbers collected in this process since the last flush"""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {
+                    name: {**histogram, "counts": list(histogram["counts"])}
+                    for name, histogram in self._histograms.items()
+                },
+            }
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Merge what this process collected into the shared totals"""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            counters, self._counters = self._counters, {}
+            histograms, self._histograms = self._histograms, {}
+        if not counters and not histograms:
+            return
+
+        key = f"{METRICS_KEY_PREFIX}:{self.namespace}"
+        try:
+            # registered first, a failure then leaves the totals untouched for the retry
+            _register_namespace(self.namespace)
+            with _locked(key):
+                totals = django_cache.get(key) or {"counters": {}, "histograms": {}}
+                _merge(totals, {"counters": counters, "histograms": histograms})
+                django_cache.set(key, totals, timeout=None)
+        except Exception as e:
+            logger.debug(f"Could not flush metrics for {self.namespace}: {e}")
+            # keep the numbers for the next flush
+            with self._lock:
+                _merge(
+                    {"counters": self._counters, "histograms": self._histograms},
+                    {"counters": counters, "histograms": histograms},
+                )
+
+
+_registry: dict[str, Metrics] = {}
+_registry_lock = threading.Lock()
+
+
+def get_metrics(namespace: str) -> Metrics:
+    with _registry_lock:
+        metrics = _registry.get(namespace)
+        if metrics is None:
+            metrics = _registry[namespace] = Metrics(namespace)
+        return metrics
+
+
+def flush_all():
+    for metrics in list(_registry.values()):
+        metrics.flush()
+
+
+def read_metrics(prefix: Optional[str] = None) -> dict[str, dict]:
+    """Shared totals per namespace, optionally only the namespaces starting with prefix"""
+    namespaces = django_cache.get(NAMESPACES_KEY) or []
+    if prefix:
+        namespaces = [namespace for namespace in namespaces if namespace.startswith(prefix)]
+    keys = {f"{METRICS_KEY_PREFIX}:{namespace}": namespace for namespace in namespaces}
+    found = django_cache.get_many(list(keys))
+    return {keys[key]: summarize(totals) for key, totals in sorted(found.items())}
+
+
+def reset_metrics(prefix: Optional[str] = None):
+    with _locked(NAMESPACES_KEY, wait=True):
+        namespaces = django_cache.get(NAMESPACES_KEY) or []
+        remaining = []
+        for namespace in namespaces:
+            if prefix and not namespace.startswith(prefix):
+                remaining.append(namespace)
+                continue
+            django_cache.delete(f"{METRICS_KEY_PREFIX}:{namespace}")
+        django_cache.set(NAMESPACES_KEY, remaining, timeout=None)
+
+
+def summarize(totals: dict) -> dict:
+    """Counters as they are, histograms as count/avg/p50/p95/p99 plus the raw buckets"""
+    histograms = {}
+    for name, histogram in totals.get("histograms", {}).items():
+        count = sum(histogram["counts"])
+        histograms[name] = {
+            "count": count,
+            "avg": histogram["sum"] / count if count else None,
+            "p50": _percentile(histogram, 0.50),
+            "p95": _percentile(histogram, 0.95),
+            "p99": _percentile(histogram, 0.99),
+            "buckets": dict(zip([*map(str, histogram["buckets"]), "inf"], histogram["counts"])),
+        }
+    return {"counters": dict(totals.get("counters", {})), "histograms": histograms}
+
+
+def _new_histogram(buckets: tuple) -> dict:
+    return {"buckets": tuple(buckets), "counts": [0] * (len(buckets) + 1), "sum": 0.0}
+
+
+def _add_to_histogram(histogram: dict, value: float, count: int = 1):
+    histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += count
+    histogram["sum"] += value * count
+
+
+def _percentile(histogram: dict, quantile: float) -> Optional[float]:
+    """Upper bound of the bucket holding the quantile, None when it is the overflow bucket"""
+    total = sum(histogram["counts"])
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(histogram["buckets"], histogram["counts"]):
+        seen += count
+        if seen >= total * quantile:
+            return bound
+    return None
+
+
+def _merge(totals: dict, deltas: dict):
+    counters = totals.setdefault("counters", {})
+    for name, value in deltas.get("counters", {}).items():
+        counters[name] = counters.get(name, 0) + value
+
+    histograms = totals.setdefault("histograms", {})
+    for name, delta in deltas.get("histograms", {}).items():
+        histogram = histograms.get(name)
+        if histogram is None or tuple(histogram["buckets"]) != tuple(delta["buckets"]):
+            histograms[name] = {**delta, "counts": list(delta["counts"])}
+            continue
+        histogram["counts"] = [a + b for a, b in zip(histogram["counts"], delta["counts"])]
+        histogram["sum"] += delta["sum"]
+
+
+def _register_namespace(namespace: str):
+    if namespace in (django_cache.get(NAMESPACES_KEY) or []):
+        return
+    # read again under the lock, so namespaces two workers add at once are both kept
+    with _locked(NAMESPACES_KEY):
+        namespaces = django_cache.get(NAMESPACES_KEY) or []
+        if namespace not in namespaces:
+            django_cache.set(NAMESPACES_KEY, [*namespaces, namespace], timeout=None)
+
+
+@contextmanager
+def _locked(key: str, wait: bool = False):
+    """
+    Hold the shared lock for `key`. Busy locks raise RuntimeError, or with `wait` are
+    retried for up to LOCK_TIMEOUT seconds first.
+    """
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while not django_cache.add(f"{key}:lock", 1, LOCK_TIMEOUT):
+        if not wait or time.monotonic() >= deadline:
+            raise RuntimeError(f"{key} is being updated by another worker")
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        django_cache.delete(f"{key}:lock")
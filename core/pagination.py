@@ -1,51 +1,266 @@
-from django.core.paginator import EmptyPage, PageNotAnInteger
-from django.core.paginator import Paginator as DjangoPaginator
-from django.db.models import QuerySet
+import json
+import math
+from enum import Enum
+from typing import Optional
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Field, Model, Q, QuerySet
 from django.http import HttpRequest
 
+from core.cache import Cache
+from core.utils import get_seconds
+
+CURSOR_SALT = "core.pagination.cursor"
+DEFAULT_ORDERING = ("-created_at", "-id")
+
+count_cache = Cache(
+    prefix="pagination_count",
+    timeout=float(getattr(settings, "PAGINATION_COUNT_TIMEOUT", get_seconds(minutes=1))),
+)
+
+
+class CountMode(str, Enum):
+    """How a paginated listing works out its total count"""
+
+    EXACT = "exact"  # COUNT(*) on every request
+    CACHED = "cached"  # COUNT(*) cached per filter fingerprint
+    ESTIMATED = "estimated"  # planner estimate where the backend has one, else cached
+    NONE = "none"  # no count, only has_more
+
 
 class Paginator:
+    """
+    Paginates a queryset either by page number (offset) or by an opaque cursor (keyset).
+
+    Cursor pages seek on the `ordering` fields instead of using OFFSET, so every page
+    costs the same no matter how deep it is. Offset pages still work and also return
+    cursors so clients can switch over from the first page.
+    """
+
     def __init__(
         self,
         request: HttpRequest,
         queryset: QuerySet,
         page_size: int = 10,
+        ordering: tuple[str, ...] = DEFAULT_ORDERING,
+        count_mode: Optional[CountMode] = None,
     ):
         self.request = request
-        self.queryset = queryset
         self.page_size = page_size
         if not isinstance(self.page_size, int) or self.page_size <= 0:
             self.page_size = 10
-        self.paginator = DjangoPaginator(self.queryset, self.page_size)
+        self.ordering = tuple(ordering)
+        self.queryset = queryset.order_by(*self.ordering)
+        self.count_mode = CountMode(
+            count_mode or getattr(settings, "PAGINATION_COUNT_MODE", CountMode.EXACT)
+        )
+
+    def get_page(self, page_num: int = 1, cursor: str = None):
+        """
+        Get a page by number, or by cursor when one is given. A page past the end is
+        empty in every count mode.
+        """
+        if cursor:
+            return self.get_cursor_page(cursor)
 
-    def get_page(self, page_num: int = 1):
-        """ """
         try:
-            page_obj = self.paginator.page(page_num)
-        except PageNotAnInteger:
-            page_obj = self.paginator.page(1)
-        except EmptyPage:
-            page_obj = self.paginator.page(self.paginator.num_pages)
+            page_num = max(int(page_num), 1)
+        except (TypeError, ValueError):
+            page_num = 1
 
-        query_params = self.request.GET.copy()
+        # fetch one extra row to know if there is a next page without counting
+        offset = (page_num - 1) * self.page_size
+        data = list(self.queryset[offset : offset + self.page_size + 1])
+        has_next = len(data) > self.page_size
+        data = data[: self.page_size]
+
+        count = self.get_count()
+        total_pages = None
+        if count is not None:
+            # an empty listing still has its one (empty) page
+            total_pages = max(math.ceil(count / self.page_size), 1)
+        return self._offset_response(data, page_num, has_next, count, total_pages)
+
+    def _offset_response(
+        self,
+        data: list,
+        page_num: int,
+        has_next: bool,
+        count: Optional[int],
+        total_pages: Optional[int],
+    ):
         next_url = None
         prev_url = None
+        next_cursor = None
+        previous_cursor = None
 
-        if page_obj.has_next():
-            query_params["page"] = page_obj.next_page_number()
-            next_url = f"{self.request.path}?{query_params.urlencode()}"
+        if has_next:
+            next_url = self._build_url(page=page_num + 1)
+            next_cursor = self._encode_cursor(data[-1]) if data else None
 
-        if page_obj.has_previous():
-            query_params["page"] = page_obj.previous_page_number()
-            next_url = f"{self.request.path}?{query_params.urlencode()}"
+        if page_num > 1:
+            prev_url = self._build_url(page=page_num - 1)
+            previous_cursor = self._encode_cursor(data[0], reverse=True) if data else None
 
-        data = page_obj.object_list
         return {
-            "count": self.paginator.count,
+            "count": count,
             "next": next_url,
             "previous": prev_url,
-            "page": page_obj.number,
+            "next_cursor": next_cursor,
+            "previous_cursor": previous_cursor,
+            "has_more": has_next,
+            "page": page_num,
             "page_size": self.page_size,
-            "total_pages": self.paginator.num_pages,
-            "data": list(data),
+            "total_pages": total_pages,
+            "data": data,
         }
+
+    def get_count(self) -> Optional[int]:
+        """Total number of rows, worked out according to the count mode"""
+        if self.count_mode == CountMode.NONE:
+            return None
+        if self.count_mode == CountMode.ESTIMATED:
+            estimate = self._estimate_count()
+            if estimate is not None:
+                return estimate
+        if self.count_mode in (CountMode.CACHED, CountMode.ESTIMATED):
+            return self._cached_count()
+        return self.queryset.count()
+
+    def _cached_count(self) -> int:
+        try:
+            sql, params = self.queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        key = count_cache.generate_key({"sql": sql, "params": [str(p) for p in params]})
+        count = count_cache.get(key)
+        if count is None:
+            count = self.queryset.count()
+            count_cache.set(key, count)
+        return count
+
+    def _estimate_count(self) -> Optional[int]:
+        """
+        Read the row estimate from the query planner. Only PostgreSQL is supported, and
+        small estimates are ignored since they are cheap to count and often way off.
+        """
+        if connections[self.queryset.db].vendor != "postgresql":
+            return None
+        try:
+            plan = json.loads(self.queryset.explain(format="json"))
+            if isinstance(plan, list):
+                plan = plan[0]
+            estimate = int(plan["Plan"]["Plan Rows"])
+        except Exception:
+            return None
+        threshold = getattr(settings, "PAGINATION_ESTIMATE_THRESHOLD", 1000)
+        return estimate if estimate >= threshold else None
+
+    def get_cursor_page(self, cursor: str):
+        """Get the page that starts right after (or right before) the cursor position"""
+        values, reverse = self._decode_cursor(cursor)
+        ordering = self._reverse_ordering() if reverse else self.ordering
+        queryset = self.queryset.filter(self._seek_filter(values, reverse)).order_by(*ordering)
+
+        # fetch one extra row to know if there is more after this page
+        data = list(queryset[: self.page_size + 1])
+        has_more = len(data) > self.page_size
+        data = data[: self.page_size]
+
+        if reverse:
+            data.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, True
+
+        next_cursor = self._encode_cursor(data[-1]) if has_next and data else None
+        previous_cursor = (
+            self._encode_cursor(data[0], reverse=True) if has_previous and data else None
+        )
+
+        return {
+            "count": None,
+            "next": self._build_url(cursor=next_cursor) if next_cursor else None,
+            "previous": self._build_url(cursor=previous_cursor) if previous_cursor else None,
+            "next_cursor": next_cursor,
+            "previous_cursor": previous_cursor,
+            "has_more": has_next,
+            "page": None,
+            "page_size": self.page_size,
+            "total_pages": None,
+            "data": data,
+        }
+
+    def _build_url(self, page: int = None, cursor: str = None) -> str:
+        query_params = self.request.GET.copy()
+        query_params.pop("page", None)
+        query_params.pop("cursor", None)
+        if cursor:
+            query_params["cursor"] = cursor
+        elif page:
+            query_params["page"] = page
+        return f"{self.request.path}?{query_params.urlencode()}"
+
+    def _field_names(self) -> list[str]:
+        return [field.lstrip("-") for field in self.ordering]
+
+    def _reverse_ordering(self) -> tuple[str, ...]:
+        return tuple(f[1:] if f.startswith("-") else f"-{f}" for f in self.ordering)
+
+    def _get_field(self, name: str) -> Optional[Field]:
+        """The model field behind an ordering name, None for annotations like a search rank"""
+        if name in self.queryset.query.annotations:
+            return None
+        return self.queryset.model._meta.get_field(name)
+
+    def _encode_cursor(self, obj: Model, reverse: bool = False) -> str:
+        values = []
+        for name in self._field_names():
+            field = self._get_field(name)
+            # annotation values go into the cursor as they are, they must be JSON types
+            values.append(field.value_to_string(obj) if field else getattr(obj, name))
+        payload = {"o": list(self.ordering), "v": values, "r": reverse}
+        return signing.dumps(payload, salt=CURSOR_SALT, compress=True)
+
+    def _decode_cursor(self, cursor: str) -> tuple[list, bool]:
+        try:
+            payload = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            raise ValueError("Invalid pagination cursor.")
+
+        if not isinstance(payload, dict) or payload.get("o") != list(self.ordering):
+            raise ValueError("Pagination cursor does not match the requested ordering.")
+
+        try:
+            values = []
+            for name, value in zip(self._field_names(), payload["v"], strict=True):
+                field = self._get_field(name)
+                values.append(field.to_python(value) if field else value)
+        except Exception:
+            raise ValueError("Invalid pagination cursor.")
+        return values, bool(payload.get("r"))
+
+    def _seek_filter(self, values: list, reverse: bool) -> Q:
+        """
+        Build the keyset condition for rows after `values` in the current ordering, i.e.
+        (a > x) OR (a = x AND b > y) OR ... with the comparison flipped per direction.
+
+        The ORs alone make databases scan the index from its start, so the redundant
+        a >= x goes in front of them to turn the seek into an index range.
+        """
+        names = self._field_names()
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            descending = field.startswith("-") != reverse
+            lookup = "lt" if descending else "gt"
+            clause = Q(**{f"{names[i]}__{lookup}": values[i]})
+            for name, value in zip(names[:i], values[:i]):
+                clause &= Q(**{name: value})
+            condition |= clause
+        if len(names) == 1:
+            return condition
+        descending = self.ordering[0].startswith("-") != reverse
+        return Q(**{f"{names[0]}__{'lte' if descending else 'gte'}": values[0]}) & condition
@@ -25,6 +25,14 @@ class BasePermission:
         raise self.exception(message=message, status_code=status_code)
 
 
+class IsAdminUser(BasePermission):
+    message = "Only staff users can perform this action."
+
+    def has_permission(self, request: HttpRequest, view_func: Any = None) -> bool:
+        user = getattr(request, "auth", None)
+        return bool(user and getattr(user, "is_staff", False))
+
+
 def check_permissions(
     request: HttpRequest,
     permissions: Union[list[BasePermission], BasePermission],
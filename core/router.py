@@ -1,8 +1,10 @@
+import asyncio
 from enum import Enum
 from functools import wraps
 import types
 from typing import Any, List, Union
 
+from asgiref.sync import sync_to_async
 from ninja import Router
 from ninja.constants import NOT_SET
 
@@ -122,6 +124,15 @@ class CustomRouter(Router):
                     check_permissions(request, permissions, view_func)
                 return view_func(*view_args, **view_kwargs)
 
+            if asyncio.iscoroutinefunction(view_func):
+                # ninja only awaits views that are coroutine functions themselves
+                @wraps(view_func)
+                async def wrapped_view_func(*view_args, **view_kwargs):
+                    request = view_args[0]
+                    if permissions:
+                        await sync_to_async(check_permissions)(request, permissions, view_func)
+                    return await view_func(*view_args, **view_kwargs)
+
             self.add_api_operation(
                 path, methods, wrapped_view_func, response=processed_response, **kwargs
             )
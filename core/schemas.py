@@ -1,5 +1,5 @@
 from ninja import Schema, Field
-from typing import Dict, Generic, List, Optional, TypeVar
+from typing import Any, Dict, Generic, List, Optional, TypeVar
 
 T = TypeVar("T", bound=Schema)
 
@@ -43,16 +43,26 @@ class BadRequestResponseSchema(BaseSchema):
     message: str = "Bad request"
 
 
+class MetricsResponseSchema(BaseSchema):
+    data: Dict[str, Any]
+
+
 class PaginatedResponseSchema(BaseSchema, Generic[T]):
-    count: int
+    count: Optional[int] = None
     next: Optional[str] = None
     previous: Optional[str] = None
-    page: int
+    next_cursor: Optional[str] = None
+    previous_cursor: Optional[str] = None
+    has_more: bool = False
+    page: Optional[int] = None
     page_size: int = 10
-    total_pages: int
+    total_pages: Optional[int] = None
     data: List[T]
 
 
 class PaginatedQueryParams(Schema):
     page: int = Field(1, ge=1, description="Page number")
     page_size: int = Field(10, ge=1, le=100, description="Number of items per page")
+    cursor: Optional[str] = Field(
+        None, description="Cursor from a previous response, takes precedence over page"
+    )
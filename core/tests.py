@@ -0,0 +1,471 @@
+import json
+import threading
+import time
+from datetime import date
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from uuid import UUID
+
+from django.core.cache import cache as django_cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
+from ninja import Schema
+
+from apps.products.models import Product
+from apps.users.models import CustomUser
+from core.cache import (
+    KEY_HASHERS,
+    Cache,
+    _value_size,
+    encode_key_data,
+    get_key_hasher,
+    schema_version,
+)
+from core.metrics import NAMESPACES_KEY, Metrics, flush_all, get_metrics, read_metrics, summarize
+from core.pagination import CountMode, Paginator
+
+
+class CursorPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for index in range(7):
+            CustomUser.objects.create(email=f"user{index}@example.com", username=f"user{index}")
+        # ties on created_at, so the id has to keep the order stable
+        CustomUser.objects.update(created_at=timezone.now())
+        cls.expected = list(CustomUser.objects.order_by("-created_at", "-id"))
+
+    def get_page(self, cursor=None, **kwargs):
+        request = RequestFactory().get("/api/users")
+        paginator = Paginator(
+            request, CustomUser.objects.all(), page_size=3, count_mode=CountMode.NONE, **kwargs
+        )
+        return paginator.get_page(1, cursor=cursor)
+
+    def test_next_cursors_walk_every_row_once(self):
+        page = self.get_page()
+        seen = list(page["data"])
+        while page["next_cursor"]:
+            page = self.get_page(page["next_cursor"])
+            seen.extend(page["data"])
+        self.assertEqual(seen, self.expected)
+        self.assertFalse(page["has_more"])
+        self.assertIn("cursor=", page["previous"])
+
+    def test_previous_cursor_returns_the_page_before(self):
+        first = self.get_page()
+        second = self.get_page(first["next_cursor"])
+        third = self.get_page(second["next_cursor"])
+        self.assertEqual(self.get_page(third["previous_cursor"])["data"], second["data"])
+        back = self.get_page(second["previous_cursor"])
+        self.assertEqual(back["data"], first["data"])
+        self.assertIsNone(back["previous_cursor"])
+
+    def test_rejects_tampered_or_foreign_cursors(self):
+        cursor = self.get_page()["next_cursor"]
+        with self.assertRaises(ValueError):
+            self.get_page(cursor[:-2] + "xx")
+        with self.assertRaises(ValueError):
+            self.get_page(cursor, ordering=("created_at", "id"))
+
+
+class OffsetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for index in range(5):
+            CustomUser.objects.create(email=f"user{index}@example.com", username=f"user{index}")
+
+    def get_page(self, page, count_mode):
+        request = RequestFactory().get("/api/users")
+        paginator = Paginator(request, CustomUser.objects.all(), page_size=2, count_mode=count_mode)
+        return paginator.get_page(page)
+
+    def test_page_past_the_end_is_empty_in_every_count_mode(self):
+        for count_mode in CountMode:
+            with self.subTest(count_mode=count_mode):
+                page = self.get_page(9, count_mode)
+                self.assertEqual(page["data"], [])
+                self.assertEqual(page["page"], 9)
+                self.assertFalse(page["has_more"])
+                last = self.get_page(3, count_mode)
+                self.assertEqual(len(last["data"]), 1)
+                if count_mode != CountMode.NONE:
+                    self.assertEqual((page["count"], page["total_pages"]), (5, 3))
+
+
+class CacheGenerationTests(SimpleTestCase):
+    def setUp(self):
+        self.backend = LocMemCache(f"generations-{self.id()}", {})
+        self.cache = Cache(prefix="things", timeout=60, backend=self.backend)
+
+    def test_invalidating_a_prefix_leaves_other_prefixes(self):
+        others = Cache(prefix="others", timeout=60, backend=self.backend)
+        self.cache.set("key", "value")
+        others.set("key", "other value")
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get("key"))
+        self.assertEqual(others.get("key"), "other value")
+
+    def test_invalidating_a_suffix_leaves_the_rest_of_the_prefix(self):
+        listing = self.cache.generate_key({"page": 1}, suffix="list")
+        detail = self.cache.generate_key({"id": 1}, suffix="detail")
+        self.cache.set(listing, "page")
+        self.cache.set(detail, "item")
+        self.cache.delete_pattern("list*")
+        self.assertIsNone(self.cache.get(self.cache.generate_key({"page": 1}, suffix="list")))
+        self.assertEqual(self.cache.get(detail), "item")
+
+    def test_generation_keys_expire_after_the_values(self):
+        with mock.patch.object(self.backend, "add", wraps=self.backend.add) as add:
+            self.cache.get_generation("namespace")
+        timeout = add.call_args.kwargs["timeout"]
+        self.assertIsNotNone(timeout)
+        self.assertGreater(timeout, self.cache.timeout)
+
+    def test_generations_are_read_from_the_backend_once_per_window(self):
+        self.cache.set("key", "value")
+        with mock.patch.object(self.backend, "get_many", wraps=self.backend.get_many) as get_many:
+            for _ in range(5):
+                self.cache.get("key")
+        get_many.assert_not_called()
+
+        # another worker bumps the generation, seen here once the local copy expires
+        Cache(prefix="things", timeout=60, backend=self.backend).invalidate()
+        self.assertEqual(self.cache.get("key"), "value")
+        self.cache.generations.clear()
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_generations_in_use_are_renewed(self):
+        self.cache.get_generation()
+        self.cache.generations.clear()
+        with mock.patch.object(self.backend, "touch", wraps=self.backend.touch) as touch:
+            self.cache.get_generation()
+            self.cache.generations.clear()
+            self.cache.get_generation()
+        touch.assert_not_called()
+
+        self.cache.renewed_generations.clear()
+        self.cache.generations.clear()
+        with mock.patch.object(self.backend, "touch", wraps=self.backend.touch) as touch:
+            self.cache.get_generation()
+        touch.assert_called_once_with(self.cache._generation_key(), self.cache.generation_timeout)
+
+
+def hex_key(data: bytes) -> str:
+    return data.hex()
+
+
+class CacheKeyTests(SimpleTestCase):
+    def setUp(self):
+        get_key_hasher.cache_clear()
+        self.addCleanup(get_key_hasher.cache_clear)
+
+    def test_dict_order_does_not_change_the_key(self):
+        first = {"page": 1, "filters": {"shop": "a", "category": "b"}}
+        second = {"filters": {"category": "b", "shop": "a"}, "page": 1}
+        self.assertEqual(encode_key_data(first), encode_key_data(second))
+        cache = Cache(prefix="keys")
+        self.assertEqual(cache.generate_key(first), cache.generate_key(second))
+
+    def test_equal_decimals_give_the_same_key(self):
+        keys = {encode_key_data({"price": Decimal(value)}) for value in ("10", "10.0", "10.00")}
+        self.assertEqual(keys, {b'{"price":"10"}'})
+        self.assertNotEqual(
+            encode_key_data({"price": Decimal("10.5")}), encode_key_data({"price": Decimal("10")})
+        )
+
+    def test_uuid_enum_date_and_set_values(self):
+        data = {
+            "id": UUID("12345678-1234-5678-1234-567812345678"),
+            "mode": CountMode.CACHED,
+            "day": date(2024, 1, 31),
+            "tags": {"b", "a", "c"},
+        }
+        self.assertEqual(
+            json.loads(encode_key_data(data)),
+            {
+                "id": "12345678-1234-5678-1234-567812345678",
+                "mode": "cached",
+                "day": "2024-01-31",
+                "tags": ["a", "b", "c"],
+            },
+        )
+
+    def test_unsupported_values_raise_type_error(self):
+        with self.assertRaisesMessage(TypeError, "Cannot use object in a cache key"):
+            encode_key_data({"value": object()})
+
+    def test_hasher_setting(self):
+        with self.settings(CACHE_KEY_HASHER="md5"):
+            self.assertIs(get_key_hasher(), KEY_HASHERS["md5"])
+        get_key_hasher.cache_clear()
+        with self.settings(CACHE_KEY_HASHER="core.tests.hex_key"):
+            self.assertIs(get_key_hasher(), hex_key)
+            key = Cache(prefix="keys").generate_key({"a": 1})
+        self.assertTrue(key.endswith(b'{"a":1}'.hex()))
+        get_key_hasher.cache_clear()
+        with self.settings(CACHE_KEY_HASHER="blake2b"):
+            self.assertEqual(len(get_key_hasher()(b"data")), 20)
+
+
+class LocalCacheTierTests(SimpleTestCase):
+    def setUp(self):
+        self.backend = LocMemCache(f"local-tier-{self.id()}", {})
+        self.cache = Cache(prefix="things", timeout=60, local=True, backend=self.backend)
+
+    def test_local_hit_skips_the_backend(self):
+        self.cache.set("key", "value")
+        with mock.patch.object(self.backend, "get", wraps=self.backend.get) as get:
+            self.assertEqual(self.cache.get("key"), "value")
+            self.assertEqual(self.cache.get("key"), "value")
+        get.assert_not_called()
+
+        # a value another worker stored is read from the backend once, then locally
+        Cache(prefix="things", timeout=60, backend=self.backend).set("other", "shared")
+        with mock.patch.object(self.backend, "get", wraps=self.backend.get) as get:
+            self.assertEqual(self.cache.get("other"), "shared")
+            self.assertEqual(self.cache.get("other"), "shared")
+        get.assert_called_once()
+
+    def test_local_prefixes_setting(self):
+        with self.settings(CACHE_LOCAL_PREFIXES=["things"]):
+            self.assertIsNotNone(Cache(prefix="things", backend=self.backend).local)
+            self.assertIsNone(Cache(prefix="others", backend=self.backend).local)
+            self.assertIsNone(Cache(prefix="things", local=False, backend=self.backend).local)
+        with self.settings(CACHE_LOCAL_PREFIXES=[]):
+            self.assertIsNone(Cache(prefix="things", backend=self.backend).local)
+
+    def test_local_entries_are_bounded_in_number_and_time(self):
+        with self.settings(CACHE_LOCAL_MAX_ENTRIES=2, CACHE_LOCAL_TIMEOUT=10):
+            cache = Cache(prefix="bounded", timeout=60, local=True, backend=self.backend)
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+        self.assertEqual(len(cache.local), 2)
+        self.assertIs(cache.local.get(cache._prefix_key("a"), "evicted"), "evicted")
+
+        key = cache._prefix_key("c")
+        now = time.monotonic()
+        with mock.patch.object(time, "monotonic", return_value=now + 11):
+            self.assertIs(cache.local.get(key, "expired"), "expired")
+
+    def test_invalidation_elsewhere_hides_local_values_once_the_generation_expires(self):
+        self.cache.set("key", "value")
+        Cache(prefix="things", timeout=60, backend=self.backend).invalidate()
+        # within CACHE_LOCAL_GENERATION_TIMEOUT this worker still uses its generation
+        self.assertEqual(self.cache.get("key"), "value")
+        self.cache.generations.clear()
+        self.assertIsNone(self.cache.get("key"))
+
+
+class GetOrComputeTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = Cache(prefix="computed", timeout=60, backend=LocMemCache(self.id(), {}))
+        self.key = self.cache._prefix_key("key")
+        self.compute = mock.Mock(return_value="fresh")
+
+    def store(self, value, expires_in):
+        self.cache.set(self.key, (value, 0.01, time.time() + expires_in), 120)
+
+    def hold_lock(self):
+        self.assertTrue(self.cache._acquire_lock(self.key, 10))
+
+    def test_miss_computes_once(self):
+        self.assertEqual(self.cache.get_or_compute("key", self.compute), "fresh")
+        self.assertEqual(self.cache.get_or_compute("key", self.compute), "fresh")
+        self.compute.assert_called_once()
+
+    def test_stale_value_is_served_while_another_caller_refreshes(self):
+        self.store("stale", expires_in=-1)
+        self.hold_lock()
+        self.assertEqual(self.cache.get_or_compute("key", self.compute), "stale")
+        self.compute.assert_not_called()
+
+    def test_stale_value_is_refreshed_by_the_lock_holder(self):
+        self.store("stale", expires_in=-1)
+        self.assertEqual(self.cache.get_or_compute("key", self.compute), "fresh")
+        self.assertEqual(self.cache.get(self.key)[0], "fresh")
+        # the lock is released for the next refresh
+        self.assertTrue(self.cache._acquire_lock(self.key, 10))
+
+    def test_fresh_value_is_not_refreshed_early_without_beta(self):
+        self.store("cached", expires_in=0.5)
+        self.assertEqual(self.cache.get_or_compute("key", self.compute, beta=0), "cached")
+        self.compute.assert_not_called()
+
+    def test_cold_miss_waits_for_the_lock_holder(self):
+        self.hold_lock()
+        threading.Timer(0.1, self.store, args=("from other", 60)).start()
+        value = self.cache.get_or_compute("key", self.compute, lock_timeout=2)
+        self.assertEqual(value, "from other")
+        self.compute.assert_not_called()
+
+    def test_cold_miss_computes_when_the_lock_holder_never_stores(self):
+        self.hold_lock()
+        value = self.cache.get_or_compute("key", self.compute, lock_timeout=0.2)
+        self.assertEqual(value, "fresh")
+        self.compute.assert_called_once()
+
+    def test_lock_is_released_when_compute_fails(self):
+        self.compute.side_effect = RuntimeError
+        with self.assertRaises(RuntimeError):
+            self.cache.get_or_compute("key", self.compute)
+        self.assertTrue(self.cache._acquire_lock(self.key, 10))
+
+
+class ThingSchema(Schema):
+    name: str
+    price: Decimal
+
+
+class ThingSchemaWithStock(ThingSchema):
+    stock: int = 0
+
+
+class GetOrRenderTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = Cache(prefix="rendered", timeout=60, backend=LocMemCache(self.id(), {}))
+        product = Product(name="Rake", price=Decimal("9.50"), stock=3)
+        self.fn = mock.Mock(return_value=product)
+
+    def stored(self, schema):
+        key = f"{self.cache._prefix_key('key')}:{schema_version(schema)}"
+        return self.cache.get(key)
+
+    def test_rendered_json_is_stored(self):
+        content = self.cache.get_or_render("key", ThingSchema, self.fn)
+        self.assertEqual(json.loads(content), {"name": "Rake", "price": "9.50"})
+        # the payload, not the model instance fn returned
+        value, _, _ = self.stored(ThingSchema)
+        self.assertEqual(value, content)
+        self.assertIsInstance(value, bytes)
+
+    def test_hit_skips_the_producer_and_validation(self):
+        content = self.cache.get_or_render("key", ThingSchema, self.fn)
+        with mock.patch.object(ThingSchema, "model_validate") as model_validate:
+            self.assertEqual(self.cache.get_or_render("key", ThingSchema, self.fn), content)
+        model_validate.assert_not_called()
+        self.fn.assert_called_once()
+
+    def test_schema_change_misses_the_old_entry(self):
+        self.assertNotEqual(schema_version(ThingSchema), schema_version(ThingSchemaWithStock))
+        self.cache.get_or_render("key", ThingSchema, self.fn)
+        content = self.cache.get_or_render("key", ThingSchemaWithStock, self.fn)
+        self.assertEqual(json.loads(content)["stock"], 3)
+        self.assertEqual(self.fn.call_count, 2)
+        self.assertIsNotNone(self.stored(ThingSchema))
+
+
+class CacheMetricsTests(SimpleTestCase):
+    def setUp(self):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        self.backend = LocMemCache(f"metrics-{self.id()}", {})
+        self.cache = Cache(prefix="metered", timeout=60, backend=self.backend)
+        self.cache.metrics.flush()
+        django_cache.clear()
+
+    def flushed(self, namespace="cache:metered"):
+        flush_all()
+        return read_metrics(namespace)[namespace]
+
+    def test_cache_operations_are_counted_and_timed(self):
+        self.assertIsNone(self.cache.get("key"))
+        self.cache.set("key", "value")
+        self.assertEqual(self.cache.get("key"), "value")
+        with mock.patch.object(self.backend, "get", side_effect=RuntimeError), self.assertLogs(
+            "core.cache", "WARNING"
+        ):
+            self.assertIsNone(self.cache.get("key"))
+
+        metrics = self.flushed()
+        counters, histograms = metrics["counters"], metrics["histograms"]
+        self.assertEqual(
+            {name: counters.get(name) for name in ("hits", "misses", "sets", "errors")},
+            {"hits": 1, "misses": 1, "sets": 1, "errors": 1},
+        )
+        self.assertEqual(histograms["get_ms"]["count"], 2)
+        self.assertEqual(histograms["set_ms"]["count"], 1)
+        self.assertEqual(histograms["value_bytes"]["count"], 1)
+        self.assertEqual(histograms["value_bytes"]["avg"], _value_size("value"))
+        self.assertEqual(sum(histograms["get_ms"]["buckets"].values()), 2)
+
+    def test_flushes_add_up(self):
+        self.cache.metrics.incr("sets", 2)
+        self.flushed()
+        self.cache.metrics.incr("sets", 3)
+        self.assertEqual(self.flushed()["counters"]["sets"], 5)
+
+    def test_percentile_summary(self):
+        metrics = Metrics("summary")
+        for _ in range(90):
+            metrics.observe("latency", 0.05)
+        for _ in range(10):
+            metrics.observe("latency", 20)
+        summary = summarize(metrics.snapshot())["histograms"]["latency"]
+        self.assertEqual(summary["count"], 100)
+        self.assertAlmostEqual(summary["avg"], 2.045)
+        self.assertEqual((summary["p50"], summary["p95"], summary["p99"]), (0.1, 25, 25))
+        self.assertEqual(summary["buckets"]["0.1"], 90)
+
+        metrics.observe("latency", 5000)
+        metrics.observe("latency", 5000)
+        self.assertIsNone(summarize(metrics.snapshot())["histograms"]["latency"]["p99"])
+
+    def test_namespace_registration_waits_for_other_workers(self):
+        # another worker is adding its namespace
+        django_cache.add(f"{NAMESPACES_KEY}:lock", 1)
+        metrics = Metrics("cache:registering")
+        metrics.incr("sets")
+        metrics.flush()
+        self.assertEqual(read_metrics("cache:registering"), {})
+        self.assertEqual(metrics.snapshot()["counters"], {"sets": 1})
+
+        django_cache.delete(f"{NAMESPACES_KEY}:lock")
+        metrics.flush()
+        self.cache.metrics.incr("sets")
+        self.cache.metrics.flush()
+        registered = read_metrics("cache:registering")
+        self.assertEqual(registered["cache:registering"]["counters"], {"sets": 1})
+        self.assertIn("cache:metered", read_metrics("cache:"))
+
+
+class CacheStatsCommandTests(SimpleTestCase):
+    def setUp(self):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+
+    def stats(self, *args):
+        output = StringIO()
+        call_command("cache_stats", *args, stdout=output)
+        return output.getvalue()
+
+    def test_other_namespaces_can_be_read(self):
+        metrics = get_metrics("stats_test:uploads")
+        metrics.incr("accepted", 3)
+        metrics.incr("rejected_size")
+        output = self.stats("--namespace", "stats_test")
+        self.assertIn("stats_test:uploads", output)
+        self.assertRegex(output, r"accepted\s+3")
+        self.assertRegex(output, r"rejected_size\s+1")
+        self.assertNotIn("stats_test", self.stats())
+
+    def test_prefix_json_and_reset(self):
+        for prefix, hits in (("stats_a", 2), ("stats_b", 1)):
+            cache = Cache(prefix=prefix, timeout=60, backend=LocMemCache(prefix, {}))
+            cache.set("key", "value")
+            for _ in range(hits):
+                cache.get("key")
+
+        output = self.stats("--prefix", "stats_a")
+        self.assertRegex(output, r"stats_a\s+2\s+0\s+100.0")
+        self.assertNotIn("stats_b", output)
+
+        metrics = json.loads(self.stats("--prefix", "stats_", "--json"))
+        self.assertEqual(sorted(metrics), ["cache:stats_a", "cache:stats_b"])
+        self.assertEqual(metrics["cache:stats_b"]["counters"]["hits"], 1)
+
+        output = self.stats("--prefix", "stats_a", "--reset")
+        self.assertIn("Metrics reset for cache:stats_a*.", output)
+        self.assertEqual(read_metrics("cache:stats_"), {"cache:stats_b": mock.ANY})
@@ -1,6 +1,7 @@
 from typing import Union
 from django.apps import apps
 from django.contrib import admin
+from django.http import HttpResponse
 from ninja import Schema
 
 
@@ -38,3 +39,8 @@ def schema_to_dict(schema: Union[Schema, dict, None]) -> dict:
         return schema
     else:
         return {}
+
+
+def json_response(payload: bytes, status: int = 200) -> HttpResponse:
+    """Response for a JSON payload that was already rendered, e.g. by Cache.get_or_render"""
+    return HttpResponse(payload, status=status, content_type="application/json")